@@ -1,6 +1,6 @@
 from openai import OpenAI
 from pydantic import BaseModel, Field
-from typing import Union, Literal, List, Optional, Dict, Any, Tuple
+from typing import Union, Literal, List, Optional, Dict, Any, Tuple, ClassVar
 import json
 import os
 import glob
@@ -9,6 +9,21 @@ from dataclasses import dataclass, field as dataclass_field
 import heapq
 import sys
 import math
+import threading
+from navigation import PortalGraph, OccupancyGrid, FlowField, RouteQuery, DoorReservationTable, find_routes_batch, shutdown_route_pool, item_rect, repair_path, FLOW_FIELD_MIN_GROUP
+from spatial import SpatialHash, SpaceIndex, rects_overlap
+from movement import MovementSystem, OffscreenMovement, wall_permissions_for, DEFAULT_NPC_RADIUS
+from perception import Perception, Percept
+from triggers import TriggerSystem
+from named_index import NamedIndex
+from entities import ItemEntity
+from ecs import EntityStore, populate_from_world
+from journal import WorldJournal
+from names import NameTable, NO_ID
+from prototypes import PrototypeCatalog, item_save_data
+from fragments import FragmentCache
+from snapshot import SnapshotBuilder, DecisionQueue, NPCDecision, WorldSnapshot
+from commands import WorldCommand, CommandQueue, CreateItem, DeleteItem, ChangeItemDescription, ReplaceItem, MoveItemToInventory, apply_batch
 
 client = OpenAI()
 
@@ -53,6 +68,14 @@ class Item(BaseModel):
     image_path: Optional[str] = None      # 新增：圖片路徑
     image_scale: float = 1.0              # 新增：圖片縮放比例
 
+    # Item 只用於載入/存檔的驗證；模擬執行期 (空間、庫存、世界物品字典) 使用輕量的 ItemEntity
+    def to_entity(self) -> ItemEntity:
+        return ItemEntity.from_model(self)
+
+    @classmethod
+    def from_entity(cls, entity: ItemEntity) -> "Item":
+        return cls(**entity.to_dict())
+
 
 #NOTE: Space 空間 class
 
@@ -109,12 +132,21 @@ class ConversationManager(BaseModel):
 class Space(BaseModel):
     name: str  # Space name, e.g., "kitchen" or "living_room"
     description: str  # Description of the space
-    connected_spaces: List["Space"] = []  # Connected spaces (bidirectional relationships)
-    items: List["Item"] = []  # Items in the space
-    npcs: List["NPC"] = Field(default_factory=list)  # NPCs currently in the space
+    connected_spaces: NamedIndex["Space"] = Field(default_factory=NamedIndex)  # Connected spaces (bidirectional relationships，以身分判斷成員)
+    items: NamedIndex[ItemEntity] = Field(default_factory=NamedIndex)  # Items in the space (依名稱索引，可當列表使用)
+    npcs: NamedIndex["NPC"] = Field(default_factory=NamedIndex)  # NPCs currently in the space (以身分判斷成員)
     display_pos: Tuple[int, int] = (0, 0)  # for pygame display
     display_size: Tuple[int, int] = (0, 0)  # for pygame display
+    cluster: Optional[str] = None  # 所屬群組 (例如建築/樓層)，供階層式路徑規劃使用
     conversation_manager: Optional["ConversationManager"] = None
+    uid: int = NO_ID  # 載入時由 NameTable 指定的整數 id
+
+    # 空間拓撲 (連接、位置、大小) 的全域版本號；改變時門戶圖、空間索引等快取會在下次取用時重建
+    topology_version: ClassVar[int] = 0
+    # 目前世界的變更日誌 (build_world_from_data 設定)；連接與幾何改變時記錄
+    journal: ClassVar[Optional[WorldJournal]] = None
+    # 目前世界的文字片段快取 (build_world_from_data 設定)；空間與 NPC 的描述文字依日誌版本號沿用
+    fragments: ClassVar[Optional[FragmentCache]] = None
 
     model_config = {"arbitrary_types_allowed": True}
 
@@ -122,15 +154,56 @@ class Space(BaseModel):
         """
         Establish a bidirectional connection between this space and another space.
         """
+        changed = False
         if other_space not in self.connected_spaces:
             self.connected_spaces.append(other_space)
+            changed = True
         if self not in other_space.connected_spaces:
             other_space.connected_spaces.append(self)
+            changed = True
+        if changed:
+            Space.topology_version += 1
+            if Space.journal is not None:
+                Space.journal.record("spaces_connected", ("space", self.name), ("space", other_space.name))
+
+    def disconnect(self, other_space: "Space") -> None:
+        """
+        Remove the bidirectional connection between this space and another space.
+        """
+        changed = False
+        if other_space in self.connected_spaces:
+            self.connected_spaces.remove(other_space)
+            changed = True
+        if self in other_space.connected_spaces:
+            other_space.connected_spaces.remove(self)
+            changed = True
+        if changed:
+            Space.topology_version += 1
+            if Space.journal is not None:
+                Space.journal.record("spaces_disconnected", ("space", self.name), ("space", other_space.name))
+
+    def set_geometry(self, display_pos: Tuple[int, int], display_size: Tuple[int, int]) -> None:
+        """
+        移動空間或改變空間大小 (門的位置會跟著改變)。
+        """
+        self.display_pos = tuple(display_pos)
+        self.display_size = tuple(display_size)
+        Space.topology_version += 1
+        if Space.journal is not None:
+            Space.journal.record("space_geometry_changed", ("space", self.name))
 
     def __str__(self) -> str:
         """
         Returns a string representation of the space, including its connections, items, and NPCs.
+        有變更日誌時文字會被快取，只有空間 (連接、物品、NPC) 改變後才重新產生。
         """
+        if Space.fragments is None or Space.journal is None:
+            return self._render()
+        version = (Space.journal.version_of(("space", self.name)), self.description,
+                   len(self.connected_spaces), len(self.items), len(self.npcs))
+        return Space.fragments.get(("space", self.name), version, self._render)
+
+    def _render(self) -> str:
         connected = ", ".join([space.name for space in self.connected_spaces]) if self.connected_spaces else "none"
         items = ", ".join([item.name for item in self.items]) if self.items else "none"
         npcs = ", ".join([npc.name for npc in self.npcs]) if self.npcs else "none"
@@ -145,10 +218,10 @@ class Space(BaseModel):
 #NOTE: Define Inventory
 # Inventory 類
 class Inventory(BaseModel):
-    items: List[Item] = []  # 存放物品的列表
+    items: NamedIndex[ItemEntity] = Field(default_factory=NamedIndex)  # 存放物品 (依名稱索引，可當列表使用)
     capacity: Optional[int] = None  # 容量限制（可選）
 
-    def add_item(self, item: Item) -> str:
+    def add_item(self, item: ItemEntity) -> str:
         """
         將物品添加到 Inventory。
         """
@@ -160,10 +233,9 @@ class Inventory(BaseModel):
         """
         根據物品名稱從 Inventory 中移除物品。
         """
-        for i, item in enumerate(self.items):
-            if item.name == item_name:
-                removed_item = self.items.pop(i)
-                return f"Removed {removed_item.name} from inventory."
+        removed_item = self.items.remove_name(item_name)
+        if removed_item is not None:
+            return f"Removed {removed_item.name} from inventory."
         return f"Item with name '{item_name}' not found in inventory."
 
 
@@ -171,7 +243,13 @@ class Inventory(BaseModel):
         """
         檢查 Inventory 中是否有指定名稱的物品。
         """
-        return any(item.name == item_name for item in self.items)
+        return self.items.has(item_name)
+
+    def get_item(self, item_name: str, ignore_case: bool = False) -> Optional[ItemEntity]:
+        """
+        依名稱取得 Inventory 中的物品，找不到時回傳 None。
+        """
+        return self.items.find(item_name) if ignore_case else self.items.get(item_name)
 
     def list_items(self) -> str:
         """
@@ -214,6 +292,113 @@ class PathPlanner(BaseModel):
     grid_cell_size: int = 20
     npc_radius: float = 15.0
     model_config = {"arbitrary_types_allowed": True}
+
+    # _occupancy_grids / _flow_fields / _item_hashes / _topology_version 屬於 runtime 狀態，不序列化
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._occupancy_grids: Dict[str, OccupancyGrid] = {}  # 空間名稱 -> 佔用網格
+        self._flow_fields: Dict[Tuple[str, Tuple[int, int]], FlowField] = {}  # (空間名稱, 目標格子) -> 流場
+        self._item_hashes: Dict[str, SpatialHash] = {}  # 空間名稱 -> 物品矩形的空間雜湊 (碰撞檢查用)
+        self._topology_version = Space.topology_version  # 網格與雜湊建立時的空間拓撲版本
+
+    def _check_topology(self) -> None:
+        """空間位置或大小改變後，佔用網格與物品雜湊的範圍已失效，全部丟棄待下次重建。"""
+        if self._topology_version != Space.topology_version:
+            self._occupancy_grids.clear()
+            self._flow_fields.clear()
+            self._item_hashes.clear()
+            self._topology_version = Space.topology_version
+
+    def get_item_hash(self, space: "Space") -> SpatialHash:
+        """取得空間的物品空間雜湊（第一次使用時依目前物品建立），矩形不含 NPC 半徑。"""
+        self._check_topology()
+        item_hash = self._item_hashes.get(space.name)
+        if item_hash is None:
+            item_hash = SpatialHash.from_rects(
+                (item, rect) for item, rect in ((item, item_rect(item)) for item in space.items) if rect
+            )
+            self._item_hashes[space.name] = item_hash
+        return item_hash
+
+    def get_occupancy_grid(self, space: "Space") -> Optional[OccupancyGrid]:
+        """取得空間的佔用網格（第一次使用時依目前物品建立），物品障礙物會向外擴張 NPC 半徑。"""
+        self._check_topology()
+        grid = self._occupancy_grids.get(space.name)
+        if grid is None:
+            if not space.display_size or not space.display_size[0] or not space.display_size[1]:
+                return None
+            x, y = space.display_pos
+            w, h = space.display_size
+            grid = OccupancyGrid((x, y, x + w, y + h), self.grid_cell_size)
+            for item in space.items:
+                rect = item_rect(item, self.npc_radius)
+                if rect:
+                    grid.add_obstacle(rect)
+            self._occupancy_grids[space.name] = grid
+        return grid
+
+    def get_flow_field(self, space: "Space", goal: Tuple[float, float]) -> Optional[FlowField]:
+        """
+        取得空間內朝 goal 的流場，前往同一格子的 NPC 共用同一份。
+        佔用網格改變 (物品增減或移動) 後的第一次查詢會重建。
+        """
+        grid = self.get_occupancy_grid(space)
+        if grid is None:
+            return None
+        key = (space.name, grid.cell_of(goal))
+        field = self._flow_fields.get(key)
+        if field is None or field.is_stale():
+            field = FlowField(grid, goal)
+            self._flow_fields[key] = field
+        return field
+
+    def on_item_added(self, space: "Space", item: ItemEntity, npcs: List["NPC"]) -> int:
+        """
+        物品出現在空間後呼叫：更新佔用網格，並只修補路徑穿過該物品的 NPC。
+        回傳被修補路徑的 NPC 數量。
+        """
+        rect = item_rect(item, self.npc_radius)
+        if rect is None:
+            return 0
+        if space.name in self._item_hashes:
+            self._item_hashes[space.name].insert(item, item_rect(item))
+        grid_existed = space.name in self._occupancy_grids
+        grid = self.get_occupancy_grid(space)  # 新建立的網格已包含此物品
+        if grid is None:
+            return 0
+        if grid_existed:
+            grid.add_obstacle(rect)
+
+        repaired_count = 0
+        for npc in npcs:
+            if npc.path_planner is not self or not npc.current_path_points or not npc.position:
+                continue
+            new_points = repair_path(tuple(npc.position[:2]), npc.current_path_points, rect, grid)
+            if new_points is None:
+                # 無法修補：清除路徑點，讓 NPC 直接朝 move_target 前進並交給避障邏輯
+                npc.current_path_points = []
+            elif new_points != npc.current_path_points:
+                npc.current_path_points = new_points
+                repaired_count += 1
+        return repaired_count
+
+    def on_item_removed(self, space: "Space", item: ItemEntity) -> None:
+        """物品離開空間後呼叫：釋放佔用的格子。格子變空不會讓既有路徑失效，因此不需重新規劃。"""
+        rect = item_rect(item, self.npc_radius)
+        grid = self._occupancy_grids.get(space.name)
+        if rect and grid:
+            grid.remove_obstacle(rect)
+        if space.name in self._item_hashes:
+            self._item_hashes[space.name].remove(item)
+
+    def on_item_moved(self, space: "Space", item: ItemEntity, old_position: List[float], npcs: List["NPC"]) -> int:
+        """物品在空間內移動後呼叫 (item.position 已是新位置)：釋放舊位置的格子，再依新位置加入並修補路徑。"""
+        grid = self._occupancy_grids.get(space.name)
+        if grid and old_position and item.size:
+            r = self.npc_radius
+            grid.remove_obstacle((old_position[0] - r, old_position[1] - r,
+                                  old_position[0] + item.size[0] + r, old_position[1] + item.size[1] + r))
+        return self.on_item_added(space, item, npcs)
     
     def get_space_obstacles_for_grid(self, space: "Space", obstacle_buffer: float = 5.0) -> List["SimpleRect"]:
         """獲取空間中的障礙物。用於網格路徑規劃。"""
@@ -239,7 +424,8 @@ class PathPlanner(BaseModel):
     
     def find_path_with_obstacles(self, start_space: Space, goal_space: Space,
                              start_pos: Tuple[float,float], goal_pos: Tuple[float,float],
-                             all_spaces: Dict[str, Space]) -> List[Tuple[float,float]]:
+                             all_spaces: Dict[str, Space],
+                             portal_graph: Optional[PortalGraph] = None) -> List[Tuple[float,float]]:
         """
         尋找考慮障礙物的路徑
         
@@ -249,6 +435,7 @@ class PathPlanner(BaseModel):
             start_pos: 起始位置 (世界座標)
             goal_pos: 目標位置 (世界座標)
             all_spaces: 所有空間的字典
+            portal_graph: 跨空間時使用的門戶圖，未提供時依 all_spaces 建立
             
         Returns:
             包含路徑點的列表 (世界座標)
@@ -293,15 +480,16 @@ class PathPlanner(BaseModel):
             
             return path
         
-        # 使用高級路徑規劃找到空間級路徑
-        space_level_path = find_path_astar(all_spaces, start_space.name, goal_space.name)
-        
-        if not space_level_path or len(space_level_path) <= 1:
+        # 跨空間：使用門戶圖找出要經過的門，路徑依序穿過各門中點
+        if portal_graph is None:
+            if not all_spaces:
+                return path
+            portal_graph = PortalGraph.from_spaces(all_spaces.values())
+        route = portal_graph.find_route(start_space.name, goal_space.name, start_pos, goal_pos)
+        if not route or len(route.spaces) <= 1:
             return path
-        
-        # 返回起點和終點構成的直線路徑
-        # 在實際應用中，這裡可以實現更複雜的路徑規劃邏輯
-        return path
+
+        return [start_pos] + list(route.waypoints) + [goal_pos]
     
     def _line_intersects_rect(self, start: Tuple[float, float], end: Tuple[float, float], rect: SimpleRect) -> bool:
         """檢查線段是否與矩形相交"""
@@ -337,19 +525,75 @@ class PathPlanner(BaseModel):
         return ((d1 > 0 and d2 < 0) or (d1 < 0 and d2 > 0)) and \
                ((d3 > 0 and d4 < 0) or (d3 < 0 and d4 > 0))
 
-def heuristic(space_a_pos: Tuple[float, float], space_b_pos: Tuple[float, float]) -> float:
-    """計算兩點之間的歐幾里得距離。"""
-    return math.sqrt((space_a_pos[0] - space_b_pos[0])**2 + (space_a_pos[1] - space_b_pos[1])**2)
+def get_portal_graph(world: Dict[str, Any]) -> Optional[PortalGraph]:
+    """
+    取得世界的門戶圖。build_world_from_data 會預先建立並存放於 world["portal_graph"]；
+    若不存在（例如手動組裝的 world），則依 world["spaces"] 建立並存回 world。
+    空間拓撲改變過 (Space.topology_version 不同) 時，門戶圖與空間索引會就地重建，門的預約與批次路徑的行程池會清除。
+    """
+    if not world or not world.get("spaces"):
+        return None
+    portal_graph = world.get("portal_graph")
+    if portal_graph is None:
+        portal_graph = PortalGraph.from_spaces(world["spaces"].values())
+        portal_graph.topology_version = Space.topology_version
+        world["portal_graph"] = portal_graph
+    elif portal_graph.topology_version != Space.topology_version:
+        portal_graph.rebuild(world["spaces"].values(), Space.topology_version)
+        if world.get("space_index") is not None:
+            world["space_index"].rebuild(world["spaces"].values())
+        if world.get("door_reservations") is not None:
+            world["door_reservations"].clear()
+        shutdown_route_pool()  # 工作行程持有舊門戶圖的快照，下次批次查詢時以新的拓撲重建
+    return portal_graph
+
+def get_space_index(world: Dict[str, Any]) -> Optional[SpaceIndex]:
+    """取得世界的空間索引 (查詢某一點位於哪個空間)，不存在時依 world["spaces"] 建立並存回 world。"""
+    if not world or not world.get("spaces"):
+        return None
+    get_portal_graph(world)  # 拓撲改變時順便重建空間索引
+    space_index = world.get("space_index")
+    if space_index is None:
+        space_index = SpaceIndex(world["spaces"].values())
+        world["space_index"] = space_index
+    return space_index
+
+def locate_space(world: Dict[str, Any], position: Optional[List[float]]) -> Optional["Space"]:
+    """回傳世界座標 position 所在的空間，不在任何空間內時回傳 None。"""
+    space_index = get_space_index(world)
+    if space_index is None or not position or len(position) < 2:
+        return None
+    return space_index.space_at((position[0], position[1]))
 
-def find_path_astar(world_spaces: Dict[str, "Space"], start_space_name: str, goal_space_name: str) -> Optional[List[str]]:
+def get_door_reservations(world: Dict[str, Any]) -> Optional[DoorReservationTable]:
+    """取得世界的門預約表 (協同路徑規劃用)，不存在時建立並存回 world。"""
+    if not world or not world.get("spaces"):
+        return None
+    reservations = world.get("door_reservations")
+    if reservations is None:
+        reservations = DoorReservationTable()
+        world["door_reservations"] = reservations
+    return reservations
+
+def find_path_astar(world_spaces: Dict[str, "Space"], start_space_name: str, goal_space_name: str,
+                    portal_graph: Optional[PortalGraph] = None,
+                    start_pos: Optional[Tuple[float, float]] = None,
+                    goal_pos: Optional[Tuple[float, float]] = None,
+                    reservations: Optional[DoorReservationTable] = None,
+                    owner: Optional[str] = None,
+                    speed: float = 1.0,
+                    hold: float = 0.0) -> Optional[List[str]]:
     """
-    使用 A* 演算法尋找 start_space_name 和 goal_space_name 之間的最短路徑。
-    此版本直接使用 Space 物件的 connected_spaces。
+    使用門戶圖 (門中點為節點、空間內步行距離為邊) 上的 A* 尋找 start_space_name 和 goal_space_name 之間的最短路徑。
 
     Args:
         world_spaces (dict): 空間物件的字典，以名稱為鍵。
         start_space_name (str): 起始空間的名稱。
         goal_space_name (str): 目標空間的名稱。
+        portal_graph (PortalGraph): 預先建立的門戶圖；未提供時依 world_spaces 臨時建立。
+        start_pos / goal_pos: 起點與終點的世界座標；未提供時使用空間中心。
+        reservations (DoorReservationTable): 提供時以協同 A* 避開其他 NPC 已預約的門，並替 owner 登記這條路線。
+        speed / hold: owner 每步移動的距離，以及通過一扇門需要佔用的步數。
 
     Returns:
         list: 代表從起點到終點路徑的空間名稱列表，如果找不到路徑則返回 None。
@@ -363,89 +607,657 @@ def find_path_astar(world_spaces: Dict[str, "Space"], start_space_name: str, goa
     if start_space_name == goal_space_name:
         return [start_space_name]
 
-    start_space = world_spaces[start_space_name]
-    goal_space = world_spaces[goal_space_name]
+    if portal_graph is None:
+        portal_graph = PortalGraph.from_spaces(world_spaces.values())
 
-    def get_space_center(space_obj: "Space") -> Tuple[float, float]:
-        if not hasattr(space_obj, 'display_pos') or not hasattr(space_obj, 'display_size') or \
-            space_obj.display_pos is None or space_obj.display_size is None:
-            # print(f"警告: 空間 {getattr(space_obj, 'name', '未知')} 缺少 display_pos 或 display_size 或其值為None。") # Debugging
-            return (0.0, 0.0)
-        return (
-            float(space_obj.display_pos[0] + space_obj.display_size[0] / 2),
-            float(space_obj.display_pos[1] + space_obj.display_size[1] / 2)
-        )
+    route = portal_graph.find_route(start_space_name, goal_space_name, start_pos, goal_pos,
+                                    reservations=reservations, owner=owner, speed=speed, hold=hold)
+    if route is None:
+        # print(f"A* 警告: 從 {start_space_name} 到 {goal_space_name} 找不到路徑。") # Debugging
+        return None
+    if reservations is not None and owner:
+        reservations.reserve_route(owner, route, hold)
+    return route.spaces
 
-    open_set = []
-    heapq.heappush(open_set, (0, start_space_name))
+#NOTE: MovementEngine 移動與碰撞
+# SandBox 沒有畫面，每個 tick 推進的步數 (pygame 以 30 FPS 執行，約等於一秒)
+HEADLESS_TICK_FRAMES = 30
 
-    came_from = {}
-    g_score = {name: float('inf') for name in world_spaces}
-    if start_space_name in g_score: # 防禦性檢查
-        g_score[start_space_name] = 0
-    else:
-        # print(f"A* 內部錯誤: start_space_name '{start_space_name}' 不在 g_score 字典中。") # Debugging
-        return None # 或者其他錯誤處理
-        
-    f_score = {name: float('inf') for name in world_spaces}
-    if start_space_name in f_score: # 防禦性檢查
-        f_score[start_space_name] = heuristic(get_space_center(start_space), get_space_center(goal_space))
-    else:
-        # print(f"A* 內部錯誤: start_space_name '{start_space_name}' 不在 f_score 字典中。") # Debugging
-        return None # 或者其他錯誤處理
-
-    processed_nodes_count = 0
-    while open_set:
-        processed_nodes_count += 1
-        if processed_nodes_count > len(world_spaces) * 10: 
-            # print(f"A* 警告: 處理節點過多 ({processed_nodes_count})，可能存在迴圈或無法到達的目標 ({start_space_name} -> {goal_space_name})。") # Debugging
+def offscreen_route(npc, portal_graph, all_spaces_dict):
+    """
+    NPC 剩下的 A* 路線對應的折線：目前位置 -> 依序穿過的門中點 -> 目的地空間中心。
+    回傳 (路徑點, 每個路徑點之後所在的空間, 路線上的空間名稱)；無法組成折線時回傳 None。
+    """
+    if portal_graph is None or not npc.current_space or not npc.position or not npc.current_path_segment_target_space_name:
+        return None
+    route_spaces = [npc.current_space.name, npc.current_path_segment_target_space_name] + list(npc.path_to_follow or [])
+    points = [(float(npc.position[0]), float(npc.position[1]))]
+    for space_a, space_b in zip(route_spaces, route_spaces[1:]):
+        if space_a == space_b:
+            continue
+        point = portal_graph.connection_point(space_a, space_b)
+        if point is None:
             return None
+        points.append(point)
+    goal_space = all_spaces_dict.get(route_spaces[-1])
+    if goal_space is None or not goal_space.display_pos or not goal_space.display_size:
+        return None
+    points.append((float(goal_space.display_pos[0] + goal_space.display_size[0] / 2),
+                   float(goal_space.display_pos[1] + goal_space.display_size[1] / 2)))
+    waypoint_spaces = [name for a, name in zip(route_spaces, route_spaces[1:]) if a != name] + [route_spaces[-1]]
+    return points, waypoint_spaces, route_spaces
+
+
+def finish_offscreen_trip(npc, trip, position, passed, arrived, all_spaces_dict):
+    """把結束解析式移動的 NPC 放到內插位置，並依已經過的門更新所在空間與剩下的 A* 路線。"""
+    npc.position = [float(position[0]), float(position[1])]
+    npc.display_pos = [int(p) for p in npc.position]
+    space_name = trip.waypoint_spaces[passed - 1] if passed > 0 else npc.current_space.name
+    new_space = all_spaces_dict.get(space_name)
+    if new_space is not None and new_space is not npc.current_space:
+        if npc.current_space and npc in npc.current_space.npcs:
+            npc.current_space.npcs.remove(npc)
+        npc.current_space = new_space
+        if npc not in new_space.npcs:
+            new_space.npcs.append(npc)
+    route_key = (npc.current_path_segment_target_space_name, tuple(npc.path_to_follow or []))
+    if route_key != trip.tag[0]:
+        return  # 行程期間 NPC 收到新的移動指令，保留新的路線
+    route_spaces = trip.tag[1]
+    npc.move_target = None  # 交由 A* 路線跟隨邏輯重新設定門口或中心點
+    if arrived:
+        npc.current_path_segment_target_space_name = None
+        npc.path_to_follow = []
+        return
+    remaining = route_spaces[route_spaces.index(space_name) + 1:] if space_name in route_spaces else []
+    if remaining:
+        npc.current_path_segment_target_space_name = remaining[0]
+        npc.path_to_follow = remaining[1:]
+    else:
+        npc.current_path_segment_target_space_name = space_name  # 已穿過最後一扇門，前往目的地中心
+        npc.path_to_follow = []
 
-        _, current_name = heapq.heappop(open_set)
 
-        if current_name == goal_space_name:
-            path = []
-            temp_name = current_name
-            while temp_name in came_from:
-                path.append(temp_name)
-                temp_name = came_from[temp_name]
-            path.append(start_space_name)
-            return path[::-1]
+class MovementEngine:
+    """
+    NPC 的移動與碰撞引擎，pygame 畫面與沒有畫面的 SandBox 共用同一份邏輯。
 
-        current_space_obj = world_spaces.get(current_name)
-        if not current_space_obj:
-            continue
-        current_center = get_space_center(current_space_obj)
+    每次 step(npcs, dt) 依序處理：門的預約與畫面外 NPC 的解析式移動、依 A* 路線設定 move_target、
+    以 MovementSystem 向量化計算位移與撞牆、抵達與互動、物品避障，最後更新 NPC 所在的空間。
+    dt 以 pygame 的一幀為單位 (NPC 每幀移動 move_speed)。
+    """
 
-        if not hasattr(current_space_obj, 'connected_spaces') or current_space_obj.connected_spaces is None:
-            continue
+    def __init__(self, world: Dict[str, Any], path_planner: Optional[PathPlanner] = None,
+                 door_queue_distance: float = DEFAULT_NPC_RADIUS * 3, use_flow_fields: bool = True):
+        self.world = world
+        self.path_planner = path_planner or PathPlanner()
+        self.door_queue_distance = door_queue_distance  # 提早抵達預約的門時，在離門這個距離內排隊等待
+        self.use_flow_fields = use_flow_fields  # 沿 A* 路徑前往門口或空間中心時依流場前進 (繞過物品)
+        self.movement_system = MovementSystem()
+        self.offscreen_movement = OffscreenMovement()
+
+    def run(self, npcs: List["NPC"], frames: int, dt: float = 1.0, **kwargs) -> List[str]:
+        """連續推進 frames 步 (例如 SandBox 的一個 tick)，回傳期間完成的互動結果。"""
+        results: List[str] = []
+        for _ in range(frames):
+            results.extend(self.step(npcs, dt, **kwargs))
+        return results
+
+    def step(self, npcs: List["NPC"], dt: float = 1.0,
+             visible_rect: Optional[Tuple[float, float, float, float]] = None, headless: bool = False) -> List[str]:
+        """
+        推進所有 NPC 一步，回傳這一步完成的互動結果。
+
+        visible_rect 為畫面涵蓋的世界座標範圍，所在空間不在其中的 NPC 改為解析式移動；
+        None 表示全部可見。headless 為 True 時沒有任何 NPC 被看見 (SandBox)。
+        """
+        results: List[str] = []
+        all_spaces_dict = self.world.get("spaces", {})
+        path_planner = self.path_planner
+        movement_system = self.movement_system
+        offscreen_movement = self.offscreen_movement
+        # 門的資訊來自門戶圖 (載入時已計算)，不再每步重新計算；只有空間拓撲改變時才會重建
+        portal_graph = get_portal_graph(self.world)
+        calculated_doors = portal_graph.doors if portal_graph else []
+        door_reservations = get_door_reservations(self.world)
+        space_index = get_space_index(self.world)
+        if door_reservations is not None:
+            door_reservations.advance(dt)
+
+        # 不在畫面上的 NPC：被看見、抵達或收到新路線時結束解析式移動，其餘的不參與逐步移動
+        offscreen_movement.advance(dt)
+        def should_stop_offscreen(npc, position):
+            if (npc.current_path_segment_target_space_name, tuple(npc.path_to_follow or [])) != offscreen_movement.trip_of(npc).tag[0]:
+                return True
+            return not headless and (visible_rect is None or
+                rects_overlap(visible_rect, (position[0] - 1, position[1] - 1, position[0] + 1, position[1] + 1)))
+        perception = self.world.get("perception")
+        triggers = get_triggers(self.world)
+        ecs = self.world.get("ecs")
+        journal = self.world.get("journal")
+        for npc, trip, trip_position, trip_passed, trip_arrived in offscreen_movement.due(should_stop_offscreen):
+            space_before = npc.current_space
+            if perception is not None:
+                perception.touch(npc.current_space.name if npc.current_space else None)
+            finish_offscreen_trip(npc, trip, trip_position, trip_passed, trip_arrived, all_spaces_dict)
+            if journal is not None and npc.current_space is not space_before:
+                journal.record("npc_space_changed", ("npc", npc.name), ("space", space_before.name), ("space", npc.current_space.name))
+            if perception is not None:
+                perception.touch(npc.current_space.name if npc.current_space else None)
+            if triggers is not None:
+                results.extend(triggers.moved(npc))
+            if ecs is not None:
+                ecs.sync_npc(npc)
+        if headless or visible_rect is not None:
+            for npc in npcs:
+                if npc in offscreen_movement or not npc.current_path_segment_target_space_name or \
+                    not npc.current_space or (npc.waiting_interaction and npc.waiting_interaction.get('started')):
+                    continue
+                space_rect = (npc.current_space.display_pos[0], npc.current_space.display_pos[1],
+                              npc.current_space.display_pos[0] + npc.current_space.display_size[0],
+                              npc.current_space.display_pos[1] + npc.current_space.display_size[1])
+                if not headless and rects_overlap(visible_rect, space_rect):
+                    continue
+                route = offscreen_route(npc, portal_graph, all_spaces_dict)
+                if route is not None:
+                    route_key = (npc.current_path_segment_target_space_name, tuple(npc.path_to_follow or []))
+                    offscreen_movement.begin(npc, route[0], route[1], tag=(route_key, route[2]))
+        stepped_npcs = [npc for npc in npcs if npc not in offscreen_movement] if len(offscreen_movement) else npcs
+        # 移動前的位置與空間，步驟結束後用來通知感知快取與觸發器哪些 NPC 有移動
+        before_step = [(npc.current_space, tuple(npc.position) if npc.position else None) for npc in stepped_npcs] \
+            if perception is not None or triggers is not None or ecs is not None or journal is not None else []
+
+        # 第一階段 (逐一 NPC)：整理位置，並依 A* 路徑設定 move_target
+        door_waiting_flags = []
+        exit_allowed_flags = []
+        flow_headings = []
+        for npc in stepped_npcs:
+            waiting_for_door = False
+            if npc.position is None: 
+                npc.position = [0.0, 0.0]
+            else:
+                npc.position = [float(p) for p in npc.position]
+
+            current_npc_space_name = npc.current_space.name if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'name') else None
+
+            # --- A* Path Following Logic (largely unchanged, sets npc.move_target to doors/space centers) ---
+            if hasattr(npc, 'current_path_segment_target_space_name') and npc.current_path_segment_target_space_name:
+                # ... (Your existing A* segment target logic, lines 1118-1183 or similar) ...
+                # This part should set npc.move_target to a door or space center if on an A* path
+                # For brevity, I'm not reproducing all of it, but it should remain functional.
+                target_segment_space_name = npc.current_path_segment_target_space_name
+                target_space_obj = all_spaces_dict.get(target_segment_space_name)
+                current_npc_actual_space = npc.current_space
+
+                if target_space_obj and current_npc_actual_space and hasattr(current_npc_actual_space, 'name'):
+                    if current_npc_actual_space.name != target_segment_space_name:
+                        entry_door_to_target = portal_graph.get_door(current_npc_actual_space.name, target_segment_space_name) if portal_graph else None
+                        if entry_door_to_target:
+                            door_center_x, door_center_y = 0.0, 0.0
+                            if entry_door_to_target['type'] == 'vertical':
+                                door_center_x = float(entry_door_to_target['wall_x_world'])
+                                door_center_y = float((entry_door_to_target['opening_start_world'] + entry_door_to_target['opening_end_world']) / 2)
+                            elif entry_door_to_target['type'] == 'horizontal':
+                                door_center_x = float((entry_door_to_target['opening_start_world'] + entry_door_to_target['opening_end_world']) / 2)
+                                door_center_y = float(entry_door_to_target['wall_y_world'])
+                            nudge_amount = 15.0
+                            final_target_x, final_target_y = door_center_x, door_center_y
+                            current_space_name_for_nudge = current_npc_actual_space.name
+                            if entry_door_to_target.get('s1_name') == current_space_name_for_nudge and entry_door_to_target.get('s2_name') == target_segment_space_name:
+                                s1_edge = entry_door_to_target.get('s1_edge_name')
+                                if s1_edge == 'right': final_target_x += nudge_amount
+                                elif s1_edge == 'left': final_target_x -= nudge_amount
+                                elif s1_edge == 'bottom': final_target_y += nudge_amount
+                                elif s1_edge == 'top': final_target_y -= nudge_amount
+                            elif entry_door_to_target.get('s2_name') == current_space_name_for_nudge and entry_door_to_target.get('s1_name') == target_segment_space_name:
+                                s2_edge = entry_door_to_target.get('s2_edge_name')
+                                if s2_edge == 'right': final_target_x += nudge_amount
+                                elif s2_edge == 'left': final_target_x -= nudge_amount
+                                elif s2_edge == 'bottom': final_target_y += nudge_amount
+                                elif s2_edge == 'top': final_target_y -= nudge_amount
+                            npc.move_target = [final_target_x, final_target_y]
+
+                            # 協同預約：提早抵達門口時，在門前排隊等到自己的時段再通過
+                            if door_reservations is not None:
+                                door_slot = door_reservations.slot_of(npc.name, portal_graph.portal_index(current_npc_actual_space.name, target_segment_space_name))
+                                if door_slot and door_reservations.now < door_slot[0] and \
+                                    math.hypot(door_center_x - npc.position[0], door_center_y - npc.position[1]) <= self.door_queue_distance:
+                                    waiting_for_door = True
+                                    npc.action_status = "在門口等待通過"
+                        else:
+                            if hasattr(target_space_obj, 'display_pos') and hasattr(target_space_obj, 'display_size'):
+                                center_x = float(target_space_obj.display_pos[0] + target_space_obj.display_size[0] / 2)
+                                center_y = float(target_space_obj.display_pos[1] + target_space_obj.display_size[1] / 2)
+                                npc.move_target = [center_x, center_y]
+                            else:
+                                npc.move_target = None
+                    else:
+                        space_it_just_entered_obj = all_spaces_dict.get(npc.current_path_segment_target_space_name)
+                        if space_it_just_entered_obj and hasattr(space_it_just_entered_obj, 'display_pos') and hasattr(space_it_just_entered_obj, 'display_size'):
+                            center_x = float(space_it_just_entered_obj.display_pos[0] + space_it_just_entered_obj.display_size[0] / 2)
+                            center_y = float(space_it_just_entered_obj.display_pos[1] + space_it_just_entered_obj.display_size[1] / 2)
+                            npc.move_target = [center_x, center_y]
+                        else:
+                            npc.current_path_segment_target_space_name = None
+                            if hasattr(npc, 'path_to_follow'): npc.path_to_follow = []
+                            npc.move_target = None
+                else:
+                    npc.current_path_segment_target_space_name = None
+                    if hasattr(npc, 'path_to_follow'): npc.path_to_follow = []
+                    npc.move_target = None
+            # --- A* Path Following Logic END ---
+            door_waiting_flags.append(waiting_for_door)
+
+            heading = None
+            if self.use_flow_fields and not waiting_for_door and npc.move_target and npc.current_space and \
+                getattr(npc, 'current_path_segment_target_space_name', None) and not getattr(npc, 'original_move_target', None):
+                flow_field = path_planner.get_flow_field(npc.current_space, tuple(npc.move_target[:2]))
+                if flow_field is not None:
+                    heading = flow_field.direction(tuple(npc.position[:2]))
+            flow_headings.append(heading)
+
+            # 正沿 A* 路徑前往相鄰空間且兩者之間有門：朝門外的目標前進時允許離開目前空間
+            exit_allowed_flags.append(bool(
+                getattr(npc, 'current_path_segment_target_space_name', None) and npc.current_space and
+                hasattr(npc.current_space, 'name') and
+                npc.current_path_segment_target_space_name != npc.current_space.name and
+                portal_graph is not None and
+                portal_graph.get_door(npc.current_space.name, npc.current_path_segment_target_space_name) is not None
+            ))
+
+        # 第二階段 (向量化)：一次算出所有 NPC 這一步的位移、是否抵達與撞牆結果
+        movement_system.load(stepped_npcs, exit_allowed=exit_allowed_flags, active=[not flag for flag in door_waiting_flags],
+                             headings=flow_headings)
+        movement_step = movement_system.step(dt)
+        step_arrived = movement_step.arrived.tolist()
+        step_move = movement_step.move.tolist()
+        step_candidate = movement_step.candidate.tolist()
+        step_can_move_x = movement_step.can_move_x.tolist()
+        step_can_move_y = movement_step.can_move_y.tolist()
+        step_speed = (movement_system.speed * dt).tolist()
+
+        # 第三階段 (逐一 NPC)：抵達、避障與空間更新等個別邏輯
+        for npc_index, npc in enumerate(stepped_npcs):
+            waiting_for_door = door_waiting_flags[npc_index]
+            if hasattr(npc, 'move_target') and npc.move_target and not waiting_for_door:
+                target_pos = [float(tp) for tp in npc.move_target] 
+
+                if not isinstance(npc.position, list) or not all(isinstance(p, (float, int)) for p in npc.position):
+                    #print(f"DEBUG: ERROR - NPC {npc.name} has invalid position: {npc.position}. Skipping move.")
+                    continue
+
+                current_move_speed = step_speed[npc_index]
+
+                # --- Target Reached Logic --- 
+                if step_arrived[npc_index]: # 距離小於移動速度 (向量化階段已判斷)
+                    npc.position[0] = target_pos[0]
+                    npc.position[1] = target_pos[1]
+                    #print(f"DEBUG: NPC {npc.name} REACHED {target_pos}. Current pos: {npc.position}")
+
+                    reached_original_target_after_avoidance = False
+                    if npc.avoiding_item_name and npc.original_move_target is None: # Was avoiding, and original_move_target was cleared (meaning it was set as current target)
+                        # Check if current target_pos (which was reached) matches the _last_original_target
+                        if hasattr(npc, '_last_original_target_x') and hasattr(npc, '_last_original_target_y') and \
+                            abs(target_pos[0] - npc._last_original_target_x) < 0.1 and \
+                            abs(target_pos[1] - npc._last_original_target_y) < 0.1:
+                            reached_original_target_after_avoidance = True
+
+                    if npc.avoiding_item_name and not reached_original_target_after_avoidance:
+                        #print(f"DEBUG: NPC {npc.name} reached AVOIDANCE waypoint for {npc.avoiding_item_name}. Original was {getattr(npc, 'original_move_target', 'None')}")
+                        if hasattr(npc, 'original_move_target') and npc.original_move_target:
+                            npc.move_target = list(npc.original_move_target) # Target original again
+                            # Store the original target to check against when it's reached
+                            npc._last_original_target_x = npc.original_move_target[0]
+                            npc._last_original_target_y = npc.original_move_target[1]
+                            npc.original_move_target = None # Clear it, as it's now the main target
+                            #print(f"DEBUG: NPC {npc.name} now targeting stored original: {npc.move_target}")
+                        else:
+                            # Reached an avoidance point, but no original target to go to. Clear avoidance.
+                            #print(f"DEBUG: NPC {npc.name} cleared avoidance for {npc.avoiding_item_name} (no original_move_target).")
+                            npc.avoiding_item_name = None
+                        npc.move_target = None
+                        if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
+                        if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
+                    
+                    elif reached_original_target_after_avoidance:
+                        #print(f"DEBUG: NPC {npc.name} successfully reached ORIGINAL target after avoiding {npc.avoiding_item_name}.")
+                        npc.avoiding_item_name = None
+                        npc.move_target = None
+                        if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
+                        if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
+                    
+                    else: # Reached a non-avoidance related target, or an original target directly
+                        if npc.move_target: # If it was a direct original target reach
+                            if hasattr(npc, '_last_original_target_x') and hasattr(npc, '_last_original_target_y') and \
+                                abs(target_pos[0] - npc._last_original_target_x) < 0.1 and \
+                                abs(target_pos[1] - npc._last_original_target_y) < 0.1:
+                                #print(f"DEBUG: NPC {npc.name} directly reached its original target.")
+                                if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
+                                if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
+                        
+                        npc.move_target = None 
+                        if npc.original_move_target: npc.original_move_target = None
+                        if npc.avoiding_item_name: npc.avoiding_item_name = None # Clear if any lingering state
+
+                    # A* path advancement and interaction completion (only if move_target is now None)
+                    if npc.move_target is None:
+                        is_on_astar_path_and_active = hasattr(npc, 'current_path_segment_target_space_name') and npc.current_path_segment_target_space_name is not None
+                        if is_on_astar_path_and_active:
+                            current_segment_target_space_obj = all_spaces_dict.get(npc.current_path_segment_target_space_name)
+                            if current_segment_target_space_obj and hasattr(current_segment_target_space_obj, 'display_pos') and hasattr(current_segment_target_space_obj, 'display_size'):
+                                center_x_of_current_segment = float(current_segment_target_space_obj.display_pos[0] + current_segment_target_space_obj.display_size[0] / 2)
+                                center_y_of_current_segment = float(current_segment_target_space_obj.display_pos[1] + current_segment_target_space_obj.display_size[1] / 2)
+                                if abs(npc.position[0] - center_x_of_current_segment) < 1.0 and abs(npc.position[1] - center_y_of_current_segment) < 1.0: # 稍微放寬判斷條件
+                                    print(f"DEBUG: NPC {npc.name} reached CENTER of A* segment: {npc.current_path_segment_target_space_name}")
+                                    if not npc.path_to_follow and npc.current_space is current_segment_target_space_obj:
+                                        npc.current_path_segment_target_space_name = None  # 抵達最終空間的中心，A* 路徑完成
+                                if hasattr(npc, 'path_to_follow') and npc.path_to_follow:
+                                    npc.current_path_segment_target_space_name = npc.path_to_follow.pop(0)
+                                    #print(f"DEBUG: NPC {npc.name} A* path advanced. New segment target: {npc.current_path_segment_target_space_name}. Remaining A* path: {npc.path_to_follow}")
+                            else:
+                                        #print(f"DEBUG: NPC {npc.name} A* path COMPLETED. Final segment was: {npc.current_path_segment_target_space_name}")
+                                        npc.current_path_segment_target_space_name = None # A* 路徑完成
+
+                        elif npc.current_space and npc.current_path_segment_target_space_name and npc.current_space.name == npc.current_path_segment_target_space_name:
+                                    # NPC 已經進入了 A* 路徑的當前目標空間 (current_path_segment_target_space_name)。
+                                    # 但可能還未到達該空間的中心點。
+                                    #print(f"DEBUG: NPC {npc.name} is IN A* segment target space: {npc.current_space.name} (which is {npc.current_path_segment_target_space_name}). Advancing A* if possible.")
+                                    if hasattr(npc, 'path_to_follow') and npc.path_to_follow:
+                                        # 如果 A* 路徑中還有下一個空間，則推進 A* 路徑。
+                                        npc.current_path_segment_target_space_name = npc.path_to_follow.pop(0)
+                                        #print(f"DEBUG: NPC {npc.name} A* path advanced WHILE IN SPACE. New segment target: {npc.current_path_segment_target_space_name}. Remaining A* path: {npc.path_to_follow}")
+                                    elif not npc.path_to_follow: # path_to_follow 為空，表示當前空間就是最終目標
+                                        #print(f"DEBUG: NPC {npc.name} A* path COMPLETED (already in final space {npc.current_space.name}, which was target {npc.current_path_segment_target_space_name}).")
+                                        npc.current_path_segment_target_space_name = None # A* 路徑完成
+                                    # npc.move_target is already None, the A* path following logic (around L1520) will pick up the new
+                                    # current_path_segment_target_space_name (if not None) and set a new precise move_target (door or center).
+
+                        elif npc.current_path_segment_target_space_name: 
+                                    # NPC 到達了某個點 (通常是門的微調點)，但其 current_space 記錄尚未更新為 A* 的目標空間。
+                                    # 主要依賴後續的 "Update NPC's actual current_space" (L1839) 邏輯來處理基於物理位置的空間變更。
+                                    # 這裡僅作日誌記錄，因為 move_target 為 None 會讓 A* path following logic (L1520) 重新評估。
+                                    current_space_name_for_debug = npc.current_space.name if npc.current_space else "None"
+                                    #print(f"DEBUG: NPC {npc.name} at {npc.position} reached move_target. Current space: {current_space_name_for_debug}, A* target space: {npc.current_path_segment_target_space_name}. Awaiting space update or next A* target recalc.")
+                                    # The "FORCE UPDATED current_space" logic previously here was removed as it could lead to premature A* advancement
+                                    # if the physical space update (around L1839) hadn't occurred yet.
+                                    # Relying on npc.move_target = None to re-trigger A* planning (L1520) with current state.
+
+                        # 抵達觸發器 (例如 interact_with_item 登記的互動) 只在抵達時觸發一次
+                        if triggers is not None:
+                            results.extend(triggers.arrived(npc))
+                else:
+                    # --- Normal Movement & Collision Detection (位移與撞牆已在向量化階段算好) --- 
+                    effective_move_x, effective_move_y = step_move[npc_index]
+                    next_pos_x_candidate, next_pos_y_candidate = step_candidate[npc_index]
+                    
+                    npc_world_radius = npc.radius 
+                    npc_next_rect_world = (
+                        next_pos_x_candidate - npc_world_radius,
+                        next_pos_y_candidate - npc_world_radius,
+                        next_pos_x_candidate + npc_world_radius,
+                        next_pos_y_candidate + npc_world_radius
+                    )
 
-        for neighbor_space_obj in current_space_obj.connected_spaces:
-            if not hasattr(neighbor_space_obj, 'name') or neighbor_space_obj.name not in world_spaces or \
-                neighbor_space_obj.name is None: # 確保 neighbor_space_obj.name 不是 None
-                continue 
+                    # --- Item Collision & Avoidance --- 
+                    collided_item_this_step = None
+                    current_space_obj_for_item_check = npc.current_space 
+                    if current_space_obj_for_item_check and hasattr(current_space_obj_for_item_check, 'items'):
+                        # 只檢查空間雜湊中與 NPC 下一步矩形重疊的物品 (雜湊中只有具備位置與大小的物品)
+                        nearby_items = path_planner.get_item_hash(current_space_obj_for_item_check).query(npc_next_rect_world)
+                        for item_obj in nearby_items:
+                            # Skip collision check if this item is the interaction target
+                            if hasattr(npc, 'waiting_interaction') and npc.waiting_interaction and npc.waiting_interaction.get("item_name") == item_obj.name:
+                                continue
+                            
+                            # Skip if already avoiding this item AND still moving towards an avoidance waypoint (original_move_target is set)
+                            if npc.avoiding_item_name == item_obj.name and npc.original_move_target is not None:
+                                continue
 
-            neighbor_name = neighbor_space_obj.name
-            neighbor_center = get_space_center(neighbor_space_obj)
+                            collided_item_this_step = item_obj
+                            break
+                            
+                    if collided_item_this_step:
+                        #print(f"DEBUG: NPC {npc.name} predicted collision with {collided_item_this_step.name}")
+                        if npc.avoiding_item_name != collided_item_this_step.name: # New collision or re-collision after trying original target
+                            if npc.move_target:
+                                npc.original_move_target = list(npc.move_target) # Store current main target
+                                npc._last_original_target_x = npc.original_move_target[0]
+                                npc._last_original_target_y = npc.original_move_target[1]
+                            npc.avoiding_item_name = collided_item_this_step.name
+
+                        item_center_x = collided_item_this_step.position[0] + collided_item_this_step.size[0] / 2
+                        item_center_y = collided_item_this_step.position[1] + collided_item_this_step.size[1] / 2
+                        vec_npc_to_item_x = item_center_x - npc.position[0]
+                        vec_npc_to_item_y = item_center_y - npc.position[1]
+
+                        # Try to find a clear perpendicular direction
+                        # This is a simplified avoidance, could be made more robust
+                        perp_x_option1 = -vec_npc_to_item_y
+                        perp_y_option1 = vec_npc_to_item_x
+                        perp_x_option2 = vec_npc_to_item_y
+                        perp_y_option2 = -vec_npc_to_item_x
+
+                        avoid_dist_factor = npc_world_radius + max(collided_item_this_step.size[0], collided_item_this_step.size[1]) / 2 + 20.0 # Increased buffer
+                        
+                        # Normalize and scale perpendicular vectors
+                        len_perp1 = math.hypot(perp_x_option1, perp_y_option1)
+                        if len_perp1 > 1e-6 : 
+                            avoid_target1_x = npc.position[0] + (perp_x_option1 / len_perp1) * avoid_dist_factor
+                            avoid_target1_y = npc.position[1] + (perp_y_option1 / len_perp1) * avoid_dist_factor
+                        else: # Should not happen if vec_npc_to_item is non-zero
+                            avoid_target1_x, avoid_target1_y = npc.position[0], npc.position[1]
+
+                        len_perp2 = math.hypot(perp_x_option2, perp_y_option2)
+                        if len_perp2 > 1e-6:
+                            avoid_target2_x = npc.position[0] + (perp_x_option2 / len_perp2) * avoid_dist_factor
+                            avoid_target2_y = npc.position[1] + (perp_y_option2 / len_perp2) * avoid_dist_factor
+                        else:
+                            avoid_target2_x, avoid_target2_y = npc.position[0], npc.position[1]
+                        
+                        # Simplistic choice: alternate or pick one. A better way would be to check if these points are clear.
+                        # For now, let's try the one further from the item center, or alternate.
+                        if not hasattr(npc, '_last_avoid_choice') or npc._last_avoid_choice == 1:
+                            npc.move_target = [avoid_target1_x, avoid_target1_y]
+                            npc._last_avoid_choice = 2
+                        else: 
+                            npc.move_target = [avoid_target2_x, avoid_target2_y]
+                            npc._last_avoid_choice = 1
+
+                        #print(f"DEBUG: NPC {npc.name} NEW AVOIDANCE TARGET: {npc.move_target} for {npc.avoiding_item_name}")
+                        
+                        # Recalculate movement based on new avoidance target for this frame
+                        dx = npc.move_target[0] - npc.position[0]
+                        dy = npc.move_target[1] - npc.position[1]
+                        dist = math.hypot(dx, dy)
+                        if dist > 1e-6:
+                            effective_move_x = current_move_speed * dx / dist
+                            effective_move_y = current_move_speed * dy / dist
+                        else:
+                            effective_move_x = 0
+                            effective_move_y = 0
+                            next_pos_x_candidate = npc.position[0] + effective_move_x
+                            next_pos_y_candidate = npc.position[1] + effective_move_y
+                    # --- Item Collision END ---
+
+                    # --- Wall Collision (uses the potentially updated next_pos_x/y_candidate) --- 
+                    if collided_item_this_step:
+                        # 避障改變了這一步的位移，只針對這個 NPC 重新判斷撞牆
+                        can_move_x, can_move_y = wall_permissions_for(
+                            npc.position, [next_pos_x_candidate, next_pos_y_candidate], [effective_move_x, effective_move_y],
+                            npc_world_radius, npc.current_space, exit_allowed_flags[npc_index], npc.move_target
+                        )
+                    else:
+                        can_move_x = step_can_move_x[npc_index]
+                        can_move_y = step_can_move_y[npc_index]
+                    # --- Wall Collision END ---
+                    
+                    # --- Final Movement Update --- 
+                    if can_move_x:
+                        npc.position[0] = next_pos_x_candidate
+                    #else:
+                        #print(f"DEBUG: NPC {npc.name} X-move blocked by wall. Target was {npc.move_target}")
+
+                    if can_move_y:
+                        npc.position[1] = next_pos_y_candidate
+                    #else:
+                        #print(f"DEBUG: NPC {npc.name} Y-move blocked by wall. Target was {npc.move_target}")
+                    
+                    #if not can_move_x and not can_move_y and collided_item_this_step:
+                        #print(f"DEBUG: NPC {npc.name} FULLY STUCK by {collided_item_this_step.name} and/or walls. Pos: {npc.position}")
+                        # Consider clearing avoidance if fully stuck to allow AI to replan
+                        # npc.avoiding_item_name = None
+                        # npc.original_move_target = None
+                        # npc.move_target = None
             
-            # 確保 g_score[current_name] 不是 inf，如果是，則跳過 (表示 current_name 從未被正確處理)
-            if g_score.get(current_name, float('inf')) == float('inf'):
-                # print(f"A* Debug: Skipping neighbor {neighbor_name} of {current_name} because g_score of current is inf.") # Debugging
+            # Update display_pos and NPC's current actual space (largely unchanged)
+            if npc.position is not None:
+                npc.display_pos = [int(p) for p in npc.position]
+
+            # --- Update NPC's actual current_space based on position (Your lines 1520-1590) ---
+            if npc.position is not None:
+                npc_rect_world_for_space_update = (
+                    npc.position[0] - getattr(npc, 'radius', 10),
+                    npc.position[1] - getattr(npc, 'radius', 10),
+                    npc.position[0] + getattr(npc, 'radius', 10),
+                    npc.position[1] + getattr(npc, 'radius', 10)
+                )
+                npc_center_point_for_space_update = (npc.position[0], npc.position[1])
+                current_space_name_before_update = getattr(npc.current_space, 'name', None) if hasattr(npc, 'current_space') else None
+                
+                found_new_space_for_npc = False
+                # Check current space first for optimization
+                if hasattr(npc, 'current_space') and npc.current_space and \
+                    hasattr(npc.current_space, 'display_pos') and hasattr(npc.current_space, 'display_size'):
+                    space_x, space_y = npc.current_space.display_pos
+                    space_w, space_h = npc.current_space.display_size
+                    if space_x <= npc_center_point_for_space_update[0] < space_x + space_w and \
+                        space_y <= npc_center_point_for_space_update[1] < space_y + space_h:
+                        found_new_space_for_npc = True # Still in the same space
+                    
+                if not found_new_space_for_npc:
+                    # 以空間索引查詢 (原本逐一掃描 all_spaces_dict，且 break 位置錯誤只檢查了第一個空間)
+                    space_obj_iter = space_index.space_at(npc_center_point_for_space_update) if space_index else None
+                    if space_obj_iter is not None:
+                        space_name_iter = space_obj_iter.name
+                        if current_space_name_before_update != space_name_iter:
+                            if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'npcs') and npc in npc.current_space.npcs:
+                                npc.current_space.npcs.remove(npc)
+                            npc.current_space = space_obj_iter
+                            if npc not in space_obj_iter.npcs: space_obj_iter.npcs.append(npc)
+                            #print(f"DEBUG: NPC {npc.name} SPACE UPDATE (pos) - from {current_space_name_before_update} to {space_name_iter}")
+                        found_new_space_for_npc = True
+                
+                if not found_new_space_for_npc and npc.current_path_segment_target_space_name:
+                    # 特殊處理：在門的位置且正在走 A* 路徑
+                    for door in calculated_doors:
+                        door_rect_for_space_update = None
+                        # 計算門區域
+                        if door["type"] == "vertical":
+                            # 垂直門 (在左右邊牆上)
+                            padding = 10.0  # 增加一些寬度讓門區域更容易被偵測到
+                            door_rect_for_space_update = (
+                                door["wall_x_world"] - padding,
+                                door["opening_start_world"],
+                                door["wall_x_world"] + padding,  # 2倍 padding 作為寬度
+                                door["opening_end_world"]
+                            )
+                        elif door["type"] == "horizontal":
+                            # 水平門 (在上下邊牆上)
+                            padding = 10.0
+                            door_rect_for_space_update = (
+                                door["opening_start_world"],
+                                door["wall_y_world"] - padding,
+                                door["opening_end_world"],
+                                door["wall_y_world"] + padding
+                            )
+                        
+                        # 檢查 NPC 是否在門區域，並且門連接到 NPC 正在前往的目標空間
+                        if door_rect_for_space_update and rects_overlap(door_rect_for_space_update, npc_rect_world_for_space_update) and \
+                            npc.current_path_segment_target_space_name in [door.get('s1_name'), door.get('s2_name')]:
+                            target_space_obj_on_door = all_spaces_dict.get(npc.current_path_segment_target_space_name)
+                            if target_space_obj_on_door and npc.current_space != target_space_obj_on_door:
+                                # 更新 NPC 的當前空間
+                                if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'npcs'):
+                                    if npc in npc.current_space.npcs:
+                                        npc.current_space.npcs.remove(npc)
+                                npc.current_space = target_space_obj_on_door
+                                if hasattr(target_space_obj_on_door, 'npcs') and npc not in target_space_obj_on_door.npcs:
+                                    target_space_obj_on_door.npcs.append(npc)
+                                #print(f"DEBUG: NPC {npc.name} SPACE UPDATE (door) - from {current_space_name_before_update} to {target_space_obj_on_door.name}")
+                                found_new_space_for_npc = True
+                                break
+            # --- End NPC Current Space Update ---
+
+        for npc, (space_before, position_before) in zip(stepped_npcs, before_step):
+            space_changed = npc.current_space is not space_before
+            if not space_changed and (tuple(npc.position) if npc.position else None) == position_before:
                 continue
-            
-            cost_to_neighbor = heuristic(current_center, neighbor_center)
-            if cost_to_neighbor <= 0: cost_to_neighbor = 1.0
-
-            tentative_g_score = g_score.get(current_name, float('inf')) + cost_to_neighbor
+            if perception is not None:
+                if space_changed:
+                    perception.touch(space_before.name if space_before else None)
+                perception.touch(npc.current_space.name if npc.current_space else None)
+            if journal is not None and space_changed:
+                journal.record("npc_space_changed", ("npc", npc.name),
+                               *(("space", space.name) for space in (space_before, npc.current_space) if space is not None))
+            if triggers is not None:
+                results.extend(triggers.moved(npc))
+            if ecs is not None:
+                ecs.sync_npc(npc)
+        return results
+
+
+def get_movement_engine(world: Dict[str, Any], path_planner: Optional[PathPlanner] = None) -> Optional[MovementEngine]:
+    """取得世界的移動引擎，不存在時建立並存回 world (path_planner 只在建立時使用)。"""
+    if not world or not world.get("spaces"):
+        return None
+    engine = world.get("movement_engine")
+    if engine is None:
+        engine = MovementEngine(world, path_planner)
+        world["movement_engine"] = engine
+    return engine
+
+def get_perception(world: Dict[str, Any]) -> Optional[Perception]:
+    """取得世界的感知查詢 (快取各 NPC 看得到/聽得到的東西)，不存在時建立並存回 world。"""
+    if not world or not world.get("spaces"):
+        return None
+    perception = world.get("perception")
+    if perception is None:
+        perception = Perception()
+        world["perception"] = perception
+    return perception
+
+def get_names(world: Dict[str, Any]) -> Optional[NameTable]:
+    """取得世界的名稱表 (build_world_from_data 建立)；沒有時回傳 None，呼叫端改用名稱比較。"""
+    if not world:
+        return None
+    return world.get("names")
 
-            if tentative_g_score < g_score.get(neighbor_name, float('inf')):
-                came_from[neighbor_name] = current_name
-                g_score[neighbor_name] = tentative_g_score
-                f_score[neighbor_name] = tentative_g_score + heuristic(neighbor_center, get_space_center(goal_space))
-                heapq.heappush(open_set, (f_score[neighbor_name], neighbor_name))
-    
-    # print(f"A* 警告: 從 {start_space_name} 到 {goal_space_name} 找不到路徑。") # Debugging
-    return None
+def get_entity_store(world: Dict[str, Any]) -> Optional[EntityStore]:
+    """
+    取得世界的 ECS 欄式儲存，不存在時依目前的世界建立並存回 world。
+    只有需要走訪密集陣列的系統才呼叫；建立之後移動引擎與 AI_System 才會在變動時同步。
+    """
+    if not world or not world.get("spaces"):
+        return None
+    store = world.get("ecs")
+    if store is None:
+        store = populate_from_world(world["spaces"].values(), world.get("npcs", {}).values())
+        world["ecs"] = store
+    # AI_System 保存的是世界字典的淺複製，同一個世界時也要讓它看到儲存，物品的增減才會同步
+    if world_system is not None and world_system.world is not world and \
+            world_system.world.get("spaces") is world["spaces"]:
+        world_system.world["ecs"] = store
+    return store
+
+def get_triggers(world: Dict[str, Any]) -> Optional[TriggerSystem]:
+    """取得世界的接近與抵達觸發器，不存在時建立並存回 world。"""
+    if not world or not world.get("spaces"):
+        return None
+    triggers = world.get("triggers")
+    if triggers is None:
+        triggers = TriggerSystem()
+        world["triggers"] = triggers
+    return triggers
 
 class NPC(BaseModel):
     name: str
@@ -474,6 +1286,7 @@ class NPC(BaseModel):
     image_path: Optional[str] = None  # 新增：NPC 圖片路徑
     image_scale: float = 1.0  # 新增：NPC 圖片縮放比例
     direction: str = ""  # 新增：NPC 初始朝向
+    uid: int = NO_ID  # 載入時由 NameTable 指定的整數 id
 
     # ForwardRef必須在模型定義之後更新
     # Space.model_rebuild() # 這行通常在所有模型定義後執行
@@ -503,7 +1316,8 @@ class NPC(BaseModel):
                     self.current_space,  # 當前僅支持在同一空間內規劃
                     start_pos, 
                     target_pos, 
-                    all_spaces
+                    all_spaces,
+                    portal_graph=get_portal_graph(world_system.world)
                 )
 
     @classmethod
@@ -532,15 +1346,43 @@ class NPC(BaseModel):
             "NPC.TalkToNPCAction"
         ]] = None
 
-    def update_schema(self):
+    def perceive(self) -> Optional[Percept]:
+        """目前看得到與聽得到的 NPC、物品 (由世界的 Perception 快取)；沒有世界或位置時回傳 None。"""
+        if not world_system or not world_system.world or not self.position:
+            return None
+        perception = get_perception(world_system.world)
+        if perception is None:
+            return None
+        item_index = self.path_planner.get_item_hash if self.path_planner else None
+        return perception.perceive(self, get_portal_graph(world_system.world), world_system.world["spaces"], item_index)
+
+    def update_schema(self, snapshot: Optional[WorldSnapshot] = None):
         """
         根據 NPC 當前狀態動態生成模式結構。
+        有快照時只讀取快照 (思考執行緒使用)，否則讀取目前的世界。
         返回適當的 GeneralResponse 模型。
         """
-        # 獲取當前狀態的有效選項
-        valid_spaces = [space.name for space in self.current_space.connected_spaces]
-        valid_npcs = [npc.name for npc in self.current_space.npcs if npc.name != self.name]
-        available_items = [item.name for item in self.current_space.items + self.inventory.items]
+        # 獲取當前狀態的有效選項 (有感知資料時只列出聽得到的 NPC 與看得到的物品)
+        if snapshot is not None:
+            view = snapshot.npcs[self.name]
+            space_view = snapshot.spaces.get(view.space)
+            valid_spaces = list(space_view.connected) if space_view else []
+            inventory_names = [item.name for item in view.inventory]
+            if view.percept is not None:
+                valid_npcs = list(view.percept.audible_npcs)
+                available_items = list(view.percept.visible_items) + inventory_names
+            else:
+                valid_npcs = [name for name in (space_view.npcs if space_view else ()) if name != self.name]
+                available_items = [item.name for item in (space_view.items if space_view else ())] + inventory_names
+        else:
+            valid_spaces = [space.name for space in self.current_space.connected_spaces]
+            percept = self.perceive()
+            if percept is not None:
+                valid_npcs = [npc.name for npc in percept.audible_npcs]
+                available_items = [item.name for item in percept.visible_items + self.inventory.items]
+            else:
+                valid_npcs = [npc.name for npc in self.current_space.npcs if npc.name != self.name]
+                available_items = [item.name for item in self.current_space.items + self.inventory.items]
 
         # 定義空間移動操作
         class EnterSpaceAction(BaseModel):
@@ -558,6 +1400,13 @@ class NPC(BaseModel):
             action_type: Literal["interact_item"]
             interact_with: Literal[*available_items] if available_items else str = Field(description="要互動的物品名稱")
             how_to_interact: str = Field(description="詳細描述如何與物品互動。請使用描述性語言，清楚說明你想要如何使用或操作這個物品。")
+            effect: Optional[Union[
+                AI_System.CreateItemFunction,
+                AI_System.DeleteItemFunction,
+                AI_System.ChangeItemDescriptionFunction,
+                AI_System.DeleteAndCreateNewItemFunction,
+                AI_System.MoveItemToInventoryFunction
+            ]] = Field(None, description="互動完成時對世界造成的改變 (例如撿起物品放進自己的庫存、吃掉食物)；沒有改變時留空")
 
         # 頂層響應
         class GeneralResponse(BaseModel):
@@ -576,6 +1425,22 @@ class NPC(BaseModel):
         """
         self.history.append({"role": "system", "content": str(self.current_space)})
 
+    def persona_text(self) -> str:
+        """prompt 開頭的自我介紹 (描述或家改變時才重新產生)。"""
+        render = lambda: f"你是 NPC {self.name} ({self.description}). "
+        if Space.fragments is None:
+            return render()
+        return Space.fragments.get(("npc_persona", self.name), (self.description, self.home_space_name), render)
+
+    def inventory_text(self) -> str:
+        """庫存物品的列表文字 (有物品進出或物品改變時才重新產生)。"""
+        if Space.fragments is None or Space.journal is None:
+            return self.inventory.list_items()
+        journal = Space.journal
+        version = (journal.version_of(("npc", self.name)), len(self.inventory.items),
+                   tuple(journal.version_of(("item", item.name)) for item in self.inventory.items))
+        return Space.fragments.get(("npc_inventory", self.name), version, self.inventory.list_items)
+
     def print_current_schema(self):
         """
         打印 AI 使用的實際模式結構
@@ -599,7 +1464,7 @@ class NPC(BaseModel):
             print(json.dumps(schema, indent=2))
             print("=== InteractItemAction Schema END ===\n")
 
-            valid_npcs = [npc for npc in self.current_space.npcs if npc != self]
+            valid_npcs = [npc for npc in self.current_space.npcs if npc is not self]
             if valid_npcs:
                 print("=== TalkToNPCAction Schema ===")
                 schema = self.TalkToNPCAction.model_json_schema()
@@ -610,15 +1475,13 @@ class NPC(BaseModel):
             # 打印額外的調試信息
             print(f"Current space: {self.current_space.name}")
             print(f"Available items: {[item.name for item in self.current_space.items + self.inventory.items]}")
-            print(f"Available NPCs: {[npc.name for npc in self.current_space.npcs if npc != self]}")
+            print(f"Available NPCs: {[npc.name for npc in self.current_space.npcs if npc is not self]}")
 
     def move_to_space(self, target_space_name: str) -> str:
         """
         使用 A* 演算法規劃路徑並開始移動到目標空間。
         更新 NPC 的 path_to_follow 和 current_path_segment_target_space_name。
         """
-        target_space_name_lower = target_space_name.lower()
-
         if not hasattr(self, 'current_space') or not self.current_space or \
            not hasattr(self.current_space, 'name') or not self.current_space.name:
             self.path_to_follow = []
@@ -626,15 +1489,21 @@ class NPC(BaseModel):
                 self.current_path_segment_target_space_name = None
             return f"錯誤: NPC {self.name} 沒有有效的 current_space 或 current_space.name，無法規劃路徑。"
 
-        current_space_name_lower = self.current_space.name.lower()
+        global world_system
+        # 有名稱表時把目標名稱 (忽略大小寫) 解析成 id，之後只比較整數
+        names = get_names(world_system.world) if world_system is not None else None
+        target_uid = names.resolve("space", target_space_name) if names is not None else None
+        if target_uid is not None and self.current_space.uid != NO_ID:
+            already_there = target_uid == self.current_space.uid
+        else:
+            already_there = self.current_space.name.lower() == target_space_name.lower()
 
-        if current_space_name_lower == target_space_name_lower:
+        if already_there:
             self.path_to_follow = []
             if hasattr(self, 'current_path_segment_target_space_name'):
                 self.current_path_segment_target_space_name = None
             return f"{self.name} 已經在 {target_space_name}。"
 
-        global world_system
         if world_system is None or not hasattr(world_system, 'world') or 'spaces' not in world_system.world:
             self.path_to_follow = []
             if hasattr(self, 'current_path_segment_target_space_name'):
@@ -650,21 +1519,47 @@ class NPC(BaseModel):
 
         # 先用精確的目標空間名稱搜索
         exact_target_space_name = None
-        for space_name in all_world_spaces.keys():
-            if space_name.lower() == target_space_name_lower:
-                exact_target_space_name = space_name
-                break
+        if target_uid is not None:
+            exact_target_space_name = names.name_of(target_uid)
+        else:
+            for space_name in all_world_spaces.keys():
+                if space_name.lower() == target_space_name.lower():
+                    exact_target_space_name = space_name
+                    break
                 
         # 如果找不到精確匹配，使用原始參數
         final_target_name = exact_target_space_name if exact_target_space_name else target_space_name
 
+        start_pos = tuple(self.position[:2]) if self.position and len(self.position) >= 2 else None
+
+        # 批次規劃中 (例如一批 NPC 同時思考)：先登記查詢，由 AI_System.flush_path_batch 統一計算並套用
+        if final_target_name in all_world_spaces and hasattr(world_system, 'queue_path_query') and \
+           world_system.queue_path_query(RouteQuery(key=self, start_space=self.current_space.name,
+                                                    goal_space=final_target_name, start_pos=start_pos)):
+            self.thinking_status = f"正在規劃前往 {final_target_name} 的路徑"
+            return f"前往 {final_target_name}。"
+
         print(f"DEBUG: move_to_space - 從 {self.current_space.name} 尋找路徑前往 {final_target_name}")
+        speed, hold = self.door_timing()
         path = find_path_astar(
             all_world_spaces,
             self.current_space.name, 
-            final_target_name
+            final_target_name,
+            portal_graph=get_portal_graph(world_system.world),
+            start_pos=start_pos,
+            reservations=get_door_reservations(world_system.world),
+            owner=self.name,
+            speed=speed,
+            hold=hold
         )
+        return self._follow_space_path(path, final_target_name)
 
+    def _follow_space_path(self, path: Optional[List[str]], final_target_name: str) -> str:
+        """
+        依 A* 找到的空間序列設定 path_to_follow、第一個目標段落與到門口的路徑點。
+        由 move_to_space 直接呼叫，或在批次規劃完成後由 AI_System.flush_path_batch 呼叫。
+        """
+        all_world_spaces = world_system.world.get('spaces', {})
         if path and len(path) > 1:
             self.path_to_follow = path[1:]  # 排除當前空間
             
@@ -706,184 +1601,139 @@ class NPC(BaseModel):
                 self.current_path_segment_target_space_name = None
             return f"找不到從 {self.current_space.name} 到 {final_target_name} 的 A* 路徑。"
             
+    def door_timing(self) -> Tuple[float, float]:
+        """回傳 (每步移動距離, 通過一扇門需要佔用的步數)，供門的協同預約使用。"""
+        speed = self.move_speed if self.move_speed and self.move_speed > 0 else 1.0
+        radius = self.radius if self.radius is not None else 15
+        return speed, 2 * radius / speed
+
     def _find_connection_point(self, current_space: "Space", next_space: "Space") -> Optional[Tuple[float, float]]:
-        """找到兩個空間之間的連接點（門口位置）"""
-        # 這裡假設空間是矩形，並檢查它們是否有重疊
-        if not hasattr(current_space, 'display_pos') or not hasattr(current_space, 'display_size') or \
-           not hasattr(next_space, 'display_pos') or not hasattr(next_space, 'display_size'):
+        """找到兩個空間之間的連接點（門口位置），由門戶圖提供。"""
+        if not hasattr(current_space, 'name') or not hasattr(next_space, 'name'):
             return None
-            
-        # 獲取空間矩形
-        cs_x, cs_y = current_space.display_pos
-        cs_w, cs_h = current_space.display_size
-        ns_x, ns_y = next_space.display_pos
-        ns_w, ns_h = next_space.display_size
-        
-        # 檢查空間是否有重疊區域
-        overlap_x1 = max(cs_x, ns_x)
-        overlap_y1 = max(cs_y, ns_y)
-        overlap_x2 = min(cs_x + cs_w, ns_x + ns_w)
-        overlap_y2 = min(cs_y + cs_h, ns_y + ns_h)
-        
-        # 如果有重疊
-        if overlap_x2 > overlap_x1 and overlap_y2 > overlap_y1:
-            # 返回重疊區域中心
-            connection_x = (overlap_x1 + overlap_x2) / 2
-            connection_y = (overlap_y1 + overlap_y2) / 2
-            return (connection_x, connection_y)
-            
-        # 如果沒有重疊，檢查它們是否為相鄰空間（假設相差在30像素內可視為相鄰）
-        tolerance = 30.0
-        
-        # 檢查左/右相鄰
-        if abs(cs_x + cs_w - ns_x) < tolerance or abs(ns_x + ns_w - cs_x) < tolerance:
-            # 計算垂直方向上的重疊
-            vertical_overlap_y1 = max(cs_y, ns_y)
-            vertical_overlap_y2 = min(cs_y + cs_h, ns_y + ns_h)
-            
-            if vertical_overlap_y2 > vertical_overlap_y1:
-                # 在垂直中點和水平相接處創建連接點
-                middle_y = (vertical_overlap_y1 + vertical_overlap_y2) / 2
-                
-                if abs(cs_x + cs_w - ns_x) < tolerance:
-                    # 當前空間在左側，下一個空間在右側
-                    connection_x = (cs_x + cs_w + ns_x) / 2
-                else:
-                    # 當前空間在右側，下一個空間在左側
-                    connection_x = (ns_x + ns_w + cs_x) / 2
-                    
-                return (connection_x, middle_y)
-        
-        # 檢查上/下相鄰
-        if abs(cs_y + cs_h - ns_y) < tolerance or abs(ns_y + ns_h - cs_y) < tolerance:
-            # 計算水平方向上的重疊
-            horizontal_overlap_x1 = max(cs_x, ns_x)
-            horizontal_overlap_x2 = min(cs_x + cs_w, ns_x + ns_w)
-            
-            if horizontal_overlap_x2 > horizontal_overlap_x1:
-                # 在水平中點和垂直相接處創建連接點
-                middle_x = (horizontal_overlap_x1 + horizontal_overlap_x2) / 2
-                
-                if abs(cs_y + cs_h - ns_y) < tolerance:
-                    # 當前空間在上方，下一個空間在下方
-                    connection_y = (cs_y + cs_h + ns_y) / 2
-                else:
-                    # 當前空間在下方，下一個空間在上方
-                    connection_y = (ns_y + ns_h + cs_y) / 2
-                    
-                return (middle_x, connection_y)
-        
-        # 如果以上都不符合，返回兩個空間中心點的中點作為連接點
-        center_cs_x = cs_x + cs_w / 2
-        center_cs_y = cs_y + cs_h / 2
-        center_ns_x = ns_x + ns_w / 2
-        center_ns_y = ns_y + ns_h / 2
-        
-        return ((center_cs_x + center_ns_x) / 2, (center_cs_y + center_ns_y) / 2)
+        global world_system
+        world = world_system.world if world_system is not None and world_system.world else {}
+        if not world.get("spaces"):
+            # 沒有世界資料時，只以這兩個空間建立臨時門戶圖
+            world = {"spaces": {current_space.name: current_space, next_space.name: next_space}}
+        portal_graph = get_portal_graph(world)
+        if portal_graph is None:
+            return None
+        return portal_graph.connection_point(current_space.name, next_space.name)
 
     def move_to_item(self, item_name: str) -> str:
         """
         將 NPC 移動到指定物品的位置。
         修改：嚴格限制在當前空間查找物品，並計算停在物品邊緣。
         """
-        # 在當前空間中查找物品
-        for item in self.current_space.items:
-            if item.name.lower() == item_name.lower():
-                # --- 開始：計算停在物品邊緣的邏輯 ---
-                if hasattr(item, "position") and item.position and \
-                    hasattr(item, "size") and item.size and \
-                    hasattr(self, "radius") and self.radius is not None and \
-                    hasattr(self, "position") and self.position is not None and \
-                    all(isinstance(p, (float, int)) for p in self.position) and \
-                    all(isinstance(p, (float, int)) for p in item.position) and \
-                    all(isinstance(s, (float, int)) for s in item.size):
-
-                    # 確保 item.position 和 item.size 是有效的數值列表
-                    item_pos_x, item_pos_y = float(item.position[0]), float(item.position[1])
-                    item_size_w, item_size_h = float(item.size[0]), float(item.size[1])
-                    npc_pos_x, npc_pos_y = float(self.position[0]), float(self.position[1])
-                    npc_rad = float(self.radius)
+        # 在當前空間中查找物品 (名稱索引，忽略大小寫)
+        item = self.current_space.items.find(item_name)
+        if item is not None:
+            # --- 開始：計算停在物品邊緣的邏輯 ---
+            if hasattr(item, "position") and item.position and \
+                hasattr(item, "size") and item.size and \
+                hasattr(self, "radius") and self.radius is not None and \
+                hasattr(self, "position") and self.position is not None and \
+                all(isinstance(p, (float, int)) for p in self.position) and \
+                all(isinstance(p, (float, int)) for p in item.position) and \
+                all(isinstance(s, (float, int)) for s in item.size):
+
+                # 確保 item.position 和 item.size 是有效的數值列表
+                item_pos_x, item_pos_y = float(item.position[0]), float(item.position[1])
+                item_size_w, item_size_h = float(item.size[0]), float(item.size[1])
+                npc_pos_x, npc_pos_y = float(self.position[0]), float(self.position[1])
+                npc_rad = float(self.radius)
                     
-                    # 假設 item.position 是左上角
-                    item_center_x = item_pos_x + item_size_w / 2
-                    item_center_y = item_pos_y + item_size_h / 2
+                # 假設 item.position 是左上角
+                item_center_x = item_pos_x + item_size_w / 2
+                item_center_y = item_pos_y + item_size_h / 2
 
-                    vec_x = item_center_x - npc_pos_x
-                    vec_y = item_center_y - npc_pos_y
-                    dist_to_item_center = math.hypot(vec_x, vec_y)
+                vec_x = item_center_x - npc_pos_x
+                vec_y = item_center_y - npc_pos_y
+                dist_to_item_center = math.hypot(vec_x, vec_y)
 
-                    item_effective_radius = max(item_size_w, item_size_h) / 2
+                item_effective_radius = max(item_size_w, item_size_h) / 2
                     
-                    stopping_distance_from_center = npc_rad + item_effective_radius + 5.0 # 5.0 是小間隙
-
-                    # 最小互動距離，防止 NPC 距離太遠就停下 (例如，比目標停止點遠2步)
-                    move_speed_val = self.move_speed if self.move_speed is not None and self.move_speed > 0 else 1.0
-                    min_interaction_engage_distance = stopping_distance_from_center + (move_speed_val * 2.0)
-
-                    if dist_to_item_center <= stopping_distance_from_center: 
-                        self.move_target = list(self.position) 
-                        self.original_move_target = None 
-                        self.avoiding_item_name = None   
-                        return f"已經在 {item.name} 旁邊，準備互動。"
-                    elif dist_to_item_center <= min_interaction_engage_distance : 
-                        norm_vec_x = vec_x / dist_to_item_center if dist_to_item_center > 1e-6 else 0 # 避免除以零
-                        norm_vec_y = vec_y / dist_to_item_center if dist_to_item_center > 1e-6 else 0
+                stopping_distance_from_center = npc_rad + item_effective_radius + 5.0 # 5.0 是小間隙
+
+                # 最小互動距離，防止 NPC 距離太遠就停下 (例如，比目標停止點遠2步)
+                move_speed_val = self.move_speed if self.move_speed is not None and self.move_speed > 0 else 1.0
+                min_interaction_engage_distance = stopping_distance_from_center + (move_speed_val * 2.0)
+
+                if dist_to_item_center <= stopping_distance_from_center: 
+                    self.move_target = list(self.position) 
+                    self.original_move_target = None 
+                    self.avoiding_item_name = None   
+                    return f"已經在 {item.name} 旁邊，準備互動。"
+                elif dist_to_item_center <= min_interaction_engage_distance : 
+                    norm_vec_x = vec_x / dist_to_item_center if dist_to_item_center > 1e-6 else 0 # 避免除以零
+                    norm_vec_y = vec_y / dist_to_item_center if dist_to_item_center > 1e-6 else 0
                         
-                        target_x = item_center_x - norm_vec_x * stopping_distance_from_center
-                        target_y = item_center_y - norm_vec_y * stopping_distance_from_center
+                    target_x = item_center_x - norm_vec_x * stopping_distance_from_center
+                    target_y = item_center_y - norm_vec_y * stopping_distance_from_center
                         
-                        self.move_target = [target_x, target_y]
-                        if not self.original_move_target : self.original_move_target = list(self.move_target) 
+                    self.move_target = [target_x, target_y]
+                    if not self.original_move_target : self.original_move_target = list(self.move_target) 
                         
-                        # 新增：使用路徑規劃器規劃路徑
-                        self.plan_path_to_target()
+                    # 新增：使用路徑規劃器規劃路徑
+                    self.plan_path_to_target()
                         
-                        return f"靠近 {item.name} 的邊緣準備互動。"
-                    else: 
-                        norm_vec_x = vec_x / dist_to_item_center if dist_to_item_center > 1e-6 else 0
-                        norm_vec_y = vec_y / dist_to_item_center if dist_to_item_center > 1e-6 else 0
+                    return f"靠近 {item.name} 的邊緣準備互動。"
+                else: 
+                    norm_vec_x = vec_x / dist_to_item_center if dist_to_item_center > 1e-6 else 0
+                    norm_vec_y = vec_y / dist_to_item_center if dist_to_item_center > 1e-6 else 0
                         
-                        target_x = item_center_x - norm_vec_x * stopping_distance_from_center
-                        target_y = item_center_y - norm_vec_y * stopping_distance_from_center
+                    target_x = item_center_x - norm_vec_x * stopping_distance_from_center
+                    target_y = item_center_y - norm_vec_y * stopping_distance_from_center
                         
-                        self.move_target = [target_x, target_y]
-                        if not self.original_move_target : self.original_move_target = list(self.move_target)
+                    self.move_target = [target_x, target_y]
+                    if not self.original_move_target : self.original_move_target = list(self.move_target)
                         
-                        # 新增：使用路徑規劃器規劃路徑
-                        self.plan_path_to_target()
+                    # 新增：使用路徑規劃器規劃路徑
+                    self.plan_path_to_target()
                         
-                        return f"移動到 {item.name} 的邊緣進行互動。"
-                # --- 結束：計算停在物品邊緣的邏輯 ---
-                else:
-                    # This block executes if the detailed edge calculation cannot be performed
-                    if hasattr(item, "position") and item.position:
-                        self.move_target = [float(p) for p in item.position]
+                    return f"移動到 {item.name} 的邊緣進行互動。"
+            # --- 結束：計算停在物品邊緣的邏輯 ---
+            else:
+                # This block executes if the detailed edge calculation cannot be performed
+                if hasattr(item, "position") and item.position:
+                    self.move_target = [float(p) for p in item.position]
                         
-                        # 新增：使用路徑規劃器規劃路徑
-                        self.plan_path_to_target()
+                    # 新增：使用路徑規劃器規劃路徑
+                    self.plan_path_to_target()
                         
-                        return f"移動到{item.name}的位置 (詳細邊緣計算所需資訊不足)"
-                    else: # Item does not have a direct position, or the earlier check failed.
-                        # Fallback: try to use current_space center
-                        if hasattr(self.current_space, 'display_pos') and self.current_space.display_pos and \
-                           hasattr(self.current_space, 'display_size') and self.current_space.display_size and \
-                           len(self.current_space.display_pos) == 2 and len(self.current_space.display_size) == 2:
-                            space_center_x = self.current_space.display_pos[0] + self.current_space.display_size[0] // 3
-                            space_center_y = self.current_space.display_pos[1] + self.current_space.display_size[1] // 2
-                            self.move_target = [float(space_center_x), float(space_center_y)]
+                    return f"移動到{item.name}的位置 (詳細邊緣計算所需資訊不足)"
+                else: # Item does not have a direct position, or the earlier check failed.
+                    # Fallback: try to use current_space center
+                    if hasattr(self.current_space, 'display_pos') and self.current_space.display_pos and \
+                       hasattr(self.current_space, 'display_size') and self.current_space.display_size and \
+                       len(self.current_space.display_pos) == 2 and len(self.current_space.display_size) == 2:
+                        space_center_x = self.current_space.display_pos[0] + self.current_space.display_size[0] // 3
+                        space_center_y = self.current_space.display_pos[1] + self.current_space.display_size[1] // 2
+                        self.move_target = [float(space_center_x), float(space_center_y)]
                             
-                            # 新增：使用路徑規劃器規劃路徑
-                            self.plan_path_to_target()
-                        else: # Fallback if space position/size is invalid
-                            self.move_target = [0.0,0.0] # Default to origin or handle error
-                        return f"移動到{item.name}所在空間的大致位置 (物品位置資訊不足或空間資訊無效)"
+                        # 新增：使用路徑規劃器規劃路徑
+                        self.plan_path_to_target()
+                    else: # Fallback if space position/size is invalid
+                        self.move_target = [0.0,0.0] # Default to origin or handle error
+                    return f"移動到{item.name}所在空間的大致位置 (物品位置資訊不足或空間資訊無效)"
 
         return f"在 {self.current_space.name} 中找不到物品：{item_name} (請確認 AI 選擇的物品確實存在於當前空間)"
 
-    def interact_with_item(self, item_name: str, how_to_interact: str) -> str:
+    def interact_with_item(self, item_name: str, how_to_interact: str, effect: Any = None) -> str:
         """
         將 NPC 移動到指定物品的位置並與之互動。
+        effect 為互動對世界造成的改變 (AI_System 的 function 模型)，互動完成時排入指令佇列。
         """
+        # 庫存中的物品不需要移動，直接完成互動
+        if self.inventory.items.has(item_name):
+            self.waiting_interaction = {
+                "item_name": item_name,
+                "how_to_interact": how_to_interact,
+                "effect": effect,
+                "started": True
+            }
+            return self.complete_interaction()
         # 先移動到物品位置
         move_result = self.move_to_item(item_name)
         if not move_result.startswith("找不到物品"):
@@ -891,11 +1741,23 @@ class NPC(BaseModel):
             self.waiting_interaction = {
                 "item_name": item_name,
                 "how_to_interact": how_to_interact,
+                "effect": effect,
                 "started": True
             }
+            # 抵達後由移動引擎觸發一次互動，不需要每個 tick 檢查是否已到達
+            triggers = get_triggers(world_system.world) if world_system and world_system.world else None
+            if triggers is not None:
+                triggers.cancel_arrival(self)
+                triggers.on_arrival(self, NPC._complete_interaction_on_arrival)
             return f"正在移動到{item_name}準備互動..."
         return move_result
 
+    def _complete_interaction_on_arrival(self) -> Optional[str]:
+        """抵達觸發器的回呼：途中已改做別的事 (互動不再等待) 時不回報結果。"""
+        if self.waiting_interaction and self.waiting_interaction.get("started", False):
+            return self.complete_interaction()
+        return None
+
     def complete_interaction(self) -> str:
         """
         當NPC完成移動後，執行互動。
@@ -922,189 +1784,66 @@ class NPC(BaseModel):
 
     def process_tick(self, user_input: Optional[str] = None):
         """
-        處理這一 tick 的 NPC 行為
+        處理這一 tick 的 NPC 行為 (同一執行緒內依序：建立快照 -> 思考 -> 套用決策)。
+        多執行緒時改由 think() 讀快照、主執行緒以 apply_decision() 套用。
         """
         global world_system # 移到方法頂部
+        if world_system is None:
+            from backend import AI_System # 應該在頂層或初始化時完成
+            world_system = AI_System()
+            # world_system.initialize_world(...) # 需要 world data, 這不應該在這裡發生
 
-        # 檢查 NPC 是否完成了互動等待
-        if self.waiting_interaction and self.waiting_interaction.get("started", False):
-            # 檢查是否到達目的地
-            if self.move_target is None: # 已到達
-                interaction_result = self.complete_interaction()
-                self.waiting_interaction = None # 清除等待狀態
-                self.history.append({"role": "system", "content": f"互動完成: {interaction_result}"})
-                return f"與 {self.waiting_interaction.get('item_name', '物品')} 的互動完成: {interaction_result}"
-            else: # 尚未到達，繼續移動
-                # (移動邏輯會在下面處理)
-                self.action_status = f"正在前往 {self.waiting_interaction.get('item_name', '物品')} 以便互動"
-                # return f"NPC {self.name} 正在前往 {self.waiting_interaction.get('item_name', '物品')} 以便互動..."
-        
-        # 記錄此 NPC 進入當前空間
-        if self.first_tick:
-            self.add_space_to_history()
-            self.first_tick = False
-            
-        # --- 移動處理開始 ---
-        original_thinking_status_before_move = self.thinking_status # 保存移動前的思考狀態
-        movement_occurred_this_tick = False
-
-        if hasattr(self, 'move_target') and self.move_target and hasattr(self, 'position') and self.position:
-            movement_occurred_this_tick = True # 標記發生了移動計算
-            target_x, target_y = self.move_target[0], self.move_target[1]
-            curr_x, curr_y = self.position[0], self.position[1]
-            
-            next_point = None
-            if hasattr(self, 'current_path_points') and self.current_path_points and len(self.current_path_points) > 0:
-                next_point = self.current_path_points[0]
-                target_x, target_y = next_point[0], next_point[1]
-            
-            dx = target_x - curr_x
-            dy = target_y - curr_y
-            distance = math.sqrt(dx * dx + dy * dy)
-            move_speed_val = self.move_speed if hasattr(self, 'move_speed') and self.move_speed is not None else 1.0
-            move_distance = min(distance, move_speed_val)
-            
-            if distance < move_speed_val: # 已到達（或非常接近）目標點
-                self.position[0] = target_x
-                self.position[1] = target_y
-                # print(f"DEBUG: NPC {self.name} REACHED point {target_x, target_y}. Current pos: {self.position}")
-                
-                if next_point and hasattr(self, 'current_path_points') and self.current_path_points:
-                    self.current_path_points.pop(0)
-                    if not self.current_path_points: # 如果路徑點已空
-                        # print(f"DEBUG: NPC {self.name} finished path. Original target: {self.original_move_target}, Current pos: {self.position}")
-                        # 檢查是否到達最終的 original_move_target
-                        if self.original_move_target and \
-                            math.isclose(self.position[0], self.original_move_target[0]) and \
-                            math.isclose(self.position[1], self.original_move_target[1]):
-                            print(f"DEBUG: NPC {self.name} has reached the final original_move_target: {self.original_move_target}")
-                            self.move_target = None
-                            self.original_move_target = None
-                            self.avoiding_item_name = None
-                            self.action_status = f"已到達 {self.original_move_target}"
-                            self.thinking_status = f"已到達目的地 {self.original_move_target}"
-                        elif not self.current_path_segment_target_space_name: # 如果不是跨空間移動
-                            # print(f"DEBUG: NPC {self.name} path empty, not cross-space, clearing move_target.")
-                            self.move_target = None # 清除移動目標，因為路徑已完成
-                            self.original_move_target = None
-                            self.avoiding_item_name = None
-
-
-                elif self.move_target and math.isclose(self.position[0], self.move_target[0]) and math.isclose(self.position[1], self.move_target[1]):
-                    # 如果沒有路徑點，但已到達 move_target，則清除
-                    # print(f"DEBUG: NPC {self.name} reached direct move_target, clearing it.")
-                    self.move_target = None
-                    self.original_move_target = None
-                    self.avoiding_item_name = None
-            else: # 尚未到達目標點，繼續移動
-                norm_dx = dx / distance if distance > 1e-9 else 0
-                norm_dy = dy / distance if distance > 1e-9 else 0
-                new_x = curr_x + norm_dx * move_distance
-                new_y = curr_y + norm_dy * move_distance
-                
-                can_move_x = True
-                can_move_y = True
-                if hasattr(self.current_space, 'display_pos') and hasattr(self.current_space, 'display_size'):
-                    space_x, space_y = self.current_space.display_pos
-                    space_width, space_height = self.current_space.display_size
-                    npc_radius = self.radius if hasattr(self, 'radius') and self.radius is not None else 15
-                    
-                    if new_x - npc_radius < space_x or new_x + npc_radius > space_x + space_width:
-                        can_move_x = False
-                    if new_y - npc_radius < space_y or new_y + npc_radius > space_y + space_height:
-                        can_move_y = False
-                
-                if can_move_x: self.position[0] = new_x
-                if can_move_y: self.position[1] = new_y
-                self.action_status = f"移動到 {[round(target_x,1), round(target_y,1)]}"
-
-            # 檢查是否需要移動到下一個空間
-            if not self.move_target and self.current_path_segment_target_space_name:
-                global world_system
-                target_space_obj = world_system.world['spaces'].get(self.current_path_segment_target_space_name)
-                if target_space_obj:
-                    # NPC 進入新空間的邏輯
-                    if self.current_space and hasattr(self.current_space, 'npcs') and self in self.current_space.npcs:
-                        self.current_space.npcs.remove(self)
-                    self.current_space = target_space_obj
-                    if hasattr(target_space_obj, 'npcs') and self not in target_space_obj.npcs:
-                        target_space_obj.npcs.append(self)
-                    self.add_space_to_history() # 記錄進入新空間
-                    
-                    # 更新NPC的位置到新空間的中心 (或入口點，如果有的話)
-                    if hasattr(self, '_find_connection_point'):
-                        entry_point = self._find_connection_point(target_space_obj, self.current_space) # 反過來找入口
-                        if entry_point:
-                            self.position = list(entry_point)
-                        else:
-                            self.position = [target_space_obj.display_pos[0] + target_space_obj.display_size[0] / 2,
-                                        target_space_obj.display_pos[1] + target_space_obj.display_size[1] / 2]
-                    else: # Fallback
-                        self.position = [target_space_obj.display_pos[0] + target_space_obj.display_size[0] / 2,
-                                        target_space_obj.display_pos[1] + target_space_obj.display_size[1] / 2]
-
-
-                    self.thinking_status = f"已到達 {self.current_space.name}."
-                    self.action_status = f"進入 {self.current_space.name}"
-                    
-                    if self.path_to_follow: # 如果還有後續路徑
-                        self.current_path_segment_target_space_name = self.path_to_follow.pop(0)
-                        self.thinking_status = f"繼續前往 {self.current_path_segment_target_space_name}"
-                        # 這裡可以再次調用 move_to_space 的部分邏輯來規劃到下一個連接點
-                        next_target_space_obj = world_system.world['spaces'].get(self.current_path_segment_target_space_name)
-                        if next_target_space_obj and hasattr(self, '_find_connection_point') and self.path_planner:
-                            connection_point = self._find_connection_point(self.current_space, next_target_space_obj)
-                            if connection_point:
-                                self.move_target = list(connection_point)
-                                self.original_move_target = list(connection_point) # 更新原始目標
-                                self.plan_path_to_target()
-                    else: # 到達最終空間
-                        self.current_path_segment_target_space_name = None
-                        self.thinking_status = f"已完成跨空間移動，抵達最終空間 {self.current_space.name}"
-                else:
-                    self.current_path_segment_target_space_name = None # 目標空間無效
-        # --- 移動處理結束 ---
+        result = self.apply_decision(self.think(world_system.take_snapshot(), user_input))
+        world_system.apply_commands()
+        return result
 
-        # 如果這一 tick 主要是移動，或者正在等待互動，則可能不需要立即進行新的 AI 思考
-        if movement_occurred_this_tick and self.move_target: # 如果還在移動中
-            # self.thinking_status = original_thinking_status_before_move # 恢復移動前的思考狀態，如果被移動覆蓋
-            return self.action_status # 返回當前移動狀態
+    def think(self, snapshot: WorldSnapshot, user_input: Optional[str] = None) -> NPCDecision:
+        """
+        只讀取快照來組 prompt 與 schema 並呼叫 LLM，不修改共享的世界 (可在思考執行緒中執行)。
+        回傳的決策需交由主執行緒以 apply_decision 套用。
+        """
+        view = snapshot.npcs[self.name]
+        decision = NPCDecision(npc_name=self.name, snapshot_version=snapshot.version, user_input=user_input)
 
-        if self.waiting_interaction and self.waiting_interaction.get("started", False) and self.move_target:
-             return f"NPC {self.name} 正在前往 {self.waiting_interaction.get('item_name', '物品')} 以便互動..."
+        # 記錄此 NPC 進入當前空間
+        if view.first_tick and view.space in snapshot.spaces:
+            decision.space_history = str(snapshot.spaces[view.space])
 
+        # --- 移動處理 ---
+        # 位移、撞牆與跨空間由 MovementEngine 統一處理 (pygame 每幀、SandBox 每個 tick 推進)，這裡只判斷是否仍在移動
+        # 如果還在移動中 (包含正在前往互動的物品)，則不需要立即進行新的 AI 思考
+        if view.moving:
+            decision.status = f"NPC {self.name} 正在前往 {view.waiting_item} 以便互動..." if view.waiting_item else None
+            decision.status = decision.status or self.action_status
+            return decision
 
         # --- AI 思考和行動決策 ---
-        self.is_thinking = True
-        self.thinking_status = "正在思考..."
-        
-        # global world_system # 確保 world_system 是最新的 # <--- 原本在這裡，已上移
-        if world_system is None:
-            from backend import AI_System # 應該在頂層或初始化時完成
-            world_system = AI_System() 
-            # world_system.initialize_world(...) # 需要 world data, 這不應該在這裡發生
-
-        GeneralResponseSchema = self.update_schema() # 獲取動態 schema
+        # is_thinking 與 thinking_status 由主執行緒在啟動思考時設定、在 apply_decision 中清除
+        GeneralResponseSchema = self.update_schema(snapshot) # 獲取動態 schema
 
+        # 準備 API 調用
+        messages_for_api = [dict(message) for message in view.history] # 複製歷史記錄
+        if decision.space_history:
+            messages_for_api.append({"role": "system", "content": decision.space_history})
         if user_input:
-            self.history.append({"role": "user", "content": f"User: {user_input}"})
+            messages_for_api.append({"role": "user", "content": f"User: {user_input}"})
 
-        # 準備 API 調用
-        messages_for_api = list(self.history) # 複製歷史記錄
-        
         # 構建系統提示 (可以根據需要調整)
+        space_view = snapshot.spaces.get(view.space)
+        # 自我介紹、位置與庫存是快照建立時快取的片段，同一個房間的 NPC 共用相同的字串
         system_prompt = (
-            f"你是 NPC {self.name} ({self.description}). "
-            f"目前時間是 {world_system.time}, 天氣是 {world_system.weather}. "
-            f"你位於 {self.current_space.name} ({self.current_space.description}). "
-            f"你的家是 {self.home_space_name if self.home_space_name else '未設定'}. "
+            f"{view.persona}"
+            f"目前時間是 {snapshot.time}, 天氣是 {snapshot.weather}. "
+            f"{space_view.location if space_view else f'你位於 {view.space} (). '}"
+            f"你的家是 {view.home_space_name if view.home_space_name else '未設定'}. "
             "根據你的歷史、當前環境和用戶輸入來決定下一步行動。"
             "思考你的目標和可能的行動，然後選擇一個具體的行動或決定什麼都不做。"
+            f"\n你持有的物品:\n{view.inventory_text}"
         )
+        if view.percept is not None:
+            system_prompt += f"\n你目前的感知:\n{view.percept.summary}"
         messages_for_api.insert(0, {"role": "system", "content": system_prompt})
-        
-        self.action_status = "" # 清除上一tick的行動狀態
-        
+
         try:
             completion = client.beta.chat.completions.parse(
                 model="gpt-4o", # 使用標準模型
@@ -1114,24 +1853,54 @@ class NPC(BaseModel):
             response = completion.choices[0].message.parsed
         except Exception as e:
             print(f"ERROR: NPC {self.name} 思考時 API 調用失敗: {e}")
-            self.history.append({"role": "system", "content": f"思考錯誤: {e}"})
+            decision.error = str(e)
+            return decision
+
+        decision.reasoning = response.self_talk_reasoning if response and hasattr(response, 'self_talk_reasoning') else None
+        decision.action = response.action if response else None
+        return decision
+
+    def apply_decision(self, decision: NPCDecision) -> str:
+        """
+        把 think() 的結果套用到世界 (只能由寫入世界的主執行緒呼叫)：寫入歷史、執行行動並更新狀態。
+        行動以套用當下的世界為準，例如物品已被別人拿走時會回報找不到。
+        """
+        if decision.space_history is not None and self.first_tick:
+            self.history.append({"role": "system", "content": decision.space_history})
+        self.first_tick = False
+
+        if decision.status is not None:
+            # 互動在抵達時由移動引擎的抵達觸發器完成，這裡只更新狀態
+            if self.waiting_interaction and self.waiting_interaction.get("started", False) and self.move_target is not None:
+                self.action_status = f"正在前往 {self.waiting_interaction.get('item_name', '物品')} 以便互動"
             self.is_thinking = False
-            self.thinking_status = f"思考出錯: {e}"
+            self.thinking_status = decision.status
+            return decision.status
+
+        if decision.user_input:
+            self.history.append({"role": "user", "content": f"User: {decision.user_input}"})
+
+        self.action_status = "" # 清除上一tick的行動狀態
+
+        if decision.error is not None:
+            self.history.append({"role": "system", "content": f"思考錯誤: {decision.error}"})
+            self.is_thinking = False
+            self.thinking_status = f"思考出錯: {decision.error}"
             return f"NPC {self.name} 思考出錯。"
 
         self.is_thinking = False
-        self.thinking_status = response.self_talk_reasoning if response and hasattr(response, 'self_talk_reasoning') else "思考完成"
+        self.thinking_status = decision.reasoning if decision.reasoning is not None else "思考完成"
         
         # 將 AI 的思考加入歷史
-        if response and hasattr(response, 'self_talk_reasoning'):
-            self.history.append({"role": "assistant", "content": f"Thinking: {response.self_talk_reasoning}"})
+        if decision.reasoning is not None:
+            self.history.append({"role": "assistant", "content": f"Thinking: {decision.reasoning}"})
         else: # response 可能為 None 或沒有 self_talk_reasoning
              self.history.append({"role": "assistant", "content": "Thinking: (No reasoning provided or error in response structure)"})
 
 
         action_result_str = "決定不採取行動。"
-        if response and response.action:
-            action = response.action
+        if decision.action:
+            action = decision.action
             action_type_str = getattr(action, 'action_type', 'unknown_action')
             self.action_status = f"準備執行: {action_type_str}"
 
@@ -1140,7 +1909,7 @@ class NPC(BaseModel):
                 if action.action_type == "interact_item":
                     item_name = getattr(action, 'interact_with', '未知物品')
                     how_to = getattr(action, 'how_to_interact', '未知方式')
-                    action_result_str = self.interact_with_item(item_name, how_to)
+                    action_result_str = self.interact_with_item(item_name, how_to, getattr(action, 'effect', None))
                     action_description_for_history = f"Action: 計劃與 {item_name} 互動: {how_to}"
                 elif action.action_type == "enter_space":
                     target_space = getattr(action, 'target_space', '未知空間')
@@ -1174,7 +1943,7 @@ class NPC(BaseModel):
 
     def talk_to_npc(self, target_npc_name: str, dialogue: str) -> str:
         """
-        Handle talking to another NPC in the same space.
+        Handle talking to another NPC within hearing range (the same space when no perception data is available).
 
         Args:
             target_npc_name: The name of the NPC to talk to
@@ -1183,15 +1952,25 @@ class NPC(BaseModel):
         Returns:
             A string describing the result of the conversation
         """
-        # Find the target NPC in the current space
+        # Find the target NPC among those who can hear us
+        percept = self.perceive()
+        candidates = percept.audible_npcs if percept is not None else self.current_space.npcs
+        names = get_names(world_system.world) if world_system is not None else None
+        target_uid = names.resolve("npc", target_npc_name) if names is not None else None
         target_npc = None
-        for npc in self.current_space.npcs:
-            if npc.name.lower() == target_npc_name.lower() and npc != self:
+        for npc in candidates:
+            if npc is self:
+                continue
+            if target_uid is not None and npc.uid != NO_ID:
+                matched = npc.uid == target_uid
+            else:
+                matched = npc.name.lower() == target_npc_name.lower()
+            if matched:
                 target_npc = npc
                 break
 
         if target_npc is None:
-            return f"Cannot find NPC '{target_npc_name}' in the current space."
+            return f"Cannot find NPC '{target_npc_name}' within hearing range."
 
         # In a more complex implementation, you might want to pass the dialogue to the target NPC
         # and get a response back. For now, we'll just return a simple message.
@@ -1255,6 +2034,10 @@ def build_world_from_data(world_data: Dict[str, Any]) -> Dict[str, Any]:
     spaces_dict = {}
     items_dict = {}
     npcs_dict = {}
+    journal = WorldJournal()
+    Space.journal = journal
+    fragments = FragmentCache()
+    Space.fragments = fragments
 
     # 第一步: 創建所有空間（不含連接）
     for space_data in world_data.get("spaces", []):
@@ -1266,21 +2049,25 @@ def build_world_from_data(world_data: Dict[str, Any]) -> Dict[str, Any]:
             npcs = [],  # 後續添加 NPC
             display_pos = tuple(space_data["space_positions"]),
             display_size = tuple(space_data["space_size"]),
+            cluster = space_data.get("cluster"),
             conversation_manager = ConversationManager(space_name=space_data["name"])
         )
 
-    # 第二步: 創建所有物品
+    # 第二步: 創建所有物品 (以 Item 驗證資料，執行期使用輕量的 ItemEntity)
+    # 物品可以指定 worlds/item.json 中的原型，只寫與原型不同的欄位；相同的資料由多個物品共用
+    prototypes = PrototypeCatalog.load()
     for item_data in world_data.get("items", []):
-        # 使用 Item 類創建物品
-        items_dict[item_data["name"]] = Item(
+        item_data = prototypes.expand(item_data)
+        item = Item(
             name = item_data["name"],
-            description = item_data["description"],
+            description = item_data.get("description", ""),
             properties = item_data.get("properties", {}),
             position = item_data.get("position"),
             size = item_data.get("size"),
             image_path = item_data.get("image_path"),  # 讀取圖片路徑
             image_scale = item_data.get("image_scale", 1.0)  # 讀取圖片縮放比例
         )
+        items_dict[item_data["name"]] = prototypes.instantiate({**item.model_dump(), "prototype": item_data.get("prototype")})
 
     # 第三步: 連接空間並向空間添加物品
     for space_data in world_data.get("spaces", []):
@@ -1351,8 +2138,17 @@ def build_world_from_data(world_data: Dict[str, Any]) -> Dict[str, Any]:
             # 將 NPC 存儲在字典中
             npcs_dict[npc_data["name"]] = npc
 
+    # 指定整數 id，名稱改用名稱表中 intern 過的標準字串
+    names = NameTable()
+    for kind, objects in (("space", spaces_dict), ("item", items_dict), ("npc", npcs_dict)):
+        for obj in objects.values():
+            obj.uid = names.register(kind, obj.name)
+            obj.name = names.name_of(obj.uid)
+
     # 取得物件參考
     spaces = list(spaces_dict.values())
+    portal_graph = PortalGraph.from_spaces(spaces)
+    portal_graph.topology_version = Space.topology_version
     npcs = list(npcs_dict.values())
     items = list(items_dict.values())
 
@@ -1408,7 +2204,16 @@ def build_world_from_data(world_data: Dict[str, Any]) -> Dict[str, Any]:
         "description": world_data.get("description", ""),
         "spaces": spaces_dict,
         "items": items_dict,  # 確保總是有 'items' key
-        "npcs": npcs_dict
+        "npcs": npcs_dict,
+        "portal_graph": portal_graph,  # 門戶圖：backend 路徑規劃與 renderer 共用
+        "door_reservations": DoorReservationTable(),  # 門的時空預約表：多個 NPC 錯開時間通過同一扇門
+        "space_index": SpaceIndex(spaces_dict.values()),  # 點到空間的索引：renderer 與 backend 共用
+        "perception": Perception(),  # NPC 感知查詢的快取：移動引擎與 AI_System 在變動時通知
+        "triggers": TriggerSystem(),  # 接近與抵達觸發器：由移動引擎在 NPC 移動或抵達時通知
+        "journal": journal,  # 世界的版本號與變更日誌：所有改變世界的路徑都會記錄，供快取失效使用
+        "names": names,  # 實體的整數 id 與名稱表：以 id 比對取代名稱字串的比較
+        "prototypes": prototypes,  # 物品原型型錄：相同的描述、大小與圖片由多個物品共用
+        "fragments": fragments  # prompt 文字片段快取：依變更日誌的版本號沿用空間、庫存與 NPC 的描述
     }
 
 # New function to list available worlds
@@ -1511,17 +2316,16 @@ def save_world_to_json(world: Dict[str, Any], file_path: str) -> bool:
                 "space_size": space.display_size
                 # NPC 單獨處理
             }
+            if space.cluster:
+                space_data["cluster"] = space.cluster
             world_data["spaces"].append(space_data)
 
-        # 序列化物品 - 簡化版本，不包含 interactions
+        # 序列化物品 - 簡化版本，不包含 interactions (執行期的 ItemEntity 轉回 Item 驗證後輸出)
+        # 有具名原型的物品只寫原型名稱與覆寫值
         for item_name, item in world["items"].items():
-            item_data = {
-                "name": item.name,
-                "description": item.description,
-                "properties": item.properties,
-                "position": item.position,  # 轉換為列表
-                "size": item.size  # 轉換為列表
-            }
+            item_data = item_save_data(item, ("description", "properties", "size"))
+            if item_data is None:
+                item_data = Item.from_entity(item).model_dump(include={"name", "description", "properties", "position", "size"})
             world_data["items"].append(item_data)
 
         # 序列化 NPC
@@ -1646,6 +2450,10 @@ def SandBox():
         print(f"已加載世界: {world['world_name']}")
         print(f"描述: {world['description']}")
         print(f"NPC: {', '.join([npc.name for npc in npcs])}")
+        movement_engine = get_movement_engine(world)
+        for npc in npcs:
+            if npc.path_planner is None:
+                npc.set_path_planner(movement_engine.path_planner)
 
         # 選擇要關注的 NPC 進行詳細互動
         active_npc_index = 0
@@ -1670,10 +2478,12 @@ def SandBox():
             user_input = input("c -> 繼續, e -> 退出, p -> 打印歷史, s -> 顯示模式, n -> 切換 NPC, w -> 改變天氣和時間: ").strip().lower()
 
             if user_input == "c":
-                # 處理所有 NPC 的 tick，但只顯示活躍 NPC 的結果
+                # 先推進移動 (沒有畫面，路線上的 NPC 以解析式移動)，再處理所有 NPC 的 tick，但只顯示活躍 NPC 的結果
+                for interaction_result in movement_engine.run(npcs, HEADLESS_TICK_FRAMES, headless=True):
+                    print(f"[互動] {interaction_result}")
                 for npc in npcs:
                     result = npc.process_tick()
-                    if npc == active_npc:
+                    if npc is active_npc:
                         print(f"[{npc.name}] Tick 結果: {result}")
                 print()
                 print()
@@ -1823,6 +2633,15 @@ class AI_System(BaseModel):
     history: List[Dict[str, str]] = []  # 系統歷史記錄
     world: Dict[str, Any] = {}  # 世界狀態的引用
 
+    # _path_batch 屬於 runtime 狀態，不序列化
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._path_batch: Optional[List[RouteQuery]] = None  # None 表示目前沒有在收集批次路徑查詢
+        self._path_batch_lock = threading.RLock()  # flush 時可能重新呼叫 move_to_space
+        self._snapshot_builder = SnapshotBuilder()
+        self._decisions = DecisionQueue()  # 思考執行緒提交、主執行緒套用的 NPC 決策
+        self._commands = CommandQueue()  # 待套用的世界修改指令
+
     class CreateItemFunction(BaseModel):
         function_type: Literal["create_item"]
         item_name: str = Field(description="新物品的名稱")
@@ -1895,6 +2714,96 @@ class AI_System(BaseModel):
 
         print(f"[DEBUG] world_system.world keys:", list(world_system.world.keys()) if world_system else "None")
 
+    @property
+    def decisions(self) -> DecisionQueue:
+        return self._decisions
+
+    def take_snapshot(self) -> WorldSnapshot:
+        """建立給思考執行緒讀取的唯讀世界快照 (只能在主執行緒呼叫)。"""
+        return self._snapshot_builder.build(self.world, self.time, self.weather, perceive=lambda npc: npc.perceive())
+
+    def apply_decisions(self) -> List[Tuple[NPC, str]]:
+        """
+        在主執行緒依提交順序套用所有待處理的 NPC 決策，回傳 (NPC, 結果) 列表。
+        期間的跨空間路徑查詢一起批次計算，之後再套用這段期間排入的世界修改指令。
+        """
+        decisions = self._decisions.drain()
+        if not decisions:
+            return []
+        results = []
+        npcs = self.world.get("npcs", {})
+        self.begin_path_batch()
+        try:
+            for decision in decisions:
+                npc = npcs.get(decision.npc_name)
+                if npc is not None:
+                    results.append((npc, npc.apply_decision(decision)))
+        finally:
+            self.flush_path_batch()
+        self.apply_commands()
+        return results
+
+    def begin_path_batch(self) -> None:
+        """開始收集 NPC 的跨空間路徑查詢，直到 flush_path_batch 才一起計算。"""
+        with self._path_batch_lock:
+            if self._path_batch is None:
+                self._path_batch = []
+
+    def queue_path_query(self, query: RouteQuery) -> bool:
+        """批次收集中時登記查詢並回傳 True；否則回傳 False，由呼叫端自行計算。"""
+        with self._path_batch_lock:
+            if self._path_batch is None:
+                return False
+            self._path_batch.append(query)
+            return True
+
+    def flush_path_batch(self) -> int:
+        """
+        在行程池上計算收集到的所有路徑查詢 (共用同一份唯讀門戶圖)，
+        全部算完後才一次套用到各 NPC，回傳處理的查詢數量。
+        前往同一空間的查詢達到 FLOW_FIELD_MIN_GROUP 個時 (例如「大家都去客廳」)，
+        改為建立一份共用的路線場，每個 NPC 只需沿著它走，不再各自搜尋。
+        """
+        with self._path_batch_lock:
+            queries = self._path_batch or []
+            self._path_batch = None
+        if not queries:
+            return 0
+
+        portal_graph = get_portal_graph(self.world)
+        reservations = get_door_reservations(self.world)
+        goal_counts: Dict[str, int] = {}
+        for query in queries:
+            if query.goal_pos is None:
+                goal_counts[query.goal_space] = goal_counts.get(query.goal_space, 0) + 1
+        grouped = [query.goal_pos is None and goal_counts[query.goal_space] >= FLOW_FIELD_MIN_GROUP for query in queries]
+        searched = find_routes_batch(portal_graph, [query for query, by_field in zip(queries, grouped) if not by_field])
+        searched_iter = iter(searched)
+        routes = [
+            portal_graph.route_by_field(query.start_space, query.goal_space, query.start_pos) if by_field else next(searched_iter)
+            for query, by_field in zip(queries, grouped)
+        ]
+        with self._path_batch_lock:
+            for query, route, by_field in zip(queries, routes, grouped):
+                npc = query.key
+                if npc.current_space is None or npc.current_space.name != query.start_space:
+                    # 排隊期間 NPC 已換了空間，舊結果不適用，改為重新規劃
+                    npc.move_to_space(query.goal_space)
+                    continue
+                if route is not None and route.portals and reservations is not None:
+                    # 依序登記門的預約；與先前 NPC 的預約衝突時，才以協同 A* 重新規劃 (可能改走其他門)
+                    speed, hold = npc.door_timing()
+                    start = portal_graph.anchor(query.start_space, query.start_pos)
+                    route.crossing_times, waited = reservations.schedule_route(route, start, speed, hold, npc.name)
+                    # 群體移動共用路線場，只在門口排隊，不逐一重新規劃
+                    if waited > 0 and not by_field:
+                        route = portal_graph.find_route(query.start_space, query.goal_space, query.start_pos, query.goal_pos,
+                                                        reservations=reservations, owner=npc.name, speed=speed, hold=hold)
+                    if route is not None:
+                        reservations.reserve_route(npc.name, route, hold)
+                npc._follow_space_path(route.spaces if route else None, query.goal_space)
+        return len(queries)
+
     def process_interaction(self, npc: "NPC", item_name: str, how_to_interact: str) -> str:
         """
         處理 NPC 與物品的互動。
@@ -1922,12 +2831,19 @@ class AI_System(BaseModel):
             else:
                 print(f"[ERROR] 無法獲取世界數據，互動可能無法正常工作")
 
-        # 先讓NPC移動到物品位置
-        move_result = npc.move_to_item(item_name)
+        # 互動對世界的改變排入指令佇列，於下一次 apply_commands 與其他 NPC 的指令一起套用
+        effect = npc.waiting_interaction.get("effect") if npc.waiting_interaction else None
+        if npc.inventory.items.has(item_name):
+            move_result = f"{npc.name} 使用持有的 {item_name}"
+        else:
+            # 先讓NPC移動到物品位置
+            move_result = npc.move_to_item(item_name)
         if not move_result.startswith("找不到物品"):
             # 不再需要調用 OpenAI API，直接使用互動描述
             # 準備互動結果訊息
             interaction_result = f"{npc.name} 與 {item_name} 互動: {how_to_interact}"
+            if effect is not None:
+                interaction_result += f" ({self._handle_function(effect, npc)})"
 
             # 將互動訊息加入 NPC 的歷史記錄
             npc.history.append({"role": "system", "content": interaction_result})
@@ -1943,29 +2859,86 @@ class AI_System(BaseModel):
 
     def _handle_function(self, function: Any, npc: "NPC") -> str:
         """
-        根據功能類型處理功能調用。
+        把功能調用轉成世界修改指令並排入佇列 (於 apply_commands 時套用)。
         Args:
             function: 要執行的功能
             npc: 觸發功能的 NPC
         Returns:
-            功能執行結果的描述
+            排入結果的描述
         """
+        command = None
         if hasattr(function, "function_type"):
             if function.function_type == "create_item":
-                return self._create_item(function.item_name, function.description, function.space_name)
+                command = CreateItem(function.item_name, function.description, function.space_name, npc_name=npc.name)
             elif function.function_type == "delete_item":
-                return self._delete_item(function.item_name, function.space_name, function.npc_name)
+                command = DeleteItem(function.item_name, function.space_name, function.npc_name, npc_name=npc.name)
             elif function.function_type == "change_item_description":
-                return self._change_item_description(function.item_name, function.new_description)
+                command = ChangeItemDescription(function.item_name, function.new_description, npc_name=npc.name)
             elif function.function_type == "delete_and_create_new_item":
-                return self._delete_and_create_new_item(
+                command = ReplaceItem(
                     function.old_item_name, function.new_item_name,
-                    function.new_description, function.space_name
+                    function.new_description, function.space_name, npc_name=npc.name
                 )
             elif function.function_type == "move_item_to_inventory":
-                return self._move_item_to_inventory(function.item_name, function.npc_name)
+                command = MoveItemToInventory(function.item_name, function.npc_name, npc_name=npc.name)
 
-        return "未知的功能類型。"
+        if command is None:
+            return "未知的功能類型。"
+        self.submit_command(command)
+        return f"已排入 {function.function_type}，將於下一次套用指令時生效。"
+
+    def submit_command(self, command: WorldCommand) -> WorldCommand:
+        """排入一個世界修改指令 (任何執行緒皆可呼叫)；套用後結果寫在 command.result。"""
+        return self._commands.submit(command)
+
+    def apply_commands(self) -> List[Tuple[WorldCommand, str]]:
+        """
+        在主執行緒一次套用所有排入的指令 (依 NPC 名稱與提交順序，同一物品先到先得)，
+        整批在變更日誌只遞增一次版本號。結果寫入提出指令的 NPC 的歷史，並回傳 (指令, 結果) 列表。
+        """
+        commands = self._commands.drain()
+        if not commands:
+            return []
+        journal = self.world.get("journal")
+        if journal is None:
+            results = apply_batch(self, commands)
+        else:
+            with journal.batch():
+                results = apply_batch(self, commands)
+        # 提出指令的 NPC 在歷史中得知結果 (包含被別人先取用的衝突)
+        npcs = self.world.get("npcs", {})
+        for command, result in results:
+            npc = npcs.get(command.npc_name) if command.npc_name else None
+            if npc is not None:
+                npc.history.append({"role": "system", "content": f"結果: {result}"})
+        return results
+
+    def _record_change(self, kind: str, *entities: Tuple[str, str], **details: Any) -> None:
+        """在世界的變更日誌記錄一筆變更 (沒有日誌時略過)。"""
+        journal = self.world.get("journal")
+        if journal is not None:
+            journal.record(kind, *entities, **details)
+
+    def _notify_item_layout_change(self, space: "Space", item: ItemEntity, added: bool) -> None:
+        """物品進出空間時，通知所有 NPC 使用的路徑規劃器更新佔用網格並修補受影響的路徑。"""
+        perception = self.world.get("perception")
+        if perception is not None:
+            perception.touch(space.name)
+        npcs = list(self.world.get("npcs", {}).values())
+        planners = {id(npc.path_planner): npc.path_planner for npc in npcs if npc.path_planner}
+        for planner in planners.values():
+            if added:
+                planner.on_item_added(space, item, npcs)
+            else:
+                planner.on_item_removed(space, item)
+
+    def _forget_item(self, item: ItemEntity) -> None:
+        """被刪除的物品從 ECS 儲存與名稱表中移除。"""
+        if self.world.get("ecs") is not None:
+            self.world["ecs"].remove_object(item)
+        names = get_names(self.world)
+        if names is not None and item.uid != NO_ID:
+            names.release(item.uid)
 
     def _create_item(self, item_name: str, description: str, space_name: str) -> str:
         print(f"[DEBUG] _create_item: self.world keys = {list(self.world.keys())}")
@@ -1979,11 +2952,19 @@ class AI_System(BaseModel):
             name=item_name,
             description=description,
             properties={}  # 默認空屬性
-        )
+        ).to_entity()
+        names = get_names(self.world)
+        if names is not None:
+            new_item.uid = names.register("item", item_name)
+            new_item.name = names.name_of(new_item.uid)
         # 將物品添加到世界物品字典中
         self.world["items"][item_name] = new_item
         # 將物品添加到空間
         space.items.append(new_item)
+        self._notify_item_layout_change(space, new_item, added=True)
+        if self.world.get("ecs") is not None:
+            self.world["ecs"].sync_item(new_item, space=space)
+        self._record_change("item_created", ("item", item_name), ("space", space_name))
         return f"已在空間 '{space_name}' 創建新物品 '{item_name}'。"
 
     def _delete_item(self, item_name: str, space_name: Optional[str], npc_name: Optional[str]) -> str:
@@ -1994,13 +2975,15 @@ class AI_System(BaseModel):
             if not space:
                 return f"找不到名為 '{space_name}' 的空間。"
 
-            for i, item in enumerate(space.items):
-                if item.name == item_name:
-                    space.items.pop(i)
-                    # 如果物品不被任何其他地方引用，則從世界中刪除
-                    if item_name in self.world["items"]:
-                        del self.world["items"][item_name]
-                    return f"從 {space_name} 刪除了物品: {item_name}"
+            item = space.items.remove_name(item_name)
+            if item is not None:
+                self._notify_item_layout_change(space, item, added=False)
+                self._forget_item(item)
+                self._record_change("item_deleted", ("item", item_name), ("space", space_name))
+                # 如果物品不被任何其他地方引用，則從世界中刪除
+                if item_name in self.world["items"]:
+                    del self.world["items"][item_name]
+                return f"從 {space_name} 刪除了物品: {item_name}"
 
         # 從 NPC 庫存中刪除
         if npc_name:
@@ -2008,13 +2991,14 @@ class AI_System(BaseModel):
             if not npc:
                 return f"找不到名為 '{npc_name}' 的 NPC。"
 
-            for i, item in enumerate(npc.inventory.items):
-                if item.name == item_name:
-                    npc.inventory.items.pop(i)
-                    # 如果物品不被任何其他地方引用，則從世界中刪除
-                    if item_name in self.world["items"]:
-                        del self.world["items"][item_name]
-                    return f"從 {npc_name} 的庫存中刪除了物品: {item_name}"
+            item = npc.inventory.items.remove_name(item_name)
+            if item is not None:
+                self._forget_item(item)
+                self._record_change("item_deleted", ("item", item_name), ("npc", npc_name))
+                # 如果物品不被任何其他地方引用，則從世界中刪除
+                if item_name in self.world["items"]:
+                    del self.world["items"][item_name]
+                return f"從 {npc_name} 的庫存中刪除了物品: {item_name}"
 
         return f"找不到物品 '{item_name}'。"
 
@@ -2025,6 +3009,7 @@ class AI_System(BaseModel):
         if item_name in items:
             item = items[item_name]
             item.description = new_description
+            self._record_change("item_changed", ("item", item_name), field="description")
             return f"更新了物品 '{item_name}' 的描述。"
         return f"找不到物品 '{item_name}'。"
 
@@ -2050,18 +3035,18 @@ class AI_System(BaseModel):
             return f"找不到名為 '{npc_name}' 的 NPC。"
 
         # 在當前空間中查找物品
-        item = None
-        for i, space_item in enumerate(npc.current_space.items):
-            if space_item.name == item_name:
-                item = space_item
-                npc.current_space.items.pop(i)
-                break
+        item = npc.current_space.items.remove_name(item_name)
+        if item is not None:
+            self._notify_item_layout_change(npc.current_space, item, added=False)
 
         if not item:
             return f"在 {npc.current_space.name} 中找不到物品 '{item_name}'。"
 
         # 將物品添加到 NPC 的庫存
         result = npc.inventory.add_item(item)
+        if self.world.get("ecs") is not None:
+            self.world["ecs"].sync_item(item, owner=npc)
+        self._record_change("item_moved", ("item", item_name), ("space", npc.current_space.name), ("npc", npc_name))
         return f"{npc_name} 撿起了 {item_name}。{result}"
 
 
@@ -0,0 +1,160 @@
+"""
+AI_System 對世界的修改以指令物件表示，先排入佇列，再於 tick 中固定的時間點一次套用。
+
+任何執行緒都可以 submit() 指令；主執行緒呼叫 AI_System.apply_commands() 時：
+    1. 取出這一批指令，依 (NPC 名稱, 提交順序) 排序，結果與執行緒的先後無關；
+    2. 依序套用，指令「取用」的物品 (刪除、撿起、替換) 以先到者為準，
+       例如兩個 NPC 同一批都要撿起同一把刀時，只有排在前面的成功，另一個回報衝突；
+    3. 整批在變更日誌中只遞增一次版本號。
+
+指令只透過 AI_System 的 _create_item 等方法修改世界。
+"""
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Dict, List, Optional, Tuple
+import itertools
+import threading
+
+ClaimKey = Tuple[str, str, str]  # (持有者種類, 持有者名稱, 物品名稱)
+
+_command_sequence = itertools.count(1)
+
+
+@dataclass
+class WorldCommand(ABC):
+    """修改世界的指令；套用後 result 為結果描述。"""
+    npc_name: Optional[str] = dataclass_field(default=None, kw_only=True)  # 提出指令的 NPC (用於排序與衝突回報)
+    sequence: int = dataclass_field(default_factory=lambda: next(_command_sequence), kw_only=True)
+    result: Optional[str] = dataclass_field(default=None, kw_only=True)
+
+    def claims(self, system: Any) -> Tuple[ClaimKey, ...]:
+        """這個指令會取用 (移除) 的物品；同一批中每個物品只能被取用一次。"""
+        return ()
+
+    @abstractmethod
+    def apply(self, system: Any) -> str:
+        """修改世界並回傳結果描述。"""
+
+
+@dataclass
+class CreateItem(WorldCommand):
+    item_name: str
+    description: str
+    space_name: str
+
+    def apply(self, system: Any) -> str:
+        return system._create_item(self.item_name, self.description, self.space_name)
+
+
+@dataclass
+class DeleteItem(WorldCommand):
+    item_name: str
+    space_name: Optional[str] = None
+    holder_name: Optional[str] = None  # 持有物品的 NPC
+
+    def claims(self, system: Any) -> Tuple[ClaimKey, ...]:
+        if self.space_name:
+            return (("space", self.space_name, self.item_name),)
+        return (("npc", self.holder_name, self.item_name),)
+
+    def apply(self, system: Any) -> str:
+        return system._delete_item(self.item_name, self.space_name, self.holder_name)
+
+
+@dataclass
+class ChangeItemDescription(WorldCommand):
+    item_name: str
+    new_description: str
+
+    def apply(self, system: Any) -> str:
+        return system._change_item_description(self.item_name, self.new_description)
+
+
+@dataclass
+class ReplaceItem(WorldCommand):
+    old_item_name: str
+    new_item_name: str
+    new_description: str
+    space_name: str
+
+    def claims(self, system: Any) -> Tuple[ClaimKey, ...]:
+        return (("space", self.space_name, self.old_item_name),)
+
+    def apply(self, system: Any) -> str:
+        return system._delete_and_create_new_item(self.old_item_name, self.new_item_name,
+                                                  self.new_description, self.space_name)
+
+
+@dataclass
+class MoveItemToInventory(WorldCommand):
+    item_name: str
+    target_npc_name: str
+
+    def claims(self, system: Any) -> Tuple[ClaimKey, ...]:
+        npc = system.world.get("npcs", {}).get(self.target_npc_name)
+        if npc is None or npc.current_space is None:
+            return ()
+        return (("space", npc.current_space.name, self.item_name),)
+
+    def apply(self, system: Any) -> str:
+        return system._move_item_to_inventory(self.item_name, self.target_npc_name)
+
+
+class CommandQueue:
+    """待套用的世界指令 (執行緒安全)。"""
+
+    def __init__(self):
+        self._pending: List[WorldCommand] = []
+        self._lock = threading.Lock()
+
+    def submit(self, command: WorldCommand) -> WorldCommand:
+        with self._lock:
+            self._pending.append(command)
+        return command
+
+    def drain(self) -> List[WorldCommand]:
+        """取出目前所有待套用的指令，依 (NPC 名稱, 提交順序) 排序。"""
+        with self._lock:
+            commands, self._pending = self._pending, []
+        return sorted(commands, key=lambda command: (command.npc_name or "", command.sequence))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+def _holds(system: Any, key: ClaimKey) -> bool:
+    """持有者 (空間或 NPC 的庫存) 目前是否還有這個物品。"""
+    kind, holder_name, item_name = key
+    holder = system.world.get("spaces" if kind == "space" else "npcs", {}).get(holder_name)
+    if holder is None:
+        return False
+    items = holder.items if kind == "space" else holder.inventory.items
+    return items.has(item_name)
+
+
+def apply_batch(system: Any, commands: List[WorldCommand]) -> List[Tuple[WorldCommand, str]]:
+    """
+    依序套用一批指令並解決取用衝突，回傳 (指令, 結果) 列表。
+    只有真的把物品取走的指令會佔用該物品，失敗的指令不影響後面的指令。
+    """
+    claimed: Dict[ClaimKey, WorldCommand] = {}
+    results = []
+    for command in commands:
+        conflict = None
+        keys = command.claims(system)
+        for key in keys:
+            if key in claimed:
+                conflict = claimed[key]
+                break
+        if conflict is not None:
+            winner = conflict.npc_name or "其他指令"
+            command.result = f"'{keys[0][-1]}' 已經被 {winner} 先取用了。"
+        else:
+            held = [key for key in keys if _holds(system, key)]
+            command.result = command.apply(system)
+            for key in held:
+                if not _holds(system, key):
+                    claimed[key] = command
+        results.append((command, command.result))
+    return results
@@ -0,0 +1,209 @@
+"""
+選用的 Entity-Component-System 儲存：實體是整數 id，元件以欄 (column) 的方式存成連續的 NumPy 陣列，
+讓移動、碰撞、繪製、思考等系統可以直接走訪密集陣列，而不是在互相參照的物件圖上逐一 hasattr。
+
+元件：
+    position  位置與大小 (position / size)
+    movement  移動目標、速度與半徑 (target / speed / radius)
+    space     所在空間的實體 id (space)
+    inventory 物品的持有者實體 id (owner)；NPC 的庫存即 owner 為該 NPC 的物品
+    sprite    繪製用的圖片、縮放與顏色 (sprite_path / sprite_scale / color)
+    ai        思考狀態 (thinking)
+
+儲存是選用的：build_world_from_data 不會建立，需要的系統呼叫 backend.get_entity_store(world) 時
+才以 populate_from_world 建立並存放於 world["ecs"]。原本的物件仍是權威資料，
+建立之後移動引擎與 AI_System 在狀態改變時同步對應的欄位；沒有建立時不做任何同步。
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+KIND_SPACE = 1
+KIND_ITEM = 2
+KIND_NPC = 3
+
+COMPONENTS = ("position", "movement", "space", "inventory", "sprite", "ai")
+
+
+class EntityStore:
+    """
+    實體與元件的欄式儲存。
+
+    陣列依容量預先配置，不足時加倍；刪除的實體只標記為不存在 (id 不重複使用)。
+    各元件以布林遮罩表示哪些實體擁有，query() 回傳同時擁有指定元件的實體 id 陣列。
+    """
+
+    def __init__(self, capacity: int = 64):
+        self.count = 0
+        self._capacity = 0
+        self.objects: List[Any] = []  # 實體 id -> 對應的物件 (NPC / ItemEntity / Space)
+        self.names: List[str] = []
+        self._by_key: Dict[Tuple[int, str], int] = {}  # (種類, 名稱) -> 實體 id
+        self._by_object: Dict[int, int] = {}  # id(物件) -> 實體 id
+        self._grow(max(1, capacity))
+
+    def _grow(self, capacity: int) -> None:
+        def extend(array: Optional[np.ndarray], shape: Tuple[int, ...], dtype: Any, fill: Any) -> np.ndarray:
+            grown = np.full(shape, fill, dtype=dtype)
+            if array is not None:
+                grown[:len(array)] = array
+            return grown
+
+        get = lambda name: getattr(self, name, None)
+        old_masks = getattr(self, "masks", {})
+        self.kind = extend(get("kind"), (capacity,), np.int8, 0)
+        self.alive = extend(get("alive"), (capacity,), bool, False)
+        self.masks = {name: extend(old_masks.get(name), (capacity,), bool, False) for name in COMPONENTS}
+        self.position = extend(get("position"), (capacity, 2), np.float64, np.nan)
+        self.size = extend(get("size"), (capacity, 2), np.float64, 0.0)
+        self.target = extend(get("target"), (capacity, 2), np.float64, np.nan)
+        self.speed = extend(get("speed"), (capacity,), np.float64, 0.0)
+        self.radius = extend(get("radius"), (capacity,), np.float64, 0.0)
+        self.space = extend(get("space"), (capacity,), np.int64, -1)
+        self.owner = extend(get("owner"), (capacity,), np.int64, -1)
+        self.sprite_scale = extend(get("sprite_scale"), (capacity,), np.float64, 1.0)
+        self.color = extend(get("color"), (capacity, 3), np.int16, -1)
+        self.thinking = extend(get("thinking"), (capacity,), bool, False)
+        self.sprite_path: List[Optional[str]] = (get("sprite_path") or []) + [None] * (capacity - self._capacity)
+        self._capacity = capacity
+
+    def __len__(self) -> int:
+        return int(self.alive[:self.count].sum())
+
+    # --- 實體 ---
+    def create(self, kind: int, name: str, obj: Any = None) -> int:
+        """建立實體並回傳 id (名稱索引指向最新建立的同名實體)。"""
+        if self.count == self._capacity:
+            self._grow(self._capacity * 2)
+        entity = self.count
+        self.count += 1
+        self.kind[entity] = kind
+        self.alive[entity] = True
+        self.objects.append(obj)
+        self.names.append(name)
+        self._by_key[(kind, name)] = entity
+        if obj is not None:
+            self._by_object[id(obj)] = entity
+        return entity
+
+    def destroy(self, entity: int) -> None:
+        if not (0 <= entity < self.count) or not self.alive[entity]:
+            return
+        self.alive[entity] = False
+        for mask in self.masks.values():
+            mask[entity] = False
+        if self._by_key.get((int(self.kind[entity]), self.names[entity])) == entity:
+            del self._by_key[(int(self.kind[entity]), self.names[entity])]
+        obj = self.objects[entity]
+        if obj is not None:
+            self._by_object.pop(id(obj), None)
+        self.objects[entity] = None
+
+    def entity(self, kind: int, name: str) -> Optional[int]:
+        return self._by_key.get((kind, name))
+
+    def entity_of(self, obj: Any) -> Optional[int]:
+        return self._by_object.get(id(obj))
+
+    # --- 元件 ---
+    def set_position(self, entity: int, position: Optional[Iterable[float]], size: Optional[Iterable[float]] = None) -> None:
+        if position is None:
+            self.masks["position"][entity] = False
+            return
+        self.position[entity] = list(position)[:2]
+        if size is not None:
+            self.size[entity] = list(size)[:2]
+        self.masks["position"][entity] = True
+
+    def set_movement(self, entity: int, speed: float, radius: float, target: Optional[Iterable[float]] = None) -> None:
+        self.speed[entity] = speed
+        self.radius[entity] = radius
+        self.target[entity] = list(target)[:2] if target is not None else (np.nan, np.nan)
+        self.masks["movement"][entity] = True
+
+    def set_space(self, entity: int, space_entity: Optional[int]) -> None:
+        self.space[entity] = -1 if space_entity is None else space_entity
+        self.masks["space"][entity] = space_entity is not None
+
+    def set_owner(self, entity: int, owner_entity: Optional[int]) -> None:
+        self.owner[entity] = -1 if owner_entity is None else owner_entity
+        self.masks["inventory"][entity] = owner_entity is not None
+
+    def set_sprite(self, entity: int, path: Optional[str], scale: float = 1.0,
+                   color: Optional[Iterable[int]] = None) -> None:
+        self.sprite_path[entity] = path
+        self.sprite_scale[entity] = scale
+        self.color[entity] = list(color)[:3] if color is not None else (-1, -1, -1)
+        self.masks["sprite"][entity] = True
+
+    def set_ai(self, entity: int, thinking: bool = False) -> None:
+        self.thinking[entity] = thinking
+        self.masks["ai"][entity] = True
+
+    # --- 查詢 ---
+    def query(self, *components: str, kind: Optional[int] = None) -> np.ndarray:
+        """回傳同時擁有所有指定元件 (且為指定種類) 的實體 id。"""
+        selected = self.alive[:self.count].copy()
+        for name in components:
+            selected &= self.masks[name][:self.count]
+        if kind is not None:
+            selected &= self.kind[:self.count] == kind
+        return np.nonzero(selected)[0]
+
+    def in_space(self, space_entity: int, kind: Optional[int] = None) -> np.ndarray:
+        """位於指定空間的實體 id。"""
+        ids = self.query("space", kind=kind)
+        return ids[self.space[ids] == space_entity]
+
+    def inventory_of(self, owner_entity: int) -> np.ndarray:
+        """持有者為指定實體的物品 id。"""
+        ids = self.query("inventory")
+        return ids[self.owner[ids] == owner_entity]
+
+    # --- 與物件同步 ---
+    def sync_npc(self, npc: Any) -> Optional[int]:
+        """把 NPC 物件目前的位置、移動、所在空間與思考狀態寫入對應的欄位。"""
+        entity = self.entity_of(npc)
+        if entity is None:
+            return None
+        self.set_position(entity, npc.position)
+        self.set_movement(entity, float(npc.move_speed or 0.0), float(npc.radius or 0.0), npc.move_target)
+        space = getattr(npc, "current_space", None)
+        self.set_space(entity, self.entity_of(space) if space is not None else None)
+        self.set_ai(entity, bool(getattr(npc, "is_thinking", False)))
+        return entity
+
+    def sync_item(self, item: Any, space: Any = None, owner: Any = None) -> int:
+        """加入或更新物品實體：位於 space，或由 owner (NPC) 持有。"""
+        entity = self.entity_of(item)
+        if entity is None:
+            entity = self.create(KIND_ITEM, item.name, item)
+        self.set_position(entity, getattr(item, "position", None), getattr(item, "size", None))
+        self.set_space(entity, self.entity_of(space) if space is not None else None)
+        self.set_owner(entity, self.entity_of(owner) if owner is not None else None)
+        self.set_sprite(entity, getattr(item, "image_path", None), getattr(item, "image_scale", 1.0))
+        return entity
+
+    def remove_object(self, obj: Any) -> None:
+        entity = self.entity_of(obj)
+        if entity is not None:
+            self.destroy(entity)
+
+
+def populate_from_world(spaces: Iterable[Any], npcs: Iterable[Any], store: Optional[EntityStore] = None) -> EntityStore:
+    """依空間、NPC 與它們持有的物品建立實體與元件。"""
+    store = store or EntityStore()
+    spaces = list(spaces)
+    for space in spaces:
+        entity = store.create(KIND_SPACE, space.name, space)
+        store.set_position(entity, space.display_pos, space.display_size)
+    for space in spaces:
+        for item in space.items:
+            store.sync_item(item, space=space)
+    for npc in npcs:
+        entity = store.create(KIND_NPC, npc.name, npc)
+        store.sync_npc(npc)
+        store.set_sprite(entity, getattr(npc, "image_path", None), getattr(npc, "image_scale", 1.0),
+                         getattr(npc, "display_color", None))
+        for item in npc.inventory.items:
+            store.sync_item(item, owner=npc)
+    return store
@@ -0,0 +1,159 @@
+"""
+模擬執行期使用的輕量物件 (__slots__)，與 Pydantic 的存檔/LLM 模型分開。
+
+Pydantic 模型只在邊界使用：載入世界時驗證資料後轉成執行期物件，存檔時再轉回去。
+執行期物件沒有驗證與模型機制，屬性存取就是一般的 slot 讀寫，單一物件的記憶體也小得多，
+適合數量很多 (上萬個物品) 且每幀都會讀取的資料。
+
+描述、大小、圖片等可由多個物品共用的資料放在 ItemPrototype (flyweight)，物品只保存自己的覆寫值。
+
+Pydantic 欄位可以直接註記為執行期類別 (例如 NamedIndex[ItemEntity])，
+驗證時接受執行期物件、Pydantic 模型或 dict，序列化時輸出 dict。
+"""
+from types import MappingProxyType
+from typing import Any, Dict, List, Optional
+
+from pydantic_core import core_schema
+
+
+class ItemPrototype:
+    """
+    多個物品共用的資料 (flyweight)：描述、屬性、大小與圖片。
+
+    由 prototypes.PrototypeCatalog 建立與共用；屬性是唯讀的 MappingProxyType，大小是 tuple，
+    物品要改變這些欄位時指定新的值 (例如 item.properties = {**item.properties, "lit": True})，寫入自己的覆寫值。
+    key 為型錄中的名稱 (例如 worlds/item.json 的 "sofa")，自動合併出來的匿名原型為 None。
+    """
+
+    __slots__ = ("key", "description", "properties", "size", "image_path", "image_scale")
+
+    SHARED_FIELDS = ("description", "properties", "size", "image_path", "image_scale")
+
+    def __init__(self, key: Optional[str] = None, description: str = "", properties: Optional[Dict[str, Any]] = None,
+                 size: Optional[List[int]] = None, image_path: Optional[str] = None, image_scale: float = 1.0):
+        self.key = key
+        self.description = description
+        self.properties = MappingProxyType(dict(properties or {}))
+        self.size = tuple(size) if size is not None else None
+        self.image_path = image_path
+        self.image_scale = image_scale
+
+    def __repr__(self) -> str:
+        return f"ItemPrototype(key={self.key!r}, size={self.size!r})"
+
+
+# 共用欄位未覆寫時的標記 (None 是合法的欄位值，不能當作標記)
+_INHERIT = object()
+
+_EMPTY_PROTOTYPE = ItemPrototype()
+
+
+def _shared_field(name: str) -> property:
+    """物品自己的覆寫值，沒有覆寫時讀取原型的值。"""
+    slot = "_" + name
+
+    def getter(self: "ItemEntity") -> Any:
+        value = getattr(self, slot)
+        return getattr(self.prototype, name) if value is _INHERIT else value
+
+    def setter(self: "ItemEntity", value: Any) -> None:
+        if getattr(self, slot) is _INHERIT and _same(getattr(self.prototype, name), value):
+            return  # 與原型相同，繼續共用
+        setattr(self, slot, value)
+
+    return property(getter, setter)
+
+
+class ItemEntity:
+    """
+    執行期的物品 (欄位與 backend.Item 相同)。
+
+    名稱與位置是每個物品自己的；描述、屬性、大小與圖片沒有覆寫時讀取共用的 ItemPrototype，
+    大量相同的家具只保留一份資料。
+    """
+
+    __slots__ = ("name", "position", "uid", "prototype",
+                 "_description", "_properties", "_size", "_image_path", "_image_scale", "__weakref__")
+
+    FIELDS = ("name", "description", "properties", "position", "size", "image_path", "image_scale")
+
+    description = _shared_field("description")
+    properties = _shared_field("properties")
+    size = _shared_field("size")
+    image_path = _shared_field("image_path")
+    image_scale = _shared_field("image_scale")
+
+    def __init__(self, name: str, description: Any = _INHERIT, properties: Any = _INHERIT,
+                 position: Optional[List[int]] = None, size: Any = _INHERIT,
+                 image_path: Any = _INHERIT, image_scale: Any = _INHERIT,
+                 prototype: Optional[ItemPrototype] = None):
+        self.name = name
+        self.position = list(position) if position is not None else None
+        self.uid = -1  # 載入或建立時由名稱表指定的整數 id (不存檔)
+        self.prototype = prototype if prototype is not None else _EMPTY_PROTOTYPE
+        if prototype is None and properties is _INHERIT:
+            properties = {}  # 沒有原型時每個物品有自己的屬性字典
+        self._description = description
+        self._properties = properties
+        self._size = list(size) if size is not _INHERIT and size is not None else size
+        self._image_path = image_path
+        self._image_scale = image_scale
+
+    @classmethod
+    def from_model(cls, model: Any) -> "ItemEntity":
+        """由 Pydantic 模型 (或任何具有相同屬性的物件) 建立。"""
+        return cls(**{name: getattr(model, name) for name in cls.FIELDS if hasattr(model, name)})
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ItemEntity":
+        return cls(**{name: data[name] for name in cls.FIELDS if name in data})
+
+    @classmethod
+    def from_prototype(cls, prototype: ItemPrototype, name: str, position: Optional[List[int]] = None,
+                       **overrides: Any) -> "ItemEntity":
+        """以原型建立物品；與原型相同的覆寫值會被捨棄，改為共用原型的資料。"""
+        entity = cls(name, position=position, prototype=prototype)
+        for field_name, value in overrides.items():
+            if field_name in ItemPrototype.SHARED_FIELDS and not _same(getattr(prototype, field_name), value):
+                setattr(entity, field_name, value)
+        return entity
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {name: getattr(self, name) for name in self.FIELDS}
+        data["properties"] = dict(data["properties"])
+        if data["size"] is not None:
+            data["size"] = list(data["size"])
+        return data
+
+    def overrides(self) -> Dict[str, Any]:
+        """與原型不同的共用欄位 (存檔時只需要寫這些)。"""
+        return {name: getattr(self, name) for name in ItemPrototype.SHARED_FIELDS
+                if getattr(self, "_" + name) is not _INHERIT
+                and not _same(getattr(self.prototype, name), getattr(self, name))}
+
+    def __repr__(self) -> str:
+        return f"ItemEntity(name={self.name!r}, position={self.position!r}, size={self.size!r})"
+
+    @classmethod
+    def _coerce(cls, value: Any) -> "ItemEntity":
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, dict):
+            return cls.from_dict(value)
+        if hasattr(value, "model_dump"):
+            return cls.from_model(value)
+        raise ValueError(f"無法轉換為 {cls.__name__}: {type(value).__name__}")
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source_type: Any, handler: Any) -> core_schema.CoreSchema:
+        return core_schema.no_info_plain_validator_function(
+            cls._coerce,
+            serialization=core_schema.plain_serializer_function_ser_schema(lambda entity: entity.to_dict()),
+        )
+
+
+def _same(shared: Any, value: Any) -> bool:
+    """原型的值與覆寫值是否相同 (大小在原型中是 tuple)。"""
+    if isinstance(shared, tuple) and isinstance(value, list):
+        return list(shared) == value
+    return shared == value
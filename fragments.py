@@ -0,0 +1,37 @@
+"""
+Prompt 與歷史使用的文字片段快取：空間描述 (Space.__str__)、NPC 的庫存與自我介紹。
+
+每個片段以鍵 (例如 ("space", "kitchen")) 保存上次產生時的版本與字串；版本通常由變更日誌的實體版本號
+與少量欄位組成，沒有改變時直接回傳同一個字串物件，同一個房間的多個 NPC 組 prompt 時共用同一份文字。
+讀取可在思考執行緒進行 (單一 dict 操作)；同時失效時最多重複產生一次，結果相同。
+"""
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class FragmentCache:
+    """鍵 -> (版本, 文字) 的快取。"""
+
+    def __init__(self):
+        self._entries: Dict[Hashable, Tuple[Any, str]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, version: Any, render: Callable[[], str]) -> str:
+        """版本相同時回傳快取的文字，否則呼叫 render() 產生並保存。"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        text = render()
+        self._entries[key] = (version, text)
+        return text
+
+    def discard(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
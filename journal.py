@@ -0,0 +1,95 @@
+"""
+世界的版本號與變更日誌：快取失效的共同基礎。
+
+每一條會改變世界的路徑 (建立/刪除/移動物品、NPC 換空間、空間連接與幾何改變) 都呼叫 record()，
+讓全域版本號與相關實體的版本號遞增，並在日誌中留下一筆 WorldChange。
+快取只要記住建立時的版本號：
+    - 比對 journal.version (任何變更) 或 journal.version_of(("space", "kitchen")) (某個實體的變更)；
+    - 或以 changes_since(version) 讀取之後的變更，只讓受影響的部分失效。
+也可以 subscribe() 在變更發生時立即收到通知。
+在 batch() 區塊內的多筆變更共用同一個版本號 (整批只遞增一次)，快取每批只需失效一次。
+
+實體以 (種類, 名稱) 表示，例如 ("space", "kitchen")、("item", "knife")、("npc", "neo")。
+"""
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+EntityKey = Tuple[str, str]
+
+# 日誌保留的最大筆數；更早的變更只能以版本號判斷「有變」
+DEFAULT_JOURNAL_SIZE = 4096
+
+
+@dataclass(frozen=True)
+class WorldChange:
+    version: int  # 這筆變更之後的全域版本號
+    kind: str  # 例如 "item_created"、"npc_space_changed"、"spaces_connected"
+    entities: Tuple[EntityKey, ...]  # 受影響的實體
+    details: Dict[str, Any] = dataclass_field(default_factory=dict)
+
+
+class WorldJournal:
+    """全域與各實體的版本號，以及最近的變更日誌。"""
+
+    def __init__(self, max_entries: int = DEFAULT_JOURNAL_SIZE):
+        self.version = 0
+        self._entity_versions: Dict[EntityKey, int] = {}
+        self._changes: Deque[WorldChange] = deque(maxlen=max_entries)
+        self._subscribers: List[Callable[[WorldChange], None]] = []
+        self._dropped_version = 0  # 已被擠出日誌的變更中最大的版本號
+        self._batch_depth = 0
+        self._batch_bumped = False  # 目前的批次是否已經遞增過版本號
+
+    def record(self, kind: str, *entities: EntityKey, **details: Any) -> WorldChange:
+        """
+        記錄一筆變更：全域版本號與每個受影響實體的版本號都更新為新的版本號。
+        在 batch() 內只有第一筆變更會遞增版本號，之後的變更沿用同一個版本號。
+        """
+        if not self._batch_depth or not self._batch_bumped:
+            self.version += 1
+            self._batch_bumped = bool(self._batch_depth)
+        for entity in entities:
+            self._entity_versions[entity] = self.version
+        change = WorldChange(self.version, kind, tuple(entities), details)
+        if self._changes.maxlen is not None and len(self._changes) == self._changes.maxlen:
+            self._dropped_version = self._changes[0].version
+        self._changes.append(change)
+        for subscriber in list(self._subscribers):
+            subscriber(change)
+        return change
+
+    def version_of(self, entity: EntityKey) -> int:
+        """實體最後一次變更時的全域版本號 (從未變更為 0)。"""
+        return self._entity_versions.get(entity, 0)
+
+    def changes_since(self, version: int) -> Optional[List[WorldChange]]:
+        """
+        回傳版本號 version 之後的變更 (依先後順序)。
+        日誌已經不包含那之後的全部變更時回傳 None，呼叫端應視為全部失效。
+        """
+        if version >= self.version:
+            return []
+        if not self._changes or self._dropped_version > version:
+            return None
+        return [change for change in self._changes if change.version > version]
+
+    @contextmanager
+    def batch(self) -> Iterator["WorldJournal"]:
+        """區塊內記錄的變更共用同一個版本號 (可巢狀，以最外層為準)。"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._batch_bumped = False
+
+    def subscribe(self, callback: Callable[[WorldChange], None]) -> Callable[[WorldChange], None]:
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: Callable[[WorldChange], None]) -> None:
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
@@ -0,0 +1,334 @@
+"""
+NPC 移動子系統：以連續的 NumPy 陣列保存所有 NPC 的位置、目標、速度與半徑，
+每一步以向量運算一次推進全部 NPC (包含撞牆判斷與 NPC 之間的避讓)；
+不在畫面上的 NPC 則改以 OffscreenMovement 依路徑長度解析計算位置。
+
+此模組不依賴 pygame 或 backend，只讀寫 NPC 物件的 position / move_target / move_speed / radius
+與 current_space 的 display_pos / display_size。座標一律為世界座標。
+"""
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import bisect
+import math
+import numpy as np
+from spatial import NeighborGrid
+
+DEFAULT_NPC_RADIUS = 15.0
+DEFAULT_MOVE_SPEED = 1.0
+# NPC 之間保持的額外間距 (世界座標系)
+SEPARATION_MARGIN = 2.0
+# 重疊量轉換為推開位移的比例 (每步)
+SEPARATION_STRENGTH = 0.5
+# 迎面相遇時往自己右手邊側移的比例，避免兩個 NPC 在同一直線上互相頂住
+SEPARATION_SIDESTEP = 0.5
+
+
+@dataclass
+class MovementStep:
+    """MovementSystem.step 的結果，每個陣列的第 i 列對應載入時的第 i 個 NPC。"""
+    moving: np.ndarray  # (N,) bool，有移動目標的 NPC
+    arrived: np.ndarray  # (N,) bool，這一步可直接抵達目標 (距離小於速度)
+    move: np.ndarray  # (N, 2) 這一步的位移向量 (未考慮牆壁)
+    candidate: np.ndarray  # (N, 2) 未考慮牆壁時的下一個位置
+    can_move_x: np.ndarray  # (N,) bool
+    can_move_y: np.ndarray  # (N,) bool
+    new_position: np.ndarray  # (N, 2) 套用牆壁判斷後的位置 (抵達者為目標點)
+
+
+def wall_permissions(position: np.ndarray, candidate: np.ndarray, move: np.ndarray, radius: np.ndarray,
+                     rect: np.ndarray, exit_allowed: np.ndarray, target: np.ndarray):
+    """
+    判斷每個 NPC 在 x / y 方向上的下一步是否會撞到所在空間的牆。
+
+    rect 為 (left, top, right, bottom)，沒有空間資料的列為 NaN (不受牆壁限制)。
+    exit_allowed 為 True 的 NPC 正沿 A* 路徑穿過門：只要朝著牆外的目標前進，就允許離開空間。
+    回傳 (can_move_x, can_move_y)。
+    """
+    left, top, right, bottom = rect[:, 0], rect[:, 1], rect[:, 2], rect[:, 3]
+    has_rect = ~np.isnan(left)
+    px, py = position[:, 0], position[:, 1]
+    cx, cy = candidate[:, 0], candidate[:, 1]
+    mx, my = move[:, 0], move[:, 1]
+    tx, ty = target[:, 0], target[:, 1]
+    has_target = ~np.isnan(tx)
+    exiting = exit_allowed & has_target
+
+    with np.errstate(invalid="ignore"):
+        # 只移動 x (y 維持不變) 時，NPC 的外接正方形是否仍在空間內
+        inside_x = (cx - radius >= left) & (cx + radius <= right) & (py - radius >= top) & (py + radius <= bottom)
+        exit_x = ((mx < 0) & (tx < left - 1e-6)) | ((mx > 0) & (tx > right + 1e-6))
+        hit_x = ((cx - radius < left) & (mx < 0)) | ((cx + radius > right) & (mx > 0))
+        blocked_x = ~inside_x & np.where(exiting, ~exit_x, hit_x)
+
+        inside_y = (px - radius >= left) & (px + radius <= right) & (cy - radius >= top) & (cy + radius <= bottom)
+        exit_y = ((my < 0) & (ty < top - 1e-6)) | ((my > 0) & (ty > bottom + 1e-6))
+        hit_y = ((cy - radius < top) & (my < 0)) | ((cy + radius > bottom) & (my > 0))
+        blocked_y = ~inside_y & np.where(exiting, ~exit_y, hit_y)
+
+    return ~(has_rect & blocked_x), ~(has_rect & blocked_y)
+
+
+class MovementSystem:
+    """
+    以 NumPy 陣列一次推進所有 NPC 的移動。
+
+    使用方式：每幀 load(npcs) 把物件狀態複製到陣列，step() 計算一步，
+    再由呼叫端依結果處理抵達、避障等個別邏輯，或直接以 store(npcs) 寫回位置。
+    step() 預設會加上同一空間內 NPC 之間的避讓位移 (separation_enabled = False 可關閉)。
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.position = np.zeros((0, 2))
+        self.target = np.zeros((0, 2))
+        self.speed = np.zeros(0)
+        self.radius = np.zeros(0)
+        self.rect = np.zeros((0, 4))
+        self.exit_allowed = np.zeros(0, dtype=bool)
+        self.heading = np.zeros((0, 2))  # 流場給出的前進方向 (單位向量)，NaN 表示直接朝目標前進
+        self.space_id = np.zeros(0, dtype=np.int64)  # 同一空間的 NPC 才互相避讓 (中間隔著牆)
+        self.separation_enabled = True
+
+    def _resize(self, count: int) -> None:
+        if count == self.count:
+            return
+        self.count = count
+        self.position = np.zeros((count, 2))
+        self.target = np.full((count, 2), np.nan)
+        self.speed = np.full(count, DEFAULT_MOVE_SPEED)
+        self.radius = np.full(count, DEFAULT_NPC_RADIUS)
+        self.rect = np.full((count, 4), np.nan)
+        self.exit_allowed = np.zeros(count, dtype=bool)
+        self.heading = np.full((count, 2), np.nan)
+        self.space_id = np.full(count, -1, dtype=np.int64)
+
+    def load(self, npcs: Sequence[Any], exit_allowed: Optional[Sequence[bool]] = None,
+             active: Optional[Sequence[bool]] = None,
+             headings: Optional[Sequence[Optional[Sequence[float]]]] = None) -> None:
+        """
+        從 NPC 物件載入狀態。active[i] 為 False 的 NPC 視為沒有移動目標 (例如在門口等待)。
+        headings[i] 為流場取樣得到的單位方向時，該 NPC 沿此方向前進 (繞過物品)，抵達判斷仍以 move_target 為準。
+        """
+        self._resize(len(npcs))
+        space_ids = {}
+        for i, npc in enumerate(npcs):
+            pos = npc.position
+            self.position[i] = (pos[0], pos[1]) if pos else (0.0, 0.0)
+            target = npc.move_target
+            if target and (active is None or active[i]):
+                self.target[i] = (target[0], target[1])
+            else:
+                self.target[i] = np.nan
+            speed = npc.move_speed if npc.move_speed is not None else DEFAULT_MOVE_SPEED
+            self.speed[i] = speed if speed > 0 else DEFAULT_MOVE_SPEED
+            self.radius[i] = npc.radius if npc.radius is not None else DEFAULT_NPC_RADIUS
+            space = npc.current_space
+            self.space_id[i] = space_ids.setdefault(id(space), len(space_ids)) if space is not None else -1
+            if space is not None and space.display_pos and space.display_size:
+                x, y = space.display_pos
+                w, h = space.display_size
+                self.rect[i] = (x, y, x + w, y + h)
+            else:
+                self.rect[i] = np.nan
+        self.exit_allowed[:] = exit_allowed if exit_allowed is not None else False
+        self.heading[:] = np.nan
+        if headings is not None:
+            for i, heading in enumerate(headings):
+                if heading is not None:
+                    self.heading[i] = (heading[0], heading[1])
+
+    def step(self, dt: float = 1.0) -> MovementStep:
+        """
+        計算所有 NPC 的下一步，不修改陣列中的位置 (由 apply 或呼叫端決定是否採用)。
+        dt 為時間步長 (以幀為單位)，這一步的移動距離為 move_speed * dt。
+        """
+        step_length = self.speed * dt
+        moving = ~np.isnan(self.target[:, 0])
+        delta = np.where(moving[:, None], self.target - self.position, 0.0)
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        arrived = moving & (dist < step_length)
+        safe_dist = np.where(dist > 0, dist, 1.0)
+        walking = moving & ~arrived
+        direction = np.where(np.isnan(self.heading[:, :1]), delta / safe_dist[:, None], self.heading)
+        move = np.where(walking[:, None], direction * step_length[:, None], 0.0)
+        if self.separation_enabled:
+            # 快抵達目標的 NPC 不再避讓，否則目標點被其他 NPC 站著時 (例如大家都走到房間中心) 會永遠到不了
+            settling = dist < self.radius * 2 + SEPARATION_MARGIN
+            move = move + self.separation(move, walking & ~settling, dt)
+        candidate = self.position + move
+        can_move_x, can_move_y = wall_permissions(
+            self.position, candidate, move, self.radius, self.rect, self.exit_allowed, self.target
+        )
+        new_position = np.where(
+            np.column_stack((can_move_x, can_move_y)), candidate, self.position
+        )
+        new_position = np.where(arrived[:, None], self.target, new_position)
+        return MovementStep(
+            moving=moving, arrived=arrived, move=move, candidate=candidate,
+            can_move_x=can_move_x, can_move_y=can_move_y, new_position=new_position
+        )
+
+    def separation(self, move: np.ndarray, walking: np.ndarray, dt: float = 1.0) -> np.ndarray:
+        """
+        NPC 之間的避讓位移 (只作用在正在走路的 NPC)。
+
+        以 NeighborGrid 找出同一空間內彼此重疊 (距離小於兩者半徑和 + SEPARATION_MARGIN) 的 NPC，
+        沿兩者連線推開；對方靜止時由走路的一方承擔全部位移。迎面相遇時再加上往右手邊的側移。
+        每個 NPC 的避讓位移不超過這一步的移動距離 (move_speed * dt)。
+        """
+        offsets = np.zeros_like(self.position)
+        if self.count < 2 or not walking.any():
+            return offsets
+        reach = float(self.radius.max()) * 2 + SEPARATION_MARGIN
+        i, j = NeighborGrid(reach).pairs(self.position, reach, groups=self.space_id)
+        if len(i) == 0:
+            return offsets
+        delta = self.position[i] - self.position[j]
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        overlap = self.radius[i] + self.radius[j] + SEPARATION_MARGIN - dist
+        active = (overlap > 0) & (walking[i] | walking[j])
+        if not active.any():
+            return offsets
+        i, j, delta, dist, overlap = i[active], j[active], delta[active], dist[active], overlap[active]
+        # 完全重疊時沒有方向，依索引給一個固定方向
+        normal = np.where((dist > 1e-9)[:, None], delta / np.maximum(dist, 1e-9)[:, None], np.array([1.0, 0.0]))
+        wi = walking[i].astype(float)
+        wj = walking[j].astype(float)
+        share_i = wi / (wi + wj)
+        share_j = wj / (wi + wj)
+        push = normal * (overlap * SEPARATION_STRENGTH)[:, None]
+        np.add.at(offsets, i, push * share_i[:, None])
+        np.add.at(offsets, j, -push * share_j[:, None])
+
+        # 側移：沿自己前進方向的右手邊 (螢幕座標 y 向下，右手邊為 (-dy, dx))
+        step_length = self.speed * dt
+        direction = move / np.maximum(step_length, 1e-9)[:, None]
+        right = np.column_stack((-direction[:, 1], direction[:, 0]))
+        push_size = np.hypot(offsets[:, 0], offsets[:, 1])
+        offsets += right * (push_size * SEPARATION_SIDESTEP)[:, None]
+
+        size = np.hypot(offsets[:, 0], offsets[:, 1])
+        limit = np.where(size > step_length, step_length / np.maximum(size, 1e-9), 1.0)
+        return offsets * (limit * walking)[:, None]
+
+    def apply(self, result: MovementStep) -> None:
+        self.position[:] = result.new_position
+
+    def store(self, npcs: Sequence[Any]) -> None:
+        """把陣列中的位置寫回 NPC 物件。"""
+        for npc, pos in zip(npcs, self.position.tolist()):
+            npc.position = pos
+
+
+def wall_permissions_for(position: List[float], candidate: List[float], move: List[float], radius: float,
+                         space: Any, exit_allowed: bool, target: Optional[List[float]]):
+    """單一 NPC 版本的 wall_permissions (例如避障後重新計算位移時)，回傳 (can_move_x, can_move_y)。"""
+    if space is not None and space.display_pos and space.display_size:
+        x, y = space.display_pos
+        w, h = space.display_size
+        rect = np.array([[x, y, x + w, y + h]], dtype=float)
+    else:
+        rect = np.full((1, 4), np.nan)
+    target_arr = np.array([target[:2]], dtype=float) if target else np.full((1, 2), np.nan)
+    can_x, can_y = wall_permissions(
+        np.array([position[:2]], dtype=float), np.array([candidate[:2]], dtype=float),
+        np.array([move[:2]], dtype=float), np.array([float(radius)]), rect,
+        np.array([bool(exit_allowed)]), target_arr
+    )
+    return bool(can_x[0]), bool(can_y[0])
+
+
+@dataclass
+class AnalyticTrip:
+    """
+    不在畫面上的 NPC 沿已知折線路徑的行程：不逐幀推進，而是依路徑長度與速度直接算出任一時刻的位置。
+    waypoint_spaces[k] 為抵達 points[k + 1] 之後所在的空間名稱 (最後一段為目的地空間)。
+    """
+    points: List[Tuple[float, float]]
+    waypoint_spaces: List[str]
+    speed: float
+    start_frame: int
+    tag: Any = None  # 呼叫端自訂的資料 (例如登記時的 A* 路線，用來判斷路線是否已被改變)
+    cumulative: List[float] = dataclass_field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.cumulative:
+            total = 0.0
+            self.cumulative = [0.0]
+            for a, b in zip(self.points, self.points[1:]):
+                total += math.dist(a, b)
+                self.cumulative.append(total)
+
+    @property
+    def length(self) -> float:
+        return self.cumulative[-1]
+
+    @property
+    def arrival_frame(self) -> int:
+        return self.start_frame + int(math.ceil(self.length / self.speed))
+
+    def progress(self, frame: int) -> Tuple[Tuple[float, float], int]:
+        """回傳 (第 frame 幀的位置, 已經過的路徑點數量)。"""
+        travelled = min(self.length, max(0.0, (frame - self.start_frame) * self.speed))
+        segment = bisect.bisect_right(self.cumulative, travelled) - 1
+        if segment >= len(self.points) - 1:
+            return self.points[-1], len(self.points) - 1
+        a, b = self.points[segment], self.points[segment + 1]
+        span = self.cumulative[segment + 1] - self.cumulative[segment]
+        t = (travelled - self.cumulative[segment]) / span if span > 0 else 1.0
+        return (a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t), segment
+
+
+class OffscreenMovement:
+    """
+    管理不在畫面上的 NPC 的解析式移動 (AnalyticTrip)。
+
+    NPC 的所在空間離開畫面時以 begin 登記行程，之後不再參與每幀的 MovementSystem；
+    被看見或行程結束時由 due 取出，呼叫端把 NPC 放到內插位置並恢復逐幀移動。
+    移動的 CPU 成本因此只與畫面上的 NPC 數量有關，而不是整個世界的人口。
+    """
+
+    def __init__(self):
+        self.frame = 0
+        self._trips: Dict[int, Tuple[Any, AnalyticTrip]] = {}  # id(npc) -> (npc, 行程)
+
+    def __len__(self) -> int:
+        return len(self._trips)
+
+    def __contains__(self, npc: Any) -> bool:
+        return id(npc) in self._trips
+
+    def advance(self, frames: float = 1) -> None:
+        self.frame += frames
+
+    def begin(self, npc: Any, points: List[Tuple[float, float]], waypoint_spaces: List[str],
+              tag: Any = None) -> Optional[AnalyticTrip]:
+        """登記行程 (points 以 NPC 目前位置開始)，路徑長度為 0 時不登記並回傳 None。"""
+        speed = npc.move_speed if npc.move_speed is not None and npc.move_speed > 0 else DEFAULT_MOVE_SPEED
+        trip = AnalyticTrip(points=list(points), waypoint_spaces=list(waypoint_spaces), speed=speed,
+                            start_frame=self.frame, tag=tag)
+        if trip.length <= 0:
+            return None
+        self._trips[id(npc)] = (npc, trip)
+        return trip
+
+    def trip_of(self, npc: Any) -> Optional[AnalyticTrip]:
+        entry = self._trips.get(id(npc))
+        return entry[1] if entry else None
+
+    def due(self, should_stop: Callable[[Any, Tuple[float, float]], bool]) -> List[Tuple[Any, AnalyticTrip, Tuple[float, float], int, bool]]:
+        """
+        取出已抵達、或 should_stop(npc, 內插位置) 為 True (例如位置已被看見) 的行程，
+        回傳 [(npc, 行程, 位置, 已經過的路徑點數量, 是否已抵達)]。取出的行程即結束，NPC 交回逐幀移動。
+        """
+        finished = []
+        for key, (npc, trip) in list(self._trips.items()):
+            arrived = self.frame >= trip.arrival_frame
+            position, passed = trip.progress(self.frame)
+            if arrived or should_stop(npc, position):
+                finished.append((npc, trip, position, passed, arrived))
+                del self._trips[key]
+        return finished
+
+    def cancel(self, npc: Any) -> None:
+        self._trips.pop(id(npc), None)
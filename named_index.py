@@ -0,0 +1,164 @@
+"""
+依身分 (id) 判斷成員、依名稱索引的集合：Space.items / npcs / connected_spaces 與 Inventory.items 使用。
+
+保留插入順序並可像列表一樣迭代、取索引、相加，同時維護「名稱 -> 物件」與「正規化名稱 -> 物件」索引，
+讓依名稱查找、加入、移除與 `in` 判斷都是 O(1)。成員判斷只比對身分，
+不會觸發 Pydantic 逐欄位的 __eq__ (空間 -> NPC -> 空間 的整張物件圖遞迴比較)。
+"""
+from typing import Any, Dict, Iterable, Iterator, List
+
+from pydantic_core import core_schema
+
+
+def normalize_name(name: str) -> str:
+    """比對名稱時使用的正規化形式 (忽略大小寫與前後空白)。"""
+    return name.strip().casefold()
+
+
+class NamedIndex:
+    """
+    有序的物件集合 (以 id() 保存順序，Pydantic 模型不可雜湊)。
+
+    同名的物件可以並存，名稱索引指向最早加入的那一個，與逐一掃描列表時找到的結果一致。
+    """
+
+    def __init__(self, items: Iterable[Any] = ()):
+        self._items: Dict[int, Any] = {}  # id -> 物件 (依插入順序)
+        self._by_name: Dict[str, List[Any]] = {}  # 名稱 -> 同名物件 (依插入順序)
+        self._by_key: Dict[str, List[Any]] = {}  # 正規化名稱 -> 同名物件
+        for item in items:
+            self.append(item)
+
+    # --- Pydantic：欄位註記為 NamedIndex[Item]，接受列表並序列化回列表 ---
+    def __class_getitem__(cls, item_type: Any) -> Any:
+        return _TypedNamedIndex(item_type)
+
+    # --- 名稱查找 ---
+    def get(self, name: str, default: Any = None) -> Any:
+        """依名稱 (區分大小寫) 取得物件。"""
+        matches = self._by_name.get(name)
+        return matches[0] if matches else default
+
+    def find(self, name: str, default: Any = None) -> Any:
+        """依正規化名稱 (忽略大小寫) 取得物件。"""
+        matches = self._by_key.get(normalize_name(name))
+        return matches[0] if matches else default
+
+    def has(self, name: str) -> bool:
+        return name in self._by_name
+
+    def names(self) -> List[str]:
+        return [item.name for item in self._items.values()]
+
+    # --- 列表介面 ---
+    def append(self, item: Any) -> None:
+        if id(item) in self._items:
+            return  # 同一個物件不會重複加入 (與 `if x not in lst: lst.append(x)` 相同)
+        self._items[id(item)] = item
+        self._by_name.setdefault(item.name, []).append(item)
+        self._by_key.setdefault(normalize_name(item.name), []).append(item)
+
+    def extend(self, items: Iterable[Any]) -> None:
+        for item in items:
+            self.append(item)
+
+    def insert(self, index: int, item: Any) -> None:
+        """插入到指定位置 (需要重排順序，O(n))。"""
+        items = list(self._items.values())
+        items.insert(index, item)
+        self.clear()
+        self.extend(items)
+
+    def remove(self, item: Any) -> None:
+        if self.discard(item) is None:
+            raise ValueError("NamedIndex.remove(x): x not in collection")
+
+    def discard(self, item: Any) -> Any:
+        """移除物件 (以身分比對)，回傳被移除的物件；不存在時回傳 None。"""
+        if self._items.pop(id(item), None) is None:
+            return None
+        for index, key in ((self._by_name, item.name), (self._by_key, normalize_name(item.name))):
+            matches = index.get(key)
+            if matches is None:
+                continue
+            matches[:] = [match for match in matches if match is not item]
+            if not matches:
+                del index[key]
+        return item
+
+    def remove_name(self, name: str, ignore_case: bool = False) -> Any:
+        """依名稱移除最早加入的同名物件，回傳被移除的物件；找不到時回傳 None。"""
+        item = self.find(name) if ignore_case else self.get(name)
+        return self.discard(item) if item is not None else None
+
+    def pop(self, index: int = -1) -> Any:
+        if not self._items:
+            raise IndexError("pop from empty NamedIndex")
+        item = self[index]
+        self.discard(item)
+        return item
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._by_name.clear()
+        self._by_key.clear()
+
+    def index(self, item: Any) -> int:
+        for i, existing in enumerate(self._items.values()):
+            if existing is item:
+                return i
+        raise ValueError("NamedIndex.index(x): x not in collection")
+
+    def snapshot(self) -> List[Any]:
+        """目前成員的列表複本；迭代期間需要加入或移除成員時使用。"""
+        return list(self._items.values())
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._items.values())  # 不複製；迭代期間改變成員會引發 RuntimeError，請改用 snapshot()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __contains__(self, item: Any) -> bool:
+        if isinstance(item, str):
+            return item in self._by_name
+        return id(item) in self._items
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, int):
+            if index == -1 and self._items:
+                return next(reversed(self._items.values()))
+            if index == 0 and self._items:
+                return next(iter(self._items.values()))
+        return list(self._items.values())[index]
+
+    def __add__(self, other: Iterable[Any]) -> List[Any]:
+        return list(self._items.values()) + list(other)
+
+    def __radd__(self, other: Iterable[Any]) -> List[Any]:
+        return list(other) + list(self._items.values())
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, (NamedIndex, list)):
+            return len(self) == len(other) and all(a is b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"NamedIndex({list(self._items.values())!r})"
+
+
+class _TypedNamedIndex:
+    """NamedIndex[T] 的 Pydantic 註記：以 List[T] 驗證後包成 NamedIndex。"""
+
+    def __init__(self, item_type: Any):
+        self.item_type = item_type
+
+    def __get_pydantic_core_schema__(self, source_type: Any, handler: Any) -> core_schema.CoreSchema:
+        list_schema = handler.generate_schema(List[self.item_type])
+        return core_schema.union_schema([
+            core_schema.is_instance_schema(NamedIndex),
+            core_schema.no_info_after_validator_function(NamedIndex, list_schema),
+        ], serialization=core_schema.plain_serializer_function_ser_schema(list, return_schema=list_schema))
@@ -0,0 +1,78 @@
+"""
+空間、物品與 NPC 的整數 id 與名稱表。
+
+載入世界時每個實體取得一個穩定的整數 id (物件的 uid 屬性)，名稱以 sys.intern 保存一份標準字串；
+正規化名稱 (忽略大小寫與前後空白) 對應到 id 的查找表取代各處的 `.lower()` 比較。
+熱路徑 (例如「是否已在目標空間」、「找對話對象」) 先把輸入解析成 id，之後只比較整數。
+
+種類與變更日誌相同，以字串 "space"、"item"、"npc" 表示。
+"""
+from typing import Dict, List, Optional, Tuple
+import sys
+
+from named_index import normalize_name
+
+NO_ID = -1  # 尚未登記的實體
+
+
+class NameTable:
+    """
+    整數 id <-> (種類, 標準名稱) 的雙向表。
+
+    id 依登記順序遞增且不重複使用；同名的實體各自有 id，名稱查找指向最早登記且仍存在的那一個。
+    """
+
+    def __init__(self):
+        self._names: List[str] = []  # id -> 標準名稱
+        self._kinds: List[str] = []  # id -> 種類
+        self._alive: List[bool] = []
+        self._by_name: Dict[Tuple[str, str], List[int]] = {}  # (種類, 名稱) -> id
+        self._by_key: Dict[Tuple[str, str], List[int]] = {}  # (種類, 正規化名稱) -> id
+
+    def __len__(self) -> int:
+        return sum(self._alive)
+
+    def register(self, kind: str, name: str) -> int:
+        """登記一個實體並回傳新的 id。"""
+        name = sys.intern(name)
+        uid = len(self._names)
+        self._names.append(name)
+        self._kinds.append(kind)
+        self._alive.append(True)
+        self._by_name.setdefault((kind, name), []).append(uid)
+        self._by_key.setdefault((kind, normalize_name(name)), []).append(uid)
+        return uid
+
+    def release(self, uid: int) -> None:
+        """實體被刪除時移除它的名稱對應 (id 不會再被使用)。"""
+        if not (0 <= uid < len(self._names)) or not self._alive[uid]:
+            return
+        self._alive[uid] = False
+        kind, name = self._kinds[uid], self._names[uid]
+        for table, key in ((self._by_name, (kind, name)), (self._by_key, (kind, normalize_name(name)))):
+            ids = table.get(key)
+            if ids is not None:
+                ids.remove(uid)
+                if not ids:
+                    del table[key]
+
+    def id_of(self, kind: str, name: str) -> Optional[int]:
+        """依標準名稱 (區分大小寫) 取得 id。"""
+        ids = self._by_name.get((kind, name))
+        return ids[0] if ids else None
+
+    def resolve(self, kind: str, text: str) -> Optional[int]:
+        """把使用者或 LLM 輸入的名稱 (忽略大小寫) 解析成 id。"""
+        ids = self._by_key.get((kind, normalize_name(text)))
+        return ids[0] if ids else None
+
+    def name_of(self, uid: int) -> str:
+        return self._names[uid]
+
+    def kind_of(self, uid: int) -> str:
+        return self._kinds[uid]
+
+    def canonical(self, kind: str, text: str) -> Optional[str]:
+        """輸入名稱對應的標準名稱 (intern 過的字串)；找不到時回傳 None。"""
+        uid = self.resolve(kind, text)
+        return self._names[uid] if uid is not None else None
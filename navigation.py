@@ -0,0 +1,1121 @@
+"""
+導航相關工具：門的幾何計算與門戶圖 (portal graph)。
+
+門戶圖以「門的中點」為節點，同一空間內兩扇門之間的實際步行距離為邊，
+在地圖載入時建立一次，供 backend 的路徑規劃與 pygame 的牆壁/門繪製共用。
+"""
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import heapq
+import math
+import multiprocessing
+import os
+
+# 空間邊緣對齊的容差 (世界座標系)
+CONNECTION_TOLERANCE_WORLD_UNITS = 20.0
+# 門的寬度/高度 (開口大小)
+DOOR_WIDTH_WORLD_UNITS = 15.0
+# 沒有幾何相鄰時，仍視為相鄰的最大間距 (沿用 NPC._find_connection_point 的 30px 容差)
+FALLBACK_ADJACENCY_TOLERANCE = 30.0
+# 穿過沒有實體門的連接 (JSON 中相連但幾何上不相鄰) 的額外成本，讓路線優先走真正的門
+VIRTUAL_PORTAL_PENALTY = 200.0
+# 空間數量達到此值時建立階層式 (HPA*) 路徑規劃
+HPA_MIN_SPACES = 50
+# 空間沒有指定 cluster 時，依中心點所在的方格自動分群 (世界座標系)
+CLUSTER_CELL_SIZE = 1000.0
+# 門預約前後額外保留的步數，避免兩個 NPC 在門口貼身交錯
+DOOR_RESERVATION_MARGIN = 4.0
+# 批次路徑查詢少於此數量時直接在目前執行緒計算 (行程間傳遞的成本高於 A* 本身)
+ROUTE_BATCH_MIN_PARALLEL = 32
+# 同一批次中前往同一空間的 NPC 達到此數量時，改用共用的路線場 (一次 Dijkstra) 取代逐一 A*
+FLOW_FIELD_MIN_GROUP = 8
+
+Point = Tuple[float, float]
+
+
+def _space_rect(space: Any) -> Optional[Tuple[float, float, float, float]]:
+    """回傳空間的 (left, top, right, bottom)，缺少位置資訊時回傳 None。"""
+    pos = getattr(space, "display_pos", None)
+    size = getattr(space, "display_size", None)
+    if not pos or not size:
+        return None
+    return (float(pos[0]), float(pos[1]), float(pos[0] + size[0]), float(pos[1] + size[1]))
+
+
+def space_center(space: Any) -> Point:
+    """計算空間中心點，缺少位置資訊時回傳 (0, 0)。"""
+    rect = _space_rect(space)
+    if rect is None:
+        return (0.0, 0.0)
+    return ((rect[0] + rect[2]) / 2, (rect[1] + rect[3]) / 2)
+
+
+def door_center(door: Dict[str, Any]) -> Point:
+    """計算門開口的中點 (世界座標)。"""
+    mid = (door["opening_start_world"] + door["opening_end_world"]) / 2
+    if door["type"] == "vertical":
+        return (float(door["wall_x_world"]), float(mid))
+    return (float(mid), float(door["wall_y_world"]))
+
+
+def compute_door(s1: Any, s2: Any) -> Optional[Dict[str, Any]]:
+    """
+    根據兩個空間的矩形計算它們之間的門。
+
+    兩個空間的邊緣需在 CONNECTION_TOLERANCE_WORLD_UNITS 內對齊，
+    且重疊長度至少為 DOOR_WIDTH_WORLD_UNITS，門開在重疊區段的中央。
+    找不到門時回傳 None。
+    """
+    r1 = _space_rect(s1)
+    r2 = _space_rect(s2)
+    if r1 is None or r2 is None:
+        return None
+    left1, top1, right1, bottom1 = r1
+    left2, top2, right2, bottom2 = r2
+
+    def vertical_door(wall_x, s1_edge, s2_edge):
+        overlap_start = max(top1, top2)
+        overlap_end = min(bottom1, bottom2)
+        if overlap_end - overlap_start < DOOR_WIDTH_WORLD_UNITS:
+            return None
+        mid = (overlap_start + overlap_end) / 2
+        return {
+            "s1_name": s1.name, "s2_name": s2.name, "type": "vertical",
+            "wall_x_world": wall_x,
+            "opening_start_world": mid - DOOR_WIDTH_WORLD_UNITS / 2,
+            "opening_end_world": mid + DOOR_WIDTH_WORLD_UNITS / 2,
+            "s1_edge_name": s1_edge, "s2_edge_name": s2_edge
+        }
+
+    def horizontal_door(wall_y, s1_edge, s2_edge):
+        overlap_start = max(left1, left2)
+        overlap_end = min(right1, right2)
+        if overlap_end - overlap_start < DOOR_WIDTH_WORLD_UNITS:
+            return None
+        mid = (overlap_start + overlap_end) / 2
+        return {
+            "s1_name": s1.name, "s2_name": s2.name, "type": "horizontal",
+            "wall_y_world": wall_y,
+            "opening_start_world": mid - DOOR_WIDTH_WORLD_UNITS / 2,
+            "opening_end_world": mid + DOOR_WIDTH_WORLD_UNITS / 2,
+            "s1_edge_name": s1_edge, "s2_edge_name": s2_edge
+        }
+
+    # 與原本 pygame_display 的判斷順序一致：右、左、下、上
+    if abs(right1 - left2) < CONNECTION_TOLERANCE_WORLD_UNITS:
+        return vertical_door(right1, "right", "left")
+    if abs(left1 - right2) < CONNECTION_TOLERANCE_WORLD_UNITS:
+        return vertical_door(left1, "left", "right")
+    if abs(bottom1 - top2) < CONNECTION_TOLERANCE_WORLD_UNITS:
+        return horizontal_door(bottom1, "bottom", "top")
+    if abs(top1 - bottom2) < CONNECTION_TOLERANCE_WORLD_UNITS:
+        return horizontal_door(top1, "top", "bottom")
+    return None
+
+
+def fallback_connection_point(s1: Any, s2: Any) -> Optional[Point]:
+    """
+    沒有門時的連接點：重疊區域中心、30px 內相鄰邊的中點，否則兩空間中心的中點。
+    """
+    r1 = _space_rect(s1)
+    r2 = _space_rect(s2)
+    if r1 is None or r2 is None:
+        return None
+    left1, top1, right1, bottom1 = r1
+    left2, top2, right2, bottom2 = r2
+
+    overlap_x1, overlap_y1 = max(left1, left2), max(top1, top2)
+    overlap_x2, overlap_y2 = min(right1, right2), min(bottom1, bottom2)
+    if overlap_x2 > overlap_x1 and overlap_y2 > overlap_y1:
+        return ((overlap_x1 + overlap_x2) / 2, (overlap_y1 + overlap_y2) / 2)
+
+    tolerance = FALLBACK_ADJACENCY_TOLERANCE
+    if (abs(right1 - left2) < tolerance or abs(right2 - left1) < tolerance) and overlap_y2 > overlap_y1:
+        middle_y = (overlap_y1 + overlap_y2) / 2
+        if abs(right1 - left2) < tolerance:
+            return ((right1 + left2) / 2, middle_y)
+        return ((right2 + left1) / 2, middle_y)
+    if (abs(bottom1 - top2) < tolerance or abs(bottom2 - top1) < tolerance) and overlap_x2 > overlap_x1:
+        middle_x = (overlap_x1 + overlap_x2) / 2
+        if abs(bottom1 - top2) < tolerance:
+            return (middle_x, (bottom1 + top2) / 2)
+        return (middle_x, (bottom2 + top1) / 2)
+
+    c1 = space_center(s1)
+    c2 = space_center(s2)
+    return ((c1[0] + c2[0]) / 2, (c1[1] + c2[1]) / 2)
+
+
+def pair_key(a: str, b: str) -> Tuple[str, str]:
+    """空間對的無向鍵。"""
+    return (a, b) if a <= b else (b, a)
+
+
+@dataclass
+class Portal:
+    """門戶圖中的節點：兩個相連空間之間的一個通道。"""
+    index: int
+    spaces: Tuple[str, str]
+    point: Point
+    door: Optional[Dict[str, Any]] = None  # None 表示空間相連但幾何上沒有可繪製的門
+    crossing_cost: float = 0.0
+
+    def other_side(self, space_name: str) -> str:
+        return self.spaces[1] if self.spaces[0] == space_name else self.spaces[0]
+
+
+@dataclass
+class PortalRoute:
+    """門戶圖查詢結果。"""
+    spaces: List[str]  # 依序經過的空間名稱 (含起點與終點)
+    waypoints: List[Point]  # 依序經過的門中點
+    cost: float
+    portals: List[int] = dataclass_field(default_factory=list)  # 依序穿過的門 (Portal.index)
+    crossing_times: List[float] = dataclass_field(default_factory=list)  # 協同規劃時，預計穿過每扇門的時間 (步數)
+
+
+@dataclass
+class PortalGraph:
+    """
+    以門中點為節點、空間內步行距離為邊的導航圖。
+
+    使用 PortalGraph.from_spaces(...) 從地圖幾何建立一次，之後查詢只需走訪門節點。
+    """
+    portals: List[Portal] = dataclass_field(default_factory=list)
+    doors: List[Dict[str, Any]] = dataclass_field(default_factory=list)  # 只包含幾何上可繪製的門 (供 renderer 使用)
+    portals_by_space: Dict[str, List[int]] = dataclass_field(default_factory=dict)
+    portal_by_pair: Dict[Tuple[str, str], int] = dataclass_field(default_factory=dict)
+    edges: Dict[Tuple[int, str], List[Tuple[int, float]]] = dataclass_field(default_factory=dict)
+    space_rects: Dict[str, Tuple[float, float, float, float]] = dataclass_field(default_factory=dict)
+    hierarchy: Optional["HierarchicalPortalGraph"] = None  # 大型地圖的階層式規劃器
+    topology_version: int = 0  # 建立時的空間拓撲版本，由呼叫端設定，用來判斷是否需要重建
+    route_fields: Dict[Tuple[str, Point], "RouteField"] = dataclass_field(default_factory=dict)  # (目標空間, 目標點) -> 路線場
+
+    @classmethod
+    def from_spaces(cls, spaces: Iterable[Any]) -> "PortalGraph":
+        """
+        從空間物件 (需有 connected_spaces) 建立門戶圖。
+        空間數量達到 HPA_MIN_SPACES 時另外建立階層式規劃器，find_route 會交由它處理。
+        """
+        graph = cls()
+        space_list = list(spaces)
+        space_map = {s.name: s for s in space_list}
+        for s in space_list:
+            graph.portals_by_space.setdefault(s.name, [])
+            rect = _space_rect(s)
+            if rect is not None:
+                graph.space_rects[s.name] = rect
+
+        for s1 in space_list:
+            for connected in getattr(s1, "connected_spaces", None) or []:
+                s2_name = connected if isinstance(connected, str) else getattr(connected, "name", None)
+                s2 = space_map.get(s2_name)
+                if s2 is None or s2.name == s1.name:
+                    continue
+                key = pair_key(s1.name, s2.name)
+                if key in graph.portal_by_pair:
+                    continue
+                door = compute_door(s1, s2)
+                if door:
+                    point = door_center(door)
+                    graph.doors.append(door)
+                else:
+                    point = fallback_connection_point(s1, s2)
+                    if point is None:
+                        continue
+                portal = Portal(
+                    index=len(graph.portals), spaces=(s1.name, s2.name), point=point, door=door,
+                    crossing_cost=0.0 if door else VIRTUAL_PORTAL_PENALTY
+                )
+                graph.portals.append(portal)
+                graph.portal_by_pair[key] = portal.index
+                graph.portals_by_space[s1.name].append(portal.index)
+                graph.portals_by_space[s2.name].append(portal.index)
+
+        # 同一空間內的每對門之間建立邊，成本為直線步行距離 (空間為凸矩形)
+        # 鍵為 (門, 所在空間)：從該門進入此空間後可前往的其他門
+        for space_name, portal_ids in graph.portals_by_space.items():
+            for i in portal_ids:
+                graph.edges[(i, space_name)] = [
+                    (j, math.dist(graph.portals[i].point, graph.portals[j].point) + graph.portals[j].crossing_cost)
+                    for j in portal_ids if j != i
+                ]
+
+        if len(space_list) >= HPA_MIN_SPACES:
+            graph.hierarchy = HierarchicalPortalGraph(graph, assign_clusters(space_list))
+        return graph
+
+    def rebuild(self, spaces: Iterable[Any], topology_version: int = 0) -> None:
+        """空間的連接或位置/大小改變後就地重建，持有同一物件的 renderer 與 backend 會一起更新。"""
+        fresh = type(self).from_spaces(spaces)
+        fresh.topology_version = topology_version
+        self.__dict__.update(fresh.__dict__)
+
+    def get_door(self, space_a: str, space_b: str) -> Optional[Dict[str, Any]]:
+        """取得兩個空間之間可繪製的門 (沒有則回傳 None)。"""
+        idx = self.portal_by_pair.get(pair_key(space_a, space_b))
+        return self.portals[idx].door if idx is not None else None
+
+    def portal_index(self, space_a: str, space_b: str) -> Optional[int]:
+        """取得兩個空間之間的門的索引 (Portal.index)，不相連時回傳 None。"""
+        return self.portal_by_pair.get(pair_key(space_a, space_b))
+
+    def connection_point(self, space_a: str, space_b: str) -> Optional[Point]:
+        """取得兩個空間之間的連接點 (門中點或後備連接點)。"""
+        idx = self.portal_by_pair.get(pair_key(space_a, space_b))
+        return self.portals[idx].point if idx is not None else None
+
+    def anchor(self, space_name: str, pos: Optional[Point]) -> Point:
+        """路線的起訖點：有位置就用位置，否則使用空間中心。"""
+        if pos is not None:
+            return (float(pos[0]), float(pos[1]))
+        rect = self.space_rects.get(space_name)
+        if rect is None:
+            return (0.0, 0.0)
+        return ((rect[0] + rect[2]) / 2, (rect[1] + rect[3]) / 2)
+
+    def start_states(self, space_name: str, anchor: Point) -> List[Tuple[Tuple[int, str], float]]:
+        """從空間內某一點出發，穿過該空間每一扇門後的搜尋狀態與成本。"""
+        return [
+            ((pid, self.portals[pid].other_side(space_name)),
+             math.dist(anchor, self.portals[pid].point) + self.portals[pid].crossing_cost)
+            for pid in self.portals_by_space.get(space_name, [])
+        ]
+
+    def search_states(self, sources: List[Tuple[Tuple[int, str], float]], allowed_spaces: set):
+        """
+        從 sources 出發的 Dijkstra，只在 allowed_spaces 內展開。
+        穿出 allowed_spaces 的狀態仍會記錄成本，但不再往外展開。
+        回傳 (g_score, came_from)，狀態為 (門, 穿過門之後所在的空間)。
+        """
+        g_score: Dict[Tuple[int, str], float] = {}
+        came_from: Dict[Tuple[int, str], Tuple[int, str]] = {}
+        heap: List[Tuple[float, int, str]] = []
+        for state, cost in sources:
+            if cost < g_score.get(state, math.inf):
+                g_score[state] = cost
+                heapq.heappush(heap, (cost, state[0], state[1]))
+        closed = set()
+        while heap:
+            cost, pid, side = heapq.heappop(heap)
+            state = (pid, side)
+            if state in closed:
+                continue
+            closed.add(state)
+            if side not in allowed_spaces:
+                continue
+            for neighbor, edge_cost in self.edges.get(state, []):
+                next_state = (neighbor, self.portals[neighbor].other_side(side))
+                tentative = cost + edge_cost
+                if tentative < g_score.get(next_state, math.inf):
+                    g_score[next_state] = tentative
+                    came_from[next_state] = state
+                    heapq.heappush(heap, (tentative, neighbor, next_state[1]))
+        return g_score, came_from
+
+    def route_from_portals(self, start_space: str, portal_chain: List[int], cost: float,
+                           crossing_times: Optional[List[float]] = None) -> PortalRoute:
+        """依序穿過 portal_chain 中的門，組成 PortalRoute。"""
+        route_spaces = [start_space]
+        for pid in portal_chain:
+            route_spaces.append(self.portals[pid].other_side(route_spaces[-1]))
+        return PortalRoute(
+            spaces=route_spaces,
+            waypoints=[self.portals[pid].point for pid in portal_chain],
+            cost=cost,
+            portals=list(portal_chain),
+            crossing_times=list(crossing_times or [])
+        )
+
+    def find_route(self, start_space: str, goal_space: str,
+                   start_pos: Optional[Point] = None, goal_pos: Optional[Point] = None,
+                   reservations: Optional["DoorReservationTable"] = None, owner: Optional[str] = None,
+                   speed: float = 1.0, hold: float = 0.0) -> Optional[PortalRoute]:
+        """
+        使用 A* 在門戶圖上尋找路線。
+
+        起點與終點以臨時節點接到各自空間的門上；未提供位置時使用空間中心。
+        大型地圖會改用階層式規劃器。找不到路徑時回傳 None。
+
+        提供 reservations 時改為時空協同規劃：成本以步數計 (距離 / speed)，
+        門已被其他 NPC 預約的時段必須等待，因此可能改走較遠但空著的門。
+        hold 為此 NPC 通過一扇門需要佔用的步數。結果的 crossing_times 可直接交給 reserve_route。
+        """
+        if start_space not in self.portals_by_space or goal_space not in self.portals_by_space:
+            return None
+        start = self.anchor(start_space, start_pos)
+        goal = self.anchor(goal_space, goal_pos)
+        if start_space == goal_space:
+            return PortalRoute(spaces=[start_space], waypoints=[], cost=math.dist(start, goal))
+        if self.hierarchy is not None and reservations is None:
+            # 階層式的預先計算成本不含時間，協同規劃一律使用平面搜尋
+            return self.hierarchy.find_route(start_space, goal_space, start, goal)
+
+        # 協同規劃時 g 為絕對時間 (步數)，穿過已預約的門需要等到空檔
+        scale = 1.0 / speed if reservations is not None and speed > 0 else 1.0
+        g_start = reservations.now if reservations is not None else 0.0
+
+        def cross(pid: int, t: float) -> float:
+            if reservations is None:
+                return t
+            return reservations.earliest_slot(pid, t, hold, owner)
+
+        # 搜尋狀態為 (門, 穿過門之後所在的空間)，同一扇門可從兩側穿越
+        open_set: List[Tuple[float, int, str]] = []
+        g_score: Dict[Tuple[int, str], float] = {}
+        came_from: Dict[Tuple[int, str], Tuple[int, str]] = {}
+
+        for pid in self.portals_by_space[start_space]:
+            state = (pid, self.portals[pid].other_side(start_space))
+            cost = cross(pid, g_start + (math.dist(start, self.portals[pid].point) + self.portals[pid].crossing_cost) * scale)
+            if cost < g_score.get(state, math.inf):
+                g_score[state] = cost
+                heapq.heappush(open_set, (cost + math.dist(self.portals[pid].point, goal) * scale, pid, state[1]))
+
+        best_goal_cost = math.inf
+        best_goal_state = None
+        closed = set()
+        while open_set:
+            f, pid, side = heapq.heappop(open_set)
+            if f >= best_goal_cost:
+                break
+            state = (pid, side)
+            if state in closed:
+                continue
+            closed.add(state)
+            point = self.portals[pid].point
+            if side == goal_space:
+                total = g_score[state] + math.dist(point, goal) * scale
+                if total < best_goal_cost:
+                    best_goal_cost = total
+                    best_goal_state = state
+                continue
+            for neighbor, edge_cost in self.edges.get(state, []):
+                next_state = (neighbor, self.portals[neighbor].other_side(side))
+                tentative = cross(neighbor, g_score[state] + edge_cost * scale)
+                if tentative < g_score.get(next_state, math.inf):
+                    g_score[next_state] = tentative
+                    came_from[next_state] = state
+                    heapq.heappush(open_set, (tentative + math.dist(self.portals[neighbor].point, goal) * scale, neighbor, next_state[1]))
+
+        if best_goal_state is None:
+            return None
+
+        state_chain = [best_goal_state]
+        while state_chain[-1] in came_from:
+            state_chain.append(came_from[state_chain[-1]])
+        state_chain.reverse()
+
+        crossing_times = [g_score[state] for state in state_chain] if reservations is not None else None
+        return self.route_from_portals(start_space, [pid for pid, _ in state_chain], best_goal_cost - g_start, crossing_times)
+
+    def route_field(self, goal_space: str, goal_pos: Optional[Point] = None) -> Optional["RouteField"]:
+        """
+        取得前往 goal_space 的路線場 (第一次使用時建立並快取，門戶圖重建時一併清除)。
+
+        從目標反向做一次 Dijkstra，記錄每個狀態 (門, 穿過門之後所在的空間) 到目標的剩餘成本與下一扇門，
+        之後任何起點的路線都只需沿著「下一扇門」走，不需要再搜尋。成本與 find_route 的平面搜尋相同。
+        """
+        if goal_space not in self.portals_by_space:
+            return None
+        goal = self.anchor(goal_space, goal_pos)
+        key = (goal_space, goal)
+        field = self.route_fields.get(key)
+        if field is not None:
+            return field
+
+        cost_to_go: Dict[Tuple[int, str], float] = {}
+        next_state: Dict[Tuple[int, str], Tuple[int, str]] = {}
+        heap: List[Tuple[float, int, str]] = []
+        for pid in self.portals_by_space[goal_space]:
+            state = (pid, goal_space)
+            cost_to_go[state] = math.dist(self.portals[pid].point, goal)
+            heapq.heappush(heap, (cost_to_go[state], pid, goal_space))
+        closed = set()
+        while heap:
+            cost, pid, side = heapq.heappop(heap)
+            state = (pid, side)
+            if state in closed:
+                continue
+            closed.add(state)
+            # 能走到 state 的前一個狀態：在門的另一側空間，從該空間的其他門進入後走到這扇門
+            prev_side = self.portals[pid].other_side(side)
+            step_cost = self.portals[pid].crossing_cost
+            for prev_pid in self.portals_by_space.get(prev_side, []):
+                if prev_pid == pid:
+                    continue
+                prev_state = (prev_pid, prev_side)
+                tentative = cost + math.dist(self.portals[prev_pid].point, self.portals[pid].point) + step_cost
+                if tentative < cost_to_go.get(prev_state, math.inf):
+                    cost_to_go[prev_state] = tentative
+                    next_state[prev_state] = state
+                    heapq.heappush(heap, (tentative, prev_pid, prev_side))
+
+        field = RouteField(goal_space=goal_space, goal=goal, cost_to_go=cost_to_go, next_state=next_state)
+        self.route_fields[key] = field
+        return field
+
+    def route_by_field(self, start_space: str, goal_space: str,
+                       start_pos: Optional[Point] = None, goal_pos: Optional[Point] = None) -> Optional[PortalRoute]:
+        """以共用的路線場取得路線：只比較起點空間的每扇門，再沿著路線場走到目標。"""
+        if start_space not in self.portals_by_space or goal_space not in self.portals_by_space:
+            return None
+        start = self.anchor(start_space, start_pos)
+        field = self.route_field(goal_space, goal_pos)
+        if start_space == goal_space:
+            return PortalRoute(spaces=[start_space], waypoints=[], cost=math.dist(start, field.goal))
+        best_cost = math.inf
+        best_state = None
+        for state, cost in self.start_states(start_space, start):
+            remaining = field.cost_to_go.get(state)
+            if remaining is not None and cost + remaining < best_cost:
+                best_cost = cost + remaining
+                best_state = state
+        if best_state is None:
+            return None
+        chain = [best_state[0]]
+        state = best_state
+        while state in field.next_state:
+            state = field.next_state[state]
+            chain.append(state[0])
+        return self.route_from_portals(start_space, chain, best_cost)
+
+
+@dataclass
+class RouteField:
+    """PortalGraph.route_field 的結果：所有狀態到同一個目標的剩餘成本與下一個狀態。"""
+    goal_space: str
+    goal: Point
+    cost_to_go: Dict[Tuple[int, str], float]
+    next_state: Dict[Tuple[int, str], Tuple[int, str]]  # 沒有下一個狀態表示已在目標空間
+
+
+# --- 階層式路徑規劃 (HPA*) ---
+
+def assign_clusters(spaces: Iterable[Any]) -> Dict[str, str]:
+    """
+    決定每個空間所屬的群組 (例如一棟建築的一個樓層)。
+    優先使用空間的 cluster 屬性，否則依空間中心所在的 CLUSTER_CELL_SIZE 方格分群。
+    """
+    cluster_of = {}
+    for space in spaces:
+        cluster = getattr(space, "cluster", None)
+        if not cluster:
+            cx, cy = space_center(space)
+            cluster = f"grid_{int(cx // CLUSTER_CELL_SIZE)}_{int(cy // CLUSTER_CELL_SIZE)}"
+        cluster_of[space.name] = cluster
+    return cluster_of
+
+
+def _portal_chain(came_from: Dict[Tuple[int, str], Tuple[int, str]], state: Tuple[int, str]) -> List[int]:
+    """沿 came_from 回溯到搜尋起點，回傳依序穿過的門。"""
+    chain = [state[0]]
+    while state in came_from:
+        state = came_from[state]
+        chain.append(state[0])
+    chain.reverse()
+    return chain
+
+
+class HierarchicalPortalGraph:
+    """
+    門戶圖上的階層式規劃器 (HPA*)。
+
+    空間被分成群組，群組之間的門稱為入口。建立時預先計算每個群組內
+    入口到入口的最短距離與門序列；查詢時只在起點與終點所在的群組內做局部搜尋，
+    其餘部分在入口組成的抽象圖上搜尋，最後套用預先計算好的門序列還原完整路線。
+    """
+
+    def __init__(self, graph: PortalGraph, cluster_of: Dict[str, str]):
+        self.graph = graph
+        self.cluster_of = cluster_of
+        self.spaces_in_cluster: Dict[str, set] = {}
+        for space_name, cluster in cluster_of.items():
+            self.spaces_in_cluster.setdefault(cluster, set()).add(space_name)
+
+        # 每個群組的入口：(門, 此門在群組內那一側的空間)
+        self.entrances: Dict[str, List[Tuple[int, str]]] = {cluster: [] for cluster in self.spaces_in_cluster}
+        for portal in graph.portals:
+            a, b = portal.spaces
+            if cluster_of.get(a) != cluster_of.get(b):
+                self.entrances[cluster_of[a]].append((portal.index, a))
+                self.entrances[cluster_of[b]].append((portal.index, b))
+
+        # (入口, 出口, 群組) -> (成本, 入口之後依序穿過的門，含出口)
+        self.intra: Dict[Tuple[int, int, str], Tuple[float, List[int]]] = {}
+        for cluster, entrance_list in self.entrances.items():
+            allowed = self.spaces_in_cluster[cluster]
+            for pid, inside in entrance_list:
+                g_score, came_from = graph.search_states([((pid, inside), 0.0)], allowed)
+                for exit_pid, exit_inside in entrance_list:
+                    exit_state = (exit_pid, graph.portals[exit_pid].other_side(exit_inside))
+                    if exit_pid == pid or exit_state not in g_score:
+                        continue
+                    chain = _portal_chain(came_from, exit_state)
+                    self.intra[(pid, exit_pid, cluster)] = (g_score[exit_state], chain[1:])
+
+    def find_route(self, start_space: str, goal_space: str, start: Point, goal: Point) -> Optional[PortalRoute]:
+        """在抽象圖上尋找 start_space 到 goal_space 的路線，結果與平面 A* 相同格式。"""
+        graph = self.graph
+        start_cluster = self.cluster_of.get(start_space)
+        goal_cluster = self.cluster_of.get(goal_space)
+        if start_cluster is None or goal_cluster is None:
+            return None
+
+        best_cost = math.inf
+        best_chain: Optional[List[int]] = None
+
+        # 起點群組內的局部搜尋；同一群組時可能不必離開群組就能抵達終點
+        start_g, start_came = graph.search_states(graph.start_states(start_space, start), self.spaces_in_cluster[start_cluster])
+        if start_cluster == goal_cluster:
+            for state, cost in start_g.items():
+                if state[1] == goal_space:
+                    total = cost + math.dist(graph.portals[state[0]].point, goal)
+                    if total < best_cost:
+                        best_cost = total
+                        best_chain = _portal_chain(start_came, state)
+
+        # 終點群組內的反向局部搜尋：從入口走到終點的成本
+        goal_g, goal_came = graph.search_states(graph.start_states(goal_space, goal), self.spaces_in_cluster[goal_cluster])
+        goal_entry_cost: Dict[int, float] = {}
+        for pid, inside in self.entrances.get(goal_cluster, []):
+            state = (pid, graph.portals[pid].other_side(inside))
+            if state in goal_g:
+                # 反向搜尋已計入入口的穿越成本，抽象圖抵達入口時也計入了一次，扣掉重複的部分
+                goal_entry_cost[pid] = goal_g[state] - graph.portals[pid].crossing_cost
+
+        # 抽象圖節點：(入口, 穿過入口後所在的群組)
+        open_set: List[Tuple[float, int, str]] = []
+        abstract_g: Dict[Tuple[int, str], float] = {}
+        abstract_came: Dict[Tuple[int, str], Tuple[int, str]] = {}
+        for pid, inside in self.entrances.get(start_cluster, []):
+            exit_state = (pid, graph.portals[pid].other_side(inside))
+            if exit_state not in start_g:
+                continue
+            node = (pid, self.cluster_of[exit_state[1]])
+            abstract_g[node] = start_g[exit_state]
+            heapq.heappush(open_set, (abstract_g[node] + math.dist(graph.portals[pid].point, goal), pid, node[1]))
+
+        best_node = None
+        closed = set()
+        while open_set:
+            f, pid, cluster = heapq.heappop(open_set)
+            if f >= best_cost:
+                break
+            node = (pid, cluster)
+            if node in closed:
+                continue
+            closed.add(node)
+            cost = abstract_g[node]
+            if cluster == goal_cluster and pid in goal_entry_cost:
+                total = cost + goal_entry_cost[pid]
+                if total < best_cost:
+                    best_cost = total
+                    best_node = node
+                    best_chain = None
+            for exit_pid, exit_inside in self.entrances.get(cluster, []):
+                hop = self.intra.get((pid, exit_pid, cluster))
+                if hop is None:
+                    continue
+                next_node = (exit_pid, self.cluster_of[graph.portals[exit_pid].other_side(exit_inside)])
+                tentative = cost + hop[0]
+                if tentative < abstract_g.get(next_node, math.inf):
+                    abstract_g[next_node] = tentative
+                    abstract_came[next_node] = node
+                    heapq.heappush(open_set, (tentative + math.dist(graph.portals[exit_pid].point, goal), exit_pid, next_node[1]))
+
+        if best_chain is not None:
+            return graph.route_from_portals(start_space, best_chain, best_cost)
+        if best_node is None:
+            return None
+
+        # 還原完整路線：起點群組的局部路線 + 各群組預先計算的門序列 + 終點群組的局部路線
+        nodes = [best_node]
+        while nodes[-1] in abstract_came:
+            nodes.append(abstract_came[nodes[-1]])
+        nodes.reverse()
+
+        first_pid = nodes[0][0]
+        first_inside = next(inside for pid, inside in self.entrances[start_cluster] if pid == first_pid)
+        chain = _portal_chain(start_came, (first_pid, graph.portals[first_pid].other_side(first_inside)))
+        for prev, node in zip(nodes, nodes[1:]):
+            chain.extend(self.intra[(prev[0], node[0], prev[1])][1])
+
+        last_pid = nodes[-1][0]
+        last_inside = next(inside for pid, inside in self.entrances[goal_cluster] if pid == last_pid)
+        # 反向搜尋的門序列是從終點往外走，反轉後最後一扇門就是入口本身 (已在 chain 中)
+        goal_chain = _portal_chain(goal_came, (last_pid, graph.portals[last_pid].other_side(last_inside)))
+        goal_chain.reverse()
+        chain.extend(goal_chain[1:])
+        return graph.route_from_portals(start_space, chain, best_cost)
+
+
+# --- 門的時空預約 (cooperative A*) ---
+
+class DoorReservationTable:
+    """
+    門的時空預約表，讓多個 NPC 錯開時間通過同一扇門。
+
+    時間以「移動步數」計 (pygame 主迴圈每幀一步，呼叫 advance 推進)。
+    每扇門記錄已被預約的時段，同一時段只讓一個 NPC 通過；
+    PortalGraph.find_route 協同規劃時會等待空檔或改走其他門，
+    規劃完成後以 reserve_route 登記，NPC 提早抵達時在門口排隊等待自己的時段。
+    """
+
+    def __init__(self, margin: float = DOOR_RESERVATION_MARGIN):
+        self.now = 0.0
+        self.margin = margin
+        self._slots: Dict[int, List[Tuple[float, float, str]]] = {}  # 門 -> [(開始, 結束, 預約者)]，依開始時間排序
+        self._by_owner: Dict[str, Dict[int, Tuple[float, float]]] = {}  # 預約者 -> {門: (開始, 結束)}
+
+    def advance(self, steps: float = 1.0) -> None:
+        """推進時間並清除已結束的預約。"""
+        self.now += steps
+        for pid in list(self._slots):
+            slots = [slot for slot in self._slots[pid] if slot[1] >= self.now]
+            if slots:
+                self._slots[pid] = slots
+            else:
+                del self._slots[pid]
+        for owner in list(self._by_owner):
+            kept = {pid: slot for pid, slot in self._by_owner[owner].items() if slot[1] >= self.now}
+            if kept:
+                self._by_owner[owner] = kept
+            else:
+                del self._by_owner[owner]
+
+    def earliest_slot(self, pid: int, arrival: float, hold: float, owner: Optional[str] = None) -> float:
+        """回傳不早於 arrival、且前後 hold/2 + margin 內沒有其他 NPC 預約的最早通過時間。"""
+        half = hold / 2 + self.margin
+        t = arrival
+        for start, end, slot_owner in self._slots.get(pid, []):
+            if slot_owner == owner:
+                continue
+            if t + half <= start:
+                break
+            if t - half < end:
+                t = end + half
+        return t
+
+    def schedule_route(self, route: PortalRoute, start: Point, speed: float, hold: float,
+                       owner: Optional[str] = None) -> Tuple[List[float], float]:
+        """依目前的預約，計算沿既有路線穿過每扇門的時間與總等待步數 (不修改預約表)。"""
+        scale = 1.0 / speed if speed > 0 else 1.0
+        t = self.now
+        waited = 0.0
+        prev = start
+        times = []
+        for pid, point in zip(route.portals, route.waypoints):
+            arrival = t + math.dist(prev, point) * scale
+            t = self.earliest_slot(pid, arrival, hold, owner)
+            waited += t - arrival
+            times.append(t)
+            prev = point
+        return times, waited
+
+    def reserve_route(self, owner: str, route: PortalRoute, hold: float) -> None:
+        """以 route.crossing_times 登記預約，先取消此預約者之前的所有預約。"""
+        self.release(owner)
+        half = hold / 2 + self.margin
+        owned = {}
+        for pid, t in zip(route.portals, route.crossing_times):
+            slot = (t - half, t + half, owner)
+            slots = self._slots.setdefault(pid, [])
+            slots.append(slot)
+            slots.sort()
+            owned[pid] = (slot[0], slot[1])
+        if owned:
+            self._by_owner[owner] = owned
+
+    def clear(self) -> None:
+        """清除所有預約 (門戶圖重建後，門的索引已不同)。"""
+        self._slots.clear()
+        self._by_owner.clear()
+
+    def release(self, owner: str) -> None:
+        """取消某個預約者的所有預約 (重新規劃或放棄移動時)。"""
+        owned = self._by_owner.pop(owner, None)
+        if not owned:
+            return
+        for pid in owned:
+            slots = [slot for slot in self._slots.get(pid, []) if slot[2] != owner]
+            if slots:
+                self._slots[pid] = slots
+            else:
+                self._slots.pop(pid, None)
+
+    def slot_of(self, owner: str, pid: int) -> Optional[Tuple[float, float]]:
+        """回傳預約者在某扇門的時段 (開始, 結束)，沒有預約時回傳 None。"""
+        return self._by_owner.get(owner, {}).get(pid)
+
+
+# --- 佔用網格與路徑修補 ---
+
+Rect = Tuple[float, float, float, float]  # (left, top, right, bottom)
+Cell = Tuple[int, int]
+
+
+def item_rect(item: Any, buffer: float = 0.0) -> Optional[Rect]:
+    """回傳物品的 (left, top, right, bottom)，並向外擴張 buffer；缺少位置或大小時回傳 None。"""
+    pos = getattr(item, "position", None)
+    size = getattr(item, "size", None)
+    if not pos or not size:
+        return None
+    return (pos[0] - buffer, pos[1] - buffer, pos[0] + size[0] + buffer, pos[1] + size[1] + buffer)
+
+
+def point_in_rect(point: Point, rect: Rect) -> bool:
+    return rect[0] <= point[0] <= rect[2] and rect[1] <= point[1] <= rect[3]
+
+
+def segment_intersects_rect(p1: Point, p2: Point, rect: Rect) -> bool:
+    """線段與軸對齊矩形是否相交 (Liang–Barsky 裁剪)。"""
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, p1[0] - rect[0]), (dx, rect[2] - p1[0]), (-dy, p1[1] - rect[1]), (dy, rect[3] - p1[1])):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+class OccupancyGrid:
+    """
+    單一空間的佔用網格。每個格子記錄覆蓋它的障礙物數量，
+    新增/移除物品時只更新受影響的格子，不需要重建整個網格。
+    """
+
+    def __init__(self, space_rect: Rect, cell_size: float = 20.0):
+        self.left, self.top, self.right, self.bottom = space_rect
+        self.cell_size = float(cell_size)
+        self.cols = max(1, int(math.ceil((self.right - self.left) / self.cell_size)))
+        self.rows = max(1, int(math.ceil((self.bottom - self.top) / self.cell_size)))
+        self.counts: Dict[Cell, int] = {}
+        self.version = 0  # 被佔用的格子集合改變時遞增，用來判斷流場是否過期
+
+    def cell_of(self, point: Point) -> Cell:
+        """世界座標所在的格子 (超出範圍時夾到邊界格子)。"""
+        col = int((point[0] - self.left) // self.cell_size)
+        row = int((point[1] - self.top) // self.cell_size)
+        return (min(max(col, 0), self.cols - 1), min(max(row, 0), self.rows - 1))
+
+    def cell_center(self, cell: Cell) -> Point:
+        return (self.left + (cell[0] + 0.5) * self.cell_size, self.top + (cell[1] + 0.5) * self.cell_size)
+
+    def cells_in_rect(self, rect: Rect) -> List[Cell]:
+        """格子中心落在矩形內的所有格子。"""
+        col0 = max(0, int(math.floor((rect[0] - self.left) / self.cell_size - 0.5)))
+        col1 = min(self.cols - 1, int(math.ceil((rect[2] - self.left) / self.cell_size - 0.5)))
+        row0 = max(0, int(math.floor((rect[1] - self.top) / self.cell_size - 0.5)))
+        row1 = min(self.rows - 1, int(math.ceil((rect[3] - self.top) / self.cell_size - 0.5)))
+        cells = []
+        for col in range(col0, col1 + 1):
+            for row in range(row0, row1 + 1):
+                if point_in_rect(self.cell_center((col, row)), rect):
+                    cells.append((col, row))
+        return cells
+
+    def add_obstacle(self, rect: Rect) -> List[Cell]:
+        """加入障礙物，回傳由空轉為佔用的格子。"""
+        newly_blocked = []
+        for cell in self.cells_in_rect(rect):
+            count = self.counts.get(cell, 0)
+            if count == 0:
+                newly_blocked.append(cell)
+            self.counts[cell] = count + 1
+        if newly_blocked:
+            self.version += 1
+        return newly_blocked
+
+    def remove_obstacle(self, rect: Rect) -> List[Cell]:
+        """移除障礙物，回傳由佔用轉為空的格子。"""
+        newly_freed = []
+        for cell in self.cells_in_rect(rect):
+            count = self.counts.get(cell, 0) - 1
+            if count <= 0:
+                self.counts.pop(cell, None)
+                newly_freed.append(cell)
+            else:
+                self.counts[cell] = count
+        if newly_freed:
+            self.version += 1
+        return newly_freed
+
+    def is_blocked(self, cell: Cell) -> bool:
+        return self.counts.get(cell, 0) > 0
+
+    def find_path(self, start: Point, goal: Point) -> Optional[List[Point]]:
+        """
+        在網格上以 8 方向 A* 尋路。起點與終點格子即使被佔用也允許進出。
+        回傳的路徑以 start 開始、goal 結束，中間為轉折處的格子中心；找不到時回傳 None。
+        """
+        start_cell = self.cell_of(start)
+        goal_cell = self.cell_of(goal)
+        if start_cell == goal_cell:
+            return [start, goal]
+
+        def h(cell: Cell) -> float:
+            return math.hypot(cell[0] - goal_cell[0], cell[1] - goal_cell[1])
+
+        open_set: List[Tuple[float, Cell]] = [(h(start_cell), start_cell)]
+        g_score: Dict[Cell, float] = {start_cell: 0.0}
+        came_from: Dict[Cell, Cell] = {}
+        closed = set()
+        while open_set:
+            _, current = heapq.heappop(open_set)
+            if current == goal_cell:
+                break
+            if current in closed:
+                continue
+            closed.add(current)
+            for dc in (-1, 0, 1):
+                for dr in (-1, 0, 1):
+                    if dc == 0 and dr == 0:
+                        continue
+                    nxt = (current[0] + dc, current[1] + dr)
+                    if not (0 <= nxt[0] < self.cols and 0 <= nxt[1] < self.rows):
+                        continue
+                    if nxt != goal_cell and self.is_blocked(nxt):
+                        continue
+                    # 斜向移動不可切過被佔用的角落
+                    if dc and dr and (self.is_blocked((current[0] + dc, current[1])) or self.is_blocked((current[0], current[1] + dr))):
+                        continue
+                    tentative = g_score[current] + (1.41421356 if dc and dr else 1.0)
+                    if tentative < g_score.get(nxt, math.inf):
+                        g_score[nxt] = tentative
+                        came_from[nxt] = current
+                        heapq.heappush(open_set, (tentative + h(nxt), nxt))
+        else:
+            return None
+        if goal_cell not in came_from:
+            return None
+
+        cells = [goal_cell]
+        while cells[-1] in came_from:
+            cells.append(came_from[cells[-1]])
+        cells.reverse()
+
+        # 只保留方向改變處的格子中心
+        points: List[Point] = [start]
+        for i in range(1, len(cells) - 1):
+            prev_dir = (cells[i][0] - cells[i - 1][0], cells[i][1] - cells[i - 1][1])
+            next_dir = (cells[i + 1][0] - cells[i][0], cells[i + 1][1] - cells[i][1])
+            if prev_dir != next_dir:
+                points.append(self.cell_center(cells[i]))
+        points.append(goal)
+        return points
+
+
+class FlowField:
+    """
+    單一空間內朝同一個目標點的流場。
+
+    從目標格子做一次 8 方向 Dijkstra (與 OccupancyGrid.find_path 相同的移動規則)，
+    每個格子記錄朝剩餘成本最低的相鄰格子前進的單位方向。所有前往同一目標的 NPC 共用一份，
+    每個 NPC 每步只需 direction(position) 查表一次。佔用網格改變 (version 不同) 後需要重建。
+    """
+
+    def __init__(self, grid: OccupancyGrid, goal: Point):
+        self.grid = grid
+        self.goal = (float(goal[0]), float(goal[1]))
+        self.goal_cell = grid.cell_of(self.goal)
+        self.version = grid.version
+        cols, rows = grid.cols, grid.rows
+        self.cost: List[float] = [math.inf] * (cols * rows)
+        self._next: List[int] = [-1] * (cols * rows)  # 下一個格子的索引，-1 表示目標格子或無法抵達
+
+        goal_index = self.goal_cell[1] * cols + self.goal_cell[0]
+        self.cost[goal_index] = 0.0
+        heap: List[Tuple[float, int, int]] = [(0.0, self.goal_cell[0], self.goal_cell[1])]
+        while heap:
+            cost, col, row = heapq.heappop(heap)
+            if cost > self.cost[row * cols + col]:
+                continue
+            for dc, dr, step in _NEIGHBOR_STEPS:
+                nc, nr = col + dc, row + dr
+                if not (0 <= nc < cols and 0 <= nr < rows):
+                    continue
+                if grid.is_blocked((nc, nr)):
+                    continue
+                if dc and dr and (grid.is_blocked((col + dc, row)) or grid.is_blocked((col, row + dr))):
+                    continue
+                index = nr * cols + nc
+                if cost + step < self.cost[index]:
+                    self.cost[index] = cost + step
+                    self._next[index] = row * cols + col
+                    heapq.heappush(heap, (cost + step, nc, nr))
+
+        # 被佔用的格子 (例如 NPC 的起點落在物品的緩衝區內) 朝成本最低的相鄰空格離開
+        for cell in grid.counts:
+            index = cell[1] * cols + cell[0]
+            if self._next[index] != -1 or index == goal_index:
+                continue
+            best = math.inf
+            for dc, dr, step in _NEIGHBOR_STEPS:
+                nc, nr = cell[0] + dc, cell[1] + dr
+                if 0 <= nc < cols and 0 <= nr < rows and self.cost[nr * cols + nc] + step < best:
+                    best = self.cost[nr * cols + nc] + step
+                    self._next[index] = nr * cols + nc
+            self.cost[index] = best
+
+    def is_stale(self) -> bool:
+        return self.version != self.grid.version
+
+    def remaining_cost(self, point: Point) -> float:
+        """從 point 所在格子到目標格子的剩餘成本 (格子數)，無法抵達時為 inf。"""
+        col, row = self.grid.cell_of(point)
+        return self.cost[row * self.grid.cols + col]
+
+    def direction(self, point: Point) -> Optional[Point]:
+        """
+        point 處應前進的單位方向。位於目標格子時直接朝目標點；無法抵達或已在目標點上時回傳 None。
+        """
+        col, row = self.grid.cell_of(point)
+        next_index = self._next[row * self.grid.cols + col]
+        if next_index == -1:
+            if (col, row) != self.goal_cell:
+                return None
+            target = self.goal
+        else:
+            target = self.grid.cell_center((next_index % self.grid.cols, next_index // self.grid.cols))
+        dx, dy = target[0] - point[0], target[1] - point[1]
+        dist = math.hypot(dx, dy)
+        if dist < 1e-9:
+            return None
+        return (dx / dist, dy / dist)
+
+
+# 8 方向移動與成本 (dc, dr, cost)
+_NEIGHBOR_STEPS = [(dc, dr, 1.41421356 if dc and dr else 1.0)
+                   for dc in (-1, 0, 1) for dr in (-1, 0, 1) if dc or dr]
+
+
+def repair_path(position: Point, path_points: List[Point], blocked_rect: Rect,
+                grid: OccupancyGrid) -> Optional[List[Point]]:
+    """
+    只修補路徑中穿過 blocked_rect 的片段 (D* Lite 式的局部修補)。
+
+    從被擋住片段的起點，在 grid 上重新規劃到障礙物之後第一個未被覆蓋的路徑點，
+    再接回原本剩下的路徑。路徑沒有受影響時原樣回傳；無法修補時回傳 None。
+    """
+    pts: List[Point] = [tuple(position)] + [tuple(p) for p in path_points]
+    k = 0
+    repaired = False
+    while k < len(pts) - 1:
+        if not segment_intersects_rect(pts[k], pts[k + 1], blocked_rect):
+            k += 1
+            continue
+        # 找出障礙物之後第一個沒有被覆蓋的路徑點 (終點被覆蓋時仍以終點為目標)
+        j = k + 1
+        while j < len(pts) - 1 and point_in_rect(pts[j], blocked_rect):
+            j += 1
+        local = grid.find_path(pts[k], pts[j])
+        if local is None:
+            return None
+        pts = pts[:k + 1] + local[1:-1] + pts[j:]
+        k += max(1, len(local) - 1)
+        repaired = True
+    if not repaired:
+        return list(path_points)
+    return pts[1:]
+
+
+# --- 批次路徑查詢 ---
+
+@dataclass
+class RouteQuery:
+    """一筆批次路徑查詢；key 由呼叫端決定 (例如 NPC)，方便把結果對應回去。"""
+    key: Any
+    start_space: str
+    goal_space: str
+    start_pos: Optional[Point] = None
+    goal_pos: Optional[Point] = None
+
+
+# 工作行程中的唯讀門戶圖快照，由 _init_route_worker 在行程啟動時設定一次
+_worker_graph: Optional[PortalGraph] = None
+# 主行程中的行程池，與建立它的門戶圖及其拓撲版本綁定；換了地圖或門戶圖就地重建後都會重建行程池
+_route_pool: Optional[ProcessPoolExecutor] = None
+_route_pool_key: Optional[Tuple[PortalGraph, int]] = None
+_route_pool_workers = 0  # 行程池的工作行程數 (分塊大小依此計算)
+
+
+def _init_route_worker(graph: PortalGraph) -> None:
+    global _worker_graph
+    _worker_graph = graph
+
+
+def _solve_route_chunk(queries: List[Tuple[str, str, Optional[Point], Optional[Point]]]) -> List[Optional[PortalRoute]]:
+    return [_worker_graph.find_route(*query) for query in queries]
+
+
+def _get_route_pool(graph: PortalGraph, max_workers: Optional[int]) -> Tuple[ProcessPoolExecutor, int]:
+    """取得 (行程池, 工作行程數)。"""
+    global _route_pool, _route_pool_key, _route_pool_workers
+    if _route_pool is not None and _route_pool_key is not None and \
+       _route_pool_key[0] is graph and _route_pool_key[1] == graph.topology_version:
+        return _route_pool, _route_pool_workers
+    shutdown_route_pool()
+    workers = max_workers or os.cpu_count() or 1
+    # 使用 spawn：呼叫端通常有其他執行緒 (pygame、NPC 思考執行緒) 在跑，fork 不安全
+    _route_pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_route_worker,
+        initargs=(graph,)
+    )
+    _route_pool_key = (graph, graph.topology_version)
+    _route_pool_workers = workers
+    return _route_pool, workers
+
+
+def shutdown_route_pool() -> None:
+    """關閉批次路徑查詢使用的行程池 (門戶圖改變或程式結束時)。"""
+    global _route_pool, _route_pool_key, _route_pool_workers
+    if _route_pool is not None:
+        _route_pool.shutdown(wait=False, cancel_futures=True)
+    _route_pool = None
+    _route_pool_key = None
+    _route_pool_workers = 0
+
+
+atexit.register(shutdown_route_pool)
+
+
+def find_routes_batch(graph: PortalGraph, queries: List[RouteQuery],
+                      max_workers: Optional[int] = None,
+                      min_parallel: int = ROUTE_BATCH_MIN_PARALLEL) -> List[Optional[PortalRoute]]:
+    """
+    一次解多筆路徑查詢，回傳與 queries 順序相同的 PortalRoute (找不到路徑為 None)。
+
+    查詢數量達到 min_parallel 時，分塊送到行程池；每個工作行程在啟動時收到一份門戶圖快照，
+    之後只傳遞查詢與結果。行程池無法使用時 (例如不支援多行程的環境) 改為逐筆計算。
+    """
+    if not queries:
+        return []
+    args = [(q.start_space, q.goal_space, q.start_pos, q.goal_pos) for q in queries]
+    routes: Optional[List[Optional[PortalRoute]]] = None
+    if len(queries) >= min_parallel:
+        try:
+            pool, workers = _get_route_pool(graph, max_workers)
+            chunk_size = max(1, math.ceil(len(args) / workers))
+            chunks = [args[i:i + chunk_size] for i in range(0, len(args), chunk_size)]
+            routes = [route for chunk in pool.map(_solve_route_chunk, chunks) for route in chunk]
+        except Exception as e:
+            print(f"批次路徑查詢無法使用行程池，改為逐筆計算: {e}")
+            shutdown_route_pool()
+            routes = None
+    if routes is None:
+        routes = [graph.find_route(*query) for query in args]
+    return routes
@@ -0,0 +1,206 @@
+"""
+NPC 的感知：回答「某個 NPC 現在看得到、聽得到什麼」。
+
+房間是凸矩形，同一空間內的東西只受距離限制；相鄰空間只有視線穿過兩者之間的門開口時才看得到，
+聲音則可以穿過門傳到相鄰空間。每個空間可看見的門開口由門戶圖預先計算 (VisibilityMap)，
+查詢結果依觀察者位置與附近空間的版本號快取，直到範圍內有東西移動、進出或物品改變才重新計算。
+"""
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import math
+
+Point = Tuple[float, float]
+Segment = Tuple[Point, Point]
+
+# 看得到的最遠距離 (世界座標系)
+SIGHT_RANGE = 600.0
+# 聽得到的最遠距離 (世界座標系)，可穿過門但不需要視線
+HEARING_RANGE = 300.0
+# 觀察者在同一格內移動時沿用快取的結果 (世界座標系)
+PERCEPTION_CELL_SIZE = 25.0
+
+
+def door_opening(door: Dict[str, Any]) -> Optional[Segment]:
+    """門的開口線段 (世界座標)。"""
+    if door.get("type") == "vertical":
+        x = float(door["wall_x_world"])
+        return (x, float(door["opening_start_world"])), (x, float(door["opening_end_world"]))
+    if door.get("type") == "horizontal":
+        y = float(door["wall_y_world"])
+        return (float(door["opening_start_world"]), y), (float(door["opening_end_world"]), y)
+    return None
+
+
+def segments_intersect(p1: Point, p2: Point, q1: Point, q2: Point) -> bool:
+    """兩線段是否相交 (含端點接觸)。"""
+    def cross(o: Point, a: Point, b: Point) -> float:
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    d1, d2 = cross(q1, q2, p1), cross(q1, q2, p2)
+    d3, d4 = cross(p1, p2, q1), cross(p1, p2, q2)
+    if ((d1 > 0 > d2) or (d1 < 0 < d2)) and ((d3 > 0 > d4) or (d3 < 0 < d4)):
+        return True
+
+    def on_segment(a: Point, b: Point, p: Point) -> bool:
+        return min(a[0], b[0]) - 1e-9 <= p[0] <= max(a[0], b[0]) + 1e-9 and \
+            min(a[1], b[1]) - 1e-9 <= p[1] <= max(a[1], b[1]) + 1e-9
+
+    return (d1 == 0 and on_segment(q1, q2, p1)) or (d2 == 0 and on_segment(q1, q2, p2)) or \
+        (d3 == 0 and on_segment(p1, p2, q1)) or (d4 == 0 and on_segment(p1, p2, q2))
+
+
+class VisibilityMap:
+    """
+    每個空間透過門開口可以看見的相鄰空間，由門戶圖建立 (門戶圖重建後需要重新建立)。
+    沒有實體門的連接 (後備連接點) 只傳聲音，不傳視線。
+    """
+
+    def __init__(self, portal_graph: Any):
+        self.portal_graph = portal_graph
+        self.topology_version = getattr(portal_graph, "topology_version", 0)
+        self.openings: Dict[Tuple[str, str], List[Segment]] = {}  # (空間, 相鄰空間) -> 門開口
+        self.neighbors: Dict[str, List[str]] = {}
+        for portal in getattr(portal_graph, "portals", []):
+            a, b = portal.spaces
+            self.neighbors.setdefault(a, []).append(b)
+            self.neighbors.setdefault(b, []).append(a)
+            opening = door_opening(portal.door) if portal.door else None
+            if opening is not None:
+                self.openings.setdefault((a, b), []).append(opening)
+                self.openings.setdefault((b, a), []).append(opening)
+
+    def is_stale(self, portal_graph: Any) -> bool:
+        return portal_graph is not self.portal_graph or \
+            getattr(portal_graph, "topology_version", 0) != self.topology_version
+
+    def can_see(self, space_a: str, point_a: Point, space_b: str, point_b: Point) -> bool:
+        """a 是否看得到 b：同一空間一定看得到，相鄰空間需要視線穿過兩者之間的門開口。"""
+        if space_a == space_b:
+            return True
+        return any(segments_intersect(point_a, point_b, q1, q2) for q1, q2 in self.openings.get((space_a, space_b), ()))
+
+
+@dataclass
+class Percept:
+    """一次感知查詢的結果 (依距離由近到遠排序)。"""
+    visible_npcs: List[Any] = dataclass_field(default_factory=list)
+    audible_npcs: List[Any] = dataclass_field(default_factory=list)  # 聽得到 (可以對話) 的 NPC
+    visible_items: List[Any] = dataclass_field(default_factory=list)  # 所在空間內看得到 (可以互動) 的物品
+    distant_items: List[Any] = dataclass_field(default_factory=list)  # 透過門看到的相鄰空間物品
+
+    def summary(self) -> str:
+        """給 prompt 使用的一行描述。"""
+        def names(objs: List[Any]) -> str:
+            return ", ".join(obj.name for obj in objs) if objs else "none"
+        return (
+            f"Visible NPCs: {names(self.visible_npcs)}\n"
+            f"Audible NPCs: {names(self.audible_npcs)}\n"
+            f"Nearby Items: {names(self.visible_items)}\n"
+            f"Items seen through doors: {names(self.distant_items)}"
+        )
+
+
+def _center(obj: Any) -> Optional[Point]:
+    pos = getattr(obj, "position", None)
+    if not pos or len(pos) < 2:
+        return None
+    size = getattr(obj, "size", None)
+    if size and len(size) >= 2:
+        return (pos[0] + size[0] / 2, pos[1] + size[1] / 2)
+    return (float(pos[0]), float(pos[1]))
+
+
+class Perception:
+    """
+    感知查詢與快取。
+
+    結果以 (觀察者所在空間, 觀察者位置所在的格子, 附近空間的版本號) 為鍵快取；
+    移動引擎在 NPC 移動或換空間時、AI_System 在物品增減時呼叫 touch，讓該空間附近的快取失效。
+    """
+
+    def __init__(self, sight_range: float = SIGHT_RANGE, hearing_range: float = HEARING_RANGE):
+        self.sight_range = sight_range
+        self.hearing_range = hearing_range
+        self._visibility: Optional[VisibilityMap] = None
+        self._space_versions: Dict[str, int] = {}
+        self._cache: Dict[int, Tuple[Any, Percept]] = {}  # id(觀察者) -> (快取鍵, 結果)
+
+    def touch(self, space_name: Optional[str]) -> None:
+        """空間內有東西移動、進出或物品改變。"""
+        if space_name:
+            self._space_versions[space_name] = self._space_versions.get(space_name, 0) + 1
+
+    def visibility(self, portal_graph: Any) -> Optional[VisibilityMap]:
+        if portal_graph is None:
+            return None
+        if self._visibility is None or self._visibility.is_stale(portal_graph):
+            self._visibility = VisibilityMap(portal_graph)
+            self._cache.clear()
+        return self._visibility
+
+    def perceive(self, npc: Any, portal_graph: Any, spaces: Dict[str, Any],
+                 item_index: Optional[Callable[[Any], Any]] = None) -> Percept:
+        """
+        回傳 npc 目前看得到與聽得到的 NPC、物品。
+        item_index(space) 可提供空間的物品空間雜湊 (SpatialHash)，只查詢範圍內的物品。
+        """
+        space = getattr(npc, "current_space", None)
+        origin = _center(npc)
+        if space is None or origin is None:
+            return Percept()
+        visibility = self.visibility(portal_graph)
+        nearby = [space.name] + (visibility.neighbors.get(space.name, []) if visibility else [])
+        key = (
+            space.name,
+            int(math.floor(origin[0] / PERCEPTION_CELL_SIZE)), int(math.floor(origin[1] / PERCEPTION_CELL_SIZE)),
+            tuple(self._space_versions.get(name, 0) for name in nearby),
+            visibility.topology_version if visibility else None
+        )
+        cached = self._cache.get(id(npc))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        percept = Percept()
+        ranked_npcs: List[Tuple[float, int, Any]] = []
+        ranked_items: List[Tuple[float, int, Any, str]] = []
+        for name in nearby:
+            other_space = spaces.get(name)
+            if other_space is None:
+                continue
+            for other in getattr(other_space, "npcs", []):
+                if other is npc:
+                    continue
+                point = _center(other)
+                if point is not None:
+                    ranked_npcs.append((math.dist(origin, point), len(ranked_npcs), other))
+            if item_index is not None:
+                r = self.sight_range
+                items = item_index(other_space).query((origin[0] - r, origin[1] - r, origin[0] + r, origin[1] + r))
+                if name == space.name:
+                    # 空間雜湊只收有位置與大小的物品，其餘的仍然列入所在空間
+                    items += [item for item in other_space.items if not getattr(item, "position", None) or not getattr(item, "size", None)]
+            else:
+                items = getattr(other_space, "items", [])
+            for item in items:
+                point = _center(item)
+                if point is not None:
+                    ranked_items.append((math.dist(origin, point), len(ranked_items), item, name))
+                elif name == space.name:
+                    ranked_items.append((0.0, len(ranked_items), item, name))  # 沒有位置的物品視為就在身邊
+
+        for dist, _, other in sorted(ranked_npcs, key=lambda entry: entry[:2]):
+            other_space = other.current_space.name
+            if dist <= self.hearing_range:
+                percept.audible_npcs.append(other)
+            if dist <= self.sight_range and (visibility is None or visibility.can_see(space.name, origin, other_space, _center(other))):
+                percept.visible_npcs.append(other)
+        for dist, _, item, item_space in sorted(ranked_items, key=lambda entry: entry[:2]):
+            if dist > self.sight_range:
+                continue
+            if item_space == space.name:
+                percept.visible_items.append(item)
+            elif visibility is not None and visibility.can_see(space.name, origin, item_space, _center(item)):
+                percept.distant_items.append(item)
+
+        self._cache[id(npc)] = (key, percept)
+        return percept
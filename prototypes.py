@@ -0,0 +1,137 @@
+"""
+物品原型型錄：大量重複的家具與道具共用同一份描述、屬性、大小與圖片 (entities.ItemPrototype)。
+
+型錄的來源是 worlds/item.json (格式為 {"items": {"sofa": {...}, ...}})，地圖中的物品以
+"prototype": "sofa" 指定原型 (沒有指定時以物品名稱比對)，自己只需要寫名稱、位置與不同於原型的欄位。
+沒有對應原型的物品在載入時依共用欄位自動合併：資料完全相同的物品 (例如二十張一樣的椅子) 共用一個匿名原型。
+
+存檔時有具名原型的物品只寫 "prototype" 與覆寫值；匿名原型的物品照舊寫出完整資料。
+"""
+from typing import Any, Dict, Optional, Tuple
+import json
+import os
+
+from entities import ItemEntity, ItemPrototype
+
+DEFAULT_CATALOG_PATH = os.path.join("worlds", "item.json")
+
+
+def _shared_key(data: Dict[str, Any]) -> Tuple[Any, ...]:
+    """共用欄位的雜湊鍵 (屬性字典的值不可雜湊時以排序後的 JSON 表示)。"""
+    size = data.get("size")
+    properties = data.get("properties") or {}
+    try:
+        properties_key: Any = frozenset((key, type(value), value) for key, value in properties.items())
+    except TypeError:
+        properties_key = json.dumps(properties, sort_keys=True, ensure_ascii=False, default=str)
+    return (
+        data.get("description", ""),
+        properties_key,
+        tuple(size) if size is not None else None,
+        data.get("image_path"),
+        data.get("image_scale", 1.0),
+    )
+
+
+class PrototypeCatalog:
+    """具名原型 (型錄) 與載入時自動合併的匿名原型。"""
+
+    def __init__(self):
+        self._named: Dict[str, ItemPrototype] = {}
+        self._shared: Dict[Tuple[Any, ...], ItemPrototype] = {}  # 共用欄位 -> 原型
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_CATALOG_PATH) -> "PrototypeCatalog":
+        """讀取型錄檔案；檔案不存在或格式錯誤時回傳空的型錄。"""
+        catalog = cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f).get("items", {})
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"無法讀取物品原型型錄 {path}: {e}")
+            return catalog
+        for key, data in entries.items():
+            catalog.add(key, data)
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self._named)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._named
+
+    def add(self, key: str, data: Dict[str, Any]) -> ItemPrototype:
+        prototype = ItemPrototype(
+            key=key,
+            description=data.get("description", ""),
+            properties=data.get("properties") or {},
+            size=data.get("size"),
+            image_path=data.get("image_path"),
+            image_scale=data.get("image_scale", 1.0),
+        )
+        self._named[key] = prototype
+        return prototype
+
+    def get(self, key: str) -> Optional[ItemPrototype]:
+        return self._named.get(key)
+
+    def resolve(self, item_data: Dict[str, Any]) -> Optional[ItemPrototype]:
+        """物品資料對應的具名原型 ("prototype" 欄位，沒有時以名稱比對)。"""
+        key = item_data.get("prototype")
+        if key is not None:
+            return self._named.get(key)
+        return self._named.get(item_data.get("name", ""))
+
+    def expand(self, item_data: Dict[str, Any]) -> Dict[str, Any]:
+        """以具名原型補齊物品資料中沒有寫的欄位 (供載入時驗證使用)。"""
+        prototype = self.resolve(item_data)
+        if prototype is None:
+            return item_data
+        expanded = {name: getattr(prototype, name) for name in ItemPrototype.SHARED_FIELDS}
+        if expanded["size"] is not None:
+            expanded["size"] = list(expanded["size"])
+        expanded.update(item_data)
+        return expanded
+
+    def share(self, item_data: Dict[str, Any]) -> ItemPrototype:
+        """
+        物品應共用的原型：有具名原型時使用它，否則取得 (或建立) 共用欄位完全相同的匿名原型。
+        item_data 需為已補齊並驗證過的完整資料。
+        """
+        prototype = self.resolve(item_data)
+        if prototype is not None:
+            return prototype
+        key = _shared_key(item_data)
+        prototype = self._shared.get(key)
+        if prototype is None:
+            prototype = ItemPrototype(
+                description=item_data.get("description", ""),
+                properties=item_data.get("properties") or {},
+                size=item_data.get("size"),
+                image_path=item_data.get("image_path"),
+                image_scale=item_data.get("image_scale", 1.0),
+            )
+            self._shared[key] = prototype
+        return prototype
+
+    def instantiate(self, item_data: Dict[str, Any]) -> ItemEntity:
+        """由完整的物品資料建立共用原型的 ItemEntity。"""
+        prototype = self.share(item_data)
+        overrides = {name: item_data[name] for name in ItemPrototype.SHARED_FIELDS if name in item_data}
+        return ItemEntity.from_prototype(prototype, item_data["name"], item_data.get("position"), **overrides)
+
+
+def item_save_data(item: ItemEntity, fields: Tuple[str, ...]) -> Optional[Dict[str, Any]]:
+    """
+    有具名原型的物品回傳精簡的存檔資料 (名稱、位置、原型與覆寫值)；
+    其他物品回傳 None，由呼叫端寫出完整資料。
+    """
+    key = item.prototype.key
+    if key is None:
+        return None
+    data: Dict[str, Any] = {"name": item.name}
+    if key != item.name:
+        data["prototype"] = key
+    data["position"] = item.position
+    data.update({name: value for name, value in item.overrides().items() if name in fields})
+    return data
@@ -5,6 +5,8 @@ import os
 import time
 from backend import save_world_to_json
 from backend import PathPlanner # Added import for PathPlanner
+from backend import get_portal_graph, get_world_system, MovementEngine
+from snapshot import NPCDecision
 import base64
 from openai import OpenAI
 
@@ -242,11 +244,8 @@ def run_pygame_demo(world):
     # 新增：牆壁和連接相關常數 (使用世界單位，會進行縮放)
     WALL_COLOR = (70, 70, 70)  # 深灰色牆壁
     WALL_THICKNESS_WORLD_UNITS = 2.0  # 牆壁厚度 (世界座標系)
-    CONNECTION_TOLERANCE_WORLD_UNITS = 20.0  # 空間邊緣對齊的容差 (世界座標系)
-    # MIN_PATH_WIDTH_WORLD_UNITS = 20.0     # 形成路徑所需的最小重疊寬度 (世界座標系) # 註解掉，門的邏輯使用固定寬度
     
-    # 新增：門的相關常數
-    DOOR_WIDTH_WORLD_UNITS = 15.0  # 門的寬度/高度 (開口大小)
+    # 新增：門的相關常數 (門的位置與開口大小由 navigation.PortalGraph 計算)
     DOOR_COLOR = (139, 69, 19, 180)   # 門的顏色 (棕色，半透明)
     DOOR_FRAME_THICKNESS_WORLD_UNITS = 5.0 # 門框厚度
     DOOR_FRAME_COLOR = (90, 45, 10) # 深棕色門框
@@ -261,7 +260,16 @@ def run_pygame_demo(world):
     # Default values for grid_cell_size and npc_radius
     DEFAULT_GRID_CELL_SIZE = 20 # 與 PathPlanner 預設值一致
     DEFAULT_NPC_RADIUS = 24     # 與 NPC 預設半徑一致 (或取一個代表性值)
+    DOOR_QUEUE_DISTANCE = DEFAULT_NPC_RADIUS * 3  # 提早抵達預約的門時，在離門這個距離內排隊等待
     path_planner = PathPlanner(grid_cell_size=DEFAULT_GRID_CELL_SIZE, npc_radius=DEFAULT_NPC_RADIUS)
+
+    # 門戶圖在載入地圖時建立一次，與 backend 的路徑規劃共用同一份門的幾何資訊
+    portal_graph = get_portal_graph(world)
+    # 移動與碰撞引擎：每幀推進一步 (門的預約、流場、向量化移動、畫面外 NPC 的解析式移動)
+    movement_engine = MovementEngine(world, path_planner, door_queue_distance=DOOR_QUEUE_DISTANCE)
+    world["movement_engine"] = movement_engine
+    world_system = get_world_system()  # 建立快照與套用 NPC 決策 (只在主執行緒)
+    visible_world_rect = None  # 上一幀畫面涵蓋的世界座標範圍 (left, top, right, bottom)
     
     # 為所有 NPC 設置路徑規劃器 (已在之前步驟中加入)
     if 'npcs' in world and isinstance(world['npcs'], dict):
@@ -273,8 +281,12 @@ def run_pygame_demo(world):
     # else:
         # print("Warning: world['npcs'] is not a dictionary or not found. Cannot assign path_planner.") # 可以取消註解以進行除錯
 
-    def ai_process():
-        nonlocal last_ai_result, ai_thinking, ai_running, npc_threads
+    def ai_process(snapshot):
+        """
+        思考執行緒：每個 NPC 只讀取主執行緒建立的快照來思考，決策提交到佇列，
+        由主迴圈在每幀移動之前套用 (思考期間不碰共享的世界資料)。
+        """
+        nonlocal ai_thinking, ai_running, npc_threads
         
         # 如果已經在執行，則不啟動新的 (額外的保護)
         if ai_running:
@@ -288,6 +300,7 @@ def run_pygame_demo(world):
         npc_threads.clear()
         
         active_threads_this_batch = [] # 儲存當前批次啟動的執行緒
+        decisions = world_system.decisions
         #print("DEBUG: ai_process - Starting batch AI processing for NPCs...") # MODIFIED
         for i, npc_obj in enumerate(npcs): # 使用 npc_obj 避免與外層 npc 變數混淆
                 npc_obj.is_thinking = True
@@ -295,19 +308,11 @@ def run_pygame_demo(world):
                 
                 def process_single_npc(npc_id, single_npc_ref):
                     try:
-                        this_npc_name = single_npc_ref.name
-                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {this_npc_name}) - Starting process_tick()...") # MODIFIED
-                        result = single_npc_ref.process_tick()
-                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {this_npc_name}) - process_tick() completed. Result: {str(result)[:50]}...") # MODIFIED
-                        single_npc_ref.thinking_status = f"{this_npc_name}: {str(result)[:50]}" + ("..." if len(str(result)) > 50 else "") # MODIFIED (added str())
-                        # print(f"執行緒 {npc_id}: 完成處理 {this_npc_name}: {result[:30]}...")
-
+                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {single_npc_ref.name}) - Starting think()...") # MODIFIED
+                        decisions.submit(single_npc_ref.think(snapshot))
                     except Exception as e_single:
-                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {single_npc_ref.name}) - ERROR in process_tick(): {str(e_single)}") # MODIFIED
-                        single_npc_ref.thinking_status = f"{single_npc_ref.name}: 處理失敗"
-                    finally:
-                        single_npc_ref.is_thinking = False # 確保 thinking 狀態被重置
-                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {single_npc_ref.name}) - Finished thread execution.") # MODIFIED
+                        #print(f"DEBUG: process_single_npc (Thread {npc_id}, {single_npc_ref.name}) - ERROR in think(): {str(e_single)}") # MODIFIED
+                        decisions.submit(NPCDecision(npc_name=single_npc_ref.name, snapshot_version=snapshot.version, error=str(e_single)))
                 
                 t = threading.Thread(target=process_single_npc, args=(i, npc_obj))
                 t.daemon = True
@@ -317,17 +322,12 @@ def run_pygame_demo(world):
         
         # 等待當前批次的所有NPC思考執行緒完成
         #print("DEBUG: ai_process - All NPC thinking threads launched. Waiting for completion...") # MODIFIED
-        for t_idx, t_join in enumerate(active_threads_this_batch): # MODIFIED to add t_idx
-            npc_name_for_join = "UnknownNPC"
-            if t_idx < len(npcs): # Check index bounds
-                npc_name_for_join = npcs[t_idx].name
-            #print(f"DEBUG: ai_process - Attempting to join thread {t_idx} for {npc_name_for_join}...") # MODIFIED
+        for t_join in active_threads_this_batch:
             t_join.join() # 等待每個執行緒執行完畢
-            #print(f"DEBUG: ai_process - Successfully joined thread {t_idx} for {npc_name_for_join}.") # MODIFIED
-        #print("DEBUG: ai_process - All NPC thinking processes (process_tick) completed and threads joined.") # MODIFIED
+        #print("DEBUG: ai_process - All NPC thinking processes (think) completed and threads joined.") # MODIFIED
         
         ai_thinking = False
-        ai_running = False # AI 思考和 tick 處理階段結束
+        ai_running = False # AI 思考階段結束 (決策由主迴圈套用)
         #print("DEBUG: ai_process - Batch AI processing finished. ai_running set to False.") # MODIFIED
         
     def save_menu(screen, font, world, original_path):
@@ -569,7 +569,7 @@ def run_pygame_demo(world):
                 npc_buttons.append(btn_rect)
 
                 # 決定按鈕顏色
-                if npc == selected_npc:  # 當前選中的 NPC
+                if npc is selected_npc:  # 當前選中的 NPC
                     bg_color = (220, 220, 255)  # 淺藍背景
                     text_color = (0, 0, 200)     # 深藍文字
                     border_color = (100, 100, 200)  # 藍色邊框
@@ -1006,7 +1006,7 @@ def run_pygame_demo(world):
                 screen = pygame.display.set_mode((event.w, event.h), pygame.RESIZABLE)
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_c and active_npc and can_trigger_ai: # 使用 can_trigger_ai
-                    ai_threading = threading.Thread(target=ai_process)
+                    ai_threading = threading.Thread(target=ai_process, args=(world_system.take_snapshot(),))
                     ai_threading.start()
                 elif event.key == pygame.K_e:
                     running = False
@@ -1019,7 +1019,7 @@ def run_pygame_demo(world):
                 # 新增：N鍵觸發NPC切換選單
                 elif event.key == pygame.K_n and len(npcs) > 1:
                     new_active_npc = npc_selection_menu(screen, font, npcs, active_npc)
-                    if new_active_npc and new_active_npc != active_npc:
+                    if new_active_npc and new_active_npc is not active_npc:
                         active_npc = new_active_npc
                         last_ai_result = ""  # 清空上一個NPC的AI結果
                         # 輸出目前關注的NPC
@@ -1078,7 +1078,7 @@ def run_pygame_demo(world):
                     # 動作觸發
                     if rect.collidepoint(event.pos): # 使用 event.pos 判斷點擊位置
                         if key_char == "c" and active_npc and can_trigger_ai: # 使用 can_trigger_ai
-                            ai_threading = threading.Thread(target=ai_process)
+                            ai_threading = threading.Thread(target=ai_process, args=(world_system.take_snapshot(),))
                             ai_threading.start()
                         if key_char == "e":
                             running = False
@@ -1089,7 +1089,7 @@ def run_pygame_demo(world):
                         # 新增：處理「切換NPC」按鈕
                         if key_char == "n" and len(npcs) > 1:
                             new_active_npc = npc_selection_menu(screen, font, npcs, active_npc)
-                            if new_active_npc and new_active_npc != active_npc:
+                            if new_active_npc and new_active_npc is not active_npc:
                                 active_npc = new_active_npc
                                 last_ai_result = ""  # 清空上一個NPC的AI結果
                                 # 輸出目前關注的NPC
@@ -1101,542 +1101,23 @@ def run_pygame_demo(world):
                     current_zoom_level -= zoom_speed
                 current_zoom_level = max(min_zoom, min(current_zoom_level, max_zoom)) # 限制縮放範圍
 
-        # 每次主循環都同步 display_pos 與 position，並推進動畫移動
-        # 在 NPC 移動更新之前，確保 calculated_doors 是最新的
-        # --- 預先計算門的位置 (整合 TypeError 修復) --- (這段邏輯移到 NPC 移動更新之前，以確保 A* 可以使用最新的門信息)
-        calculated_doors = [] # 儲存計算出的門的資訊
-        space_map_for_doors = {s.name: s for s in spaces} # 空間名稱到物件的映射 (避免與全域 space_map 衝突)
-        processed_space_pairs_for_doors = set() # 避免重複處理空間對
-
-        for s1 in spaces:
-            if not hasattr(s1, "connected_spaces") or not s1.connected_spaces or not hasattr(s1, "display_pos") or not hasattr(s1, "display_size") :
-                continue
-            for connected_item in s1.connected_spaces: # connected_item 可能是字串或 Space 物件
-                s2_name = None
-                if isinstance(connected_item, str): # 假設是字串
-                    s2_name = connected_item    # 直接使用字串
-                elif hasattr(connected_item, 'name'): # 假設是 Space 物件
-                    s2_name = connected_item.name # 使用 Space 物件的 name 屬性
-                else:
-                    continue
-                
-                s2 = space_map_for_doors.get(s2_name)
-                if not s2 or s1 == s2 or not hasattr(s2, "display_pos") or not hasattr(s2, "display_size"): # s2 不存在或 s2 就是 s1 自己，或s2缺少位置資訊
-                    continue
-
-                pair_key = tuple(sorted((s1.name, s2.name))) # 將空間名稱組成一個唯一的鍵
-                if pair_key in processed_space_pairs_for_doors:
-                    continue
-                
-                s1_rect_world = pygame.Rect(s1.display_pos[0], s1.display_pos[1], s1.display_size[0], s1.display_size[1])
-                s2_rect_world = pygame.Rect(s2.display_pos[0], s2.display_pos[1], s2.display_size[0], s2.display_size[1])
-                door_info = None
-                
-                # 檢查 s1 的右邊緣是否連接 s2 的左邊緣
-                if abs(s1_rect_world.right - s2_rect_world.left) < CONNECTION_TOLERANCE_WORLD_UNITS:
-                    overlap_y_start = max(s1_rect_world.top, s2_rect_world.top)
-                    overlap_y_end = min(s1_rect_world.bottom, s2_rect_world.bottom)
-                    if overlap_y_end - overlap_y_start >= DOOR_WIDTH_WORLD_UNITS:   # 門的寬度/高度 (開口大小)，世界座標系
-                        door_center_y = (overlap_y_start + overlap_y_end) / 2
-                        door_info = {
-                            "s1_name": s1.name, "s2_name": s2.name, "type": "vertical",
-                            "wall_x_world": s1_rect_world.right, 
-                            "opening_start_world": door_center_y - DOOR_WIDTH_WORLD_UNITS / 2, 
-                            "opening_end_world": door_center_y + DOOR_WIDTH_WORLD_UNITS / 2,   
-                            "s1_edge_name": "right", "s2_edge_name": "left"
-                        }
-                # 檢查 s1 的左邊緣是否連接 s2 的右邊緣
-                elif abs(s1_rect_world.left - s2_rect_world.right) < CONNECTION_TOLERANCE_WORLD_UNITS:
-                    overlap_y_start = max(s1_rect_world.top, s2_rect_world.top)
-                    overlap_y_end = min(s1_rect_world.bottom, s2_rect_world.bottom)
-                    if overlap_y_end - overlap_y_start >= DOOR_WIDTH_WORLD_UNITS:
-                        door_center_y = (overlap_y_start + overlap_y_end) / 2
-                        door_info = {
-                            "s1_name": s1.name, "s2_name": s2.name, "type": "vertical",
-                            "wall_x_world": s1_rect_world.left,
-                            "opening_start_world": door_center_y - DOOR_WIDTH_WORLD_UNITS / 2,
-                            "opening_end_world": door_center_y + DOOR_WIDTH_WORLD_UNITS / 2,
-                            "s1_edge_name": "left", "s2_edge_name": "right"
-                        }
-                # 檢查 s1 的下邊緣是否連接 s2 的上邊緣
-                elif abs(s1_rect_world.bottom - s2_rect_world.top) < CONNECTION_TOLERANCE_WORLD_UNITS:
-                    overlap_x_start = max(s1_rect_world.left, s2_rect_world.left)
-                    overlap_x_end = min(s1_rect_world.right, s2_rect_world.right)
-                    if overlap_x_end - overlap_x_start >= DOOR_WIDTH_WORLD_UNITS:
-                        door_center_x = (overlap_x_start + overlap_x_end) / 2
-                        door_info = {
-                            "s1_name": s1.name, "s2_name": s2.name, "type": "horizontal",
-                            "wall_y_world": s1_rect_world.bottom, 
-                            "opening_start_world": door_center_x - DOOR_WIDTH_WORLD_UNITS / 2, 
-                            "opening_end_world": door_center_x + DOOR_WIDTH_WORLD_UNITS / 2,   
-                            "s1_edge_name": "bottom", "s2_edge_name": "top"
-                        }
-                # 檢查 s1 的上邊緣是否連接 s2 的下邊緣
-                elif abs(s1_rect_world.top - s2_rect_world.bottom) < CONNECTION_TOLERANCE_WORLD_UNITS:
-                    overlap_x_start = max(s1_rect_world.left, s2_rect_world.left)
-                    overlap_x_end = min(s1_rect_world.right, s2_rect_world.right)
-                    if overlap_x_end - overlap_x_start >= DOOR_WIDTH_WORLD_UNITS:
-                        door_center_x = (overlap_x_start + overlap_x_end) / 2
-                        door_info = {
-                            "s1_name": s1.name, "s2_name": s2.name, "type": "horizontal",
-                            "wall_y_world": s1_rect_world.top,
-                            "opening_start_world": door_center_x - DOOR_WIDTH_WORLD_UNITS / 2,
-                            "opening_end_world": door_center_x + DOOR_WIDTH_WORLD_UNITS / 2,
-                            "s1_edge_name": "top", "s2_edge_name": "bottom"
-                        }
-                
-                if door_info:
-                    calculated_doors.append(door_info)
-                    processed_space_pairs_for_doors.add(pair_key)
-        # --- 預計算門結束 --- (calculated_doors 現在在此處更新)
-
-        for npc in npcs:
-            if npc.position is None: 
-                npc.position = [0.0, 0.0]
-            else:
-                npc.position = [float(p) for p in npc.position]
-
-            current_npc_space_name = npc.current_space.name if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'name') else None
-
-            # --- A* Path Following Logic (largely unchanged, sets npc.move_target to doors/space centers) ---
-            if hasattr(npc, 'current_path_segment_target_space_name') and npc.current_path_segment_target_space_name:
-                # ... (Your existing A* segment target logic, lines 1118-1183 or similar) ...
-                # This part should set npc.move_target to a door or space center if on an A* path
-                # For brevity, I'm not reproducing all of it, but it should remain functional.
-                target_segment_space_name = npc.current_path_segment_target_space_name
-                target_space_obj = all_spaces_dict.get(target_segment_space_name)
-                current_npc_actual_space = npc.current_space
-
-                if target_space_obj and current_npc_actual_space and hasattr(current_npc_actual_space, 'name'):
-                    if current_npc_actual_space.name != target_segment_space_name:
-                        entry_door_to_target = None
-                        for door_candidate in calculated_doors:
-                            if ((door_candidate.get('s1_name') == current_npc_actual_space.name and door_candidate.get('s2_name') == target_segment_space_name) or
-                                (door_candidate.get('s2_name') == current_npc_actual_space.name and door_candidate.get('s1_name') == target_segment_space_name)):
-                                entry_door_to_target = door_candidate
-                                break
-                        if entry_door_to_target:
-                            door_center_x, door_center_y = 0.0, 0.0
-                            if entry_door_to_target['type'] == 'vertical':
-                                door_center_x = float(entry_door_to_target['wall_x_world'])
-                                door_center_y = float((entry_door_to_target['opening_start_world'] + entry_door_to_target['opening_end_world']) / 2)
-                            elif entry_door_to_target['type'] == 'horizontal':
-                                door_center_x = float((entry_door_to_target['opening_start_world'] + entry_door_to_target['opening_end_world']) / 2)
-                                door_center_y = float(entry_door_to_target['wall_y_world'])
-                            nudge_amount = 15.0
-                            final_target_x, final_target_y = door_center_x, door_center_y
-                            current_space_name_for_nudge = current_npc_actual_space.name
-                            if entry_door_to_target.get('s1_name') == current_space_name_for_nudge and entry_door_to_target.get('s2_name') == target_segment_space_name:
-                                s1_edge = entry_door_to_target.get('s1_edge_name')
-                                if s1_edge == 'right': final_target_x += nudge_amount
-                                elif s1_edge == 'left': final_target_x -= nudge_amount
-                                elif s1_edge == 'bottom': final_target_y += nudge_amount
-                                elif s1_edge == 'top': final_target_y -= nudge_amount
-                            elif entry_door_to_target.get('s2_name') == current_space_name_for_nudge and entry_door_to_target.get('s1_name') == target_segment_space_name:
-                                s2_edge = entry_door_to_target.get('s2_edge_name')
-                                if s2_edge == 'right': final_target_x += nudge_amount
-                                elif s2_edge == 'left': final_target_x -= nudge_amount
-                                elif s2_edge == 'bottom': final_target_y += nudge_amount
-                                elif s2_edge == 'top': final_target_y -= nudge_amount
-                            npc.move_target = [final_target_x, final_target_y]
-                        else:
-                            if hasattr(target_space_obj, 'display_pos') and hasattr(target_space_obj, 'display_size'):
-                                center_x = float(target_space_obj.display_pos[0] + target_space_obj.display_size[0] / 2)
-                                center_y = float(target_space_obj.display_pos[1] + target_space_obj.display_size[1] / 2)
-                                npc.move_target = [center_x, center_y]
-                            else:
-                                npc.move_target = None
-                    else:
-                        space_it_just_entered_obj = all_spaces_dict.get(npc.current_path_segment_target_space_name)
-                        if space_it_just_entered_obj and hasattr(space_it_just_entered_obj, 'display_pos') and hasattr(space_it_just_entered_obj, 'display_size'):
-                            center_x = float(space_it_just_entered_obj.display_pos[0] + space_it_just_entered_obj.display_size[0] / 2)
-                            center_y = float(space_it_just_entered_obj.display_pos[1] + space_it_just_entered_obj.display_size[1] / 2)
-                            npc.move_target = [center_x, center_y]
-                        else:
-                            npc.current_path_segment_target_space_name = None
-                            if hasattr(npc, 'path_to_follow'): npc.path_to_follow = []
-                            npc.move_target = None
-                else:
-                    npc.current_path_segment_target_space_name = None
-                    if hasattr(npc, 'path_to_follow'): npc.path_to_follow = []
-                    npc.move_target = None
-            # --- A* Path Following Logic END ---
-
-            if hasattr(npc, 'move_target') and npc.move_target:
-                target_pos = [float(tp) for tp in npc.move_target] 
+        # 門的資訊來自門戶圖 (載入時已計算)，只有空間拓撲改變時才會重建
+        portal_graph = get_portal_graph(world)
+        calculated_doors = portal_graph.doors if portal_graph else []
 
-                if not isinstance(npc.position, list) or not all(isinstance(p, (float, int)) for p in npc.position):
-                    #print(f"DEBUG: ERROR - NPC {npc.name} has invalid position: {npc.position}. Skipping move.")
-                    continue
+        # 在移動之前套用思考執行緒提交的決策 (世界只由主執行緒修改；跨空間路徑查詢一起批次計算)
+        try:
+            for decided_npc, decision_result in world_system.apply_decisions():
+                decided_npc.thinking_status = f"{decided_npc.name}: {str(decision_result)[:50]}" + ("..." if len(str(decision_result)) > 50 else "")
+                if decided_npc is active_npc:
+                    last_ai_result = decision_result
+        except Exception as e_apply:
+            print(f"套用 NPC 決策失敗: {e_apply}")
 
-                dx = target_pos[0] - npc.position[0]
-                dy = target_pos[1] - npc.position[1]
-                dist = math.hypot(dx, dy)
-                
-                current_move_speed = getattr(npc, 'move_speed', 1.0) 
-                if current_move_speed <= 0: current_move_speed = 1.0 
-
-                # --- Target Reached Logic --- 
-                if dist < current_move_speed: # Use actual move speed as threshold
-                    npc.position[0] = target_pos[0]
-                    npc.position[1] = target_pos[1]
-                    #print(f"DEBUG: NPC {npc.name} REACHED {target_pos}. Current pos: {npc.position}")
-
-                    reached_original_target_after_avoidance = False
-                    if npc.avoiding_item_name and npc.original_move_target is None: # Was avoiding, and original_move_target was cleared (meaning it was set as current target)
-                        # Check if current target_pos (which was reached) matches the _last_original_target
-                        if hasattr(npc, '_last_original_target_x') and hasattr(npc, '_last_original_target_y') and \
-                            abs(target_pos[0] - npc._last_original_target_x) < 0.1 and \
-                            abs(target_pos[1] - npc._last_original_target_y) < 0.1:
-                            reached_original_target_after_avoidance = True
-
-                    if npc.avoiding_item_name and not reached_original_target_after_avoidance:
-                        #print(f"DEBUG: NPC {npc.name} reached AVOIDANCE waypoint for {npc.avoiding_item_name}. Original was {getattr(npc, 'original_move_target', 'None')}")
-                        if hasattr(npc, 'original_move_target') and npc.original_move_target:
-                            npc.move_target = list(npc.original_move_target) # Target original again
-                            # Store the original target to check against when it's reached
-                            npc._last_original_target_x = npc.original_move_target[0]
-                            npc._last_original_target_y = npc.original_move_target[1]
-                            npc.original_move_target = None # Clear it, as it's now the main target
-                            #print(f"DEBUG: NPC {npc.name} now targeting stored original: {npc.move_target}")
-                        else:
-                            # Reached an avoidance point, but no original target to go to. Clear avoidance.
-                            #print(f"DEBUG: NPC {npc.name} cleared avoidance for {npc.avoiding_item_name} (no original_move_target).")
-                            npc.avoiding_item_name = None
-                        npc.move_target = None
-                        if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
-                        if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
-                    
-                    elif reached_original_target_after_avoidance:
-                        #print(f"DEBUG: NPC {npc.name} successfully reached ORIGINAL target after avoiding {npc.avoiding_item_name}.")
-                        npc.avoiding_item_name = None
-                        npc.move_target = None
-                        if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
-                        if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
-                    
-                    else: # Reached a non-avoidance related target, or an original target directly
-                        if npc.move_target: # If it was a direct original target reach
-                            if hasattr(npc, '_last_original_target_x') and hasattr(npc, '_last_original_target_y') and \
-                                abs(target_pos[0] - npc._last_original_target_x) < 0.1 and \
-                                abs(target_pos[1] - npc._last_original_target_y) < 0.1:
-                                #print(f"DEBUG: NPC {npc.name} directly reached its original target.")
-                                if hasattr(npc, '_last_original_target_x'): del npc._last_original_target_x
-                                if hasattr(npc, '_last_original_target_y'): del npc._last_original_target_y
-                        
-                        npc.move_target = None 
-                        if npc.original_move_target: npc.original_move_target = None
-                        if npc.avoiding_item_name: npc.avoiding_item_name = None # Clear if any lingering state
-
-                    # A* path advancement and interaction completion (only if move_target is now None)
-                    if npc.move_target is None:
-                        is_on_astar_path_and_active = hasattr(npc, 'current_path_segment_target_space_name') and npc.current_path_segment_target_space_name is not None
-                        if is_on_astar_path_and_active:
-                            current_segment_target_space_obj = all_spaces_dict.get(npc.current_path_segment_target_space_name)
-                            if current_segment_target_space_obj and hasattr(current_segment_target_space_obj, 'display_pos') and hasattr(current_segment_target_space_obj, 'display_size'):
-                                center_x_of_current_segment = float(current_segment_target_space_obj.display_pos[0] + current_segment_target_space_obj.display_size[0] / 2)
-                                center_y_of_current_segment = float(current_segment_target_space_obj.display_pos[1] + current_segment_target_space_obj.display_size[1] / 2)
-                                if abs(npc.position[0] - center_x_of_current_segment) < 1.0 and abs(npc.position[1] - center_y_of_current_segment) < 1.0: # 稍微放寬判斷條件
-                                    print(f"DEBUG: NPC {npc.name} reached CENTER of A* segment: {npc.current_path_segment_target_space_name}")
-                                if hasattr(npc, 'path_to_follow') and npc.path_to_follow:
-                                    npc.current_path_segment_target_space_name = npc.path_to_follow.pop(0)
-                                    #print(f"DEBUG: NPC {npc.name} A* path advanced. New segment target: {npc.current_path_segment_target_space_name}. Remaining A* path: {npc.path_to_follow}")
-                            else:
-                                        #print(f"DEBUG: NPC {npc.name} A* path COMPLETED. Final segment was: {npc.current_path_segment_target_space_name}")
-                                        npc.current_path_segment_target_space_name = None # A* 路徑完成
-
-                        elif npc.current_space and npc.current_path_segment_target_space_name and npc.current_space.name == npc.current_path_segment_target_space_name:
-                                    # NPC 已經進入了 A* 路徑的當前目標空間 (current_path_segment_target_space_name)。
-                                    # 但可能還未到達該空間的中心點。
-                                    #print(f"DEBUG: NPC {npc.name} is IN A* segment target space: {npc.current_space.name} (which is {npc.current_path_segment_target_space_name}). Advancing A* if possible.")
-                                    if hasattr(npc, 'path_to_follow') and npc.path_to_follow:
-                                        # 如果 A* 路徑中還有下一個空間，則推進 A* 路徑。
-                                        npc.current_path_segment_target_space_name = npc.path_to_follow.pop(0)
-                                        #print(f"DEBUG: NPC {npc.name} A* path advanced WHILE IN SPACE. New segment target: {npc.current_path_segment_target_space_name}. Remaining A* path: {npc.path_to_follow}")
-                                    elif not npc.path_to_follow: # path_to_follow 為空，表示當前空間就是最終目標
-                                        #print(f"DEBUG: NPC {npc.name} A* path COMPLETED (already in final space {npc.current_space.name}, which was target {npc.current_path_segment_target_space_name}).")
-                                        npc.current_path_segment_target_space_name = None # A* 路徑完成
-                                    # npc.move_target is already None, the A* path following logic (around L1520) will pick up the new
-                                    # current_path_segment_target_space_name (if not None) and set a new precise move_target (door or center).
-
-                        elif npc.current_path_segment_target_space_name: 
-                                    # NPC 到達了某個點 (通常是門的微調點)，但其 current_space 記錄尚未更新為 A* 的目標空間。
-                                    # 主要依賴後續的 "Update NPC's actual current_space" (L1839) 邏輯來處理基於物理位置的空間變更。
-                                    # 這裡僅作日誌記錄，因為 move_target 為 None 會讓 A* path following logic (L1520) 重新評估。
-                                    current_space_name_for_debug = npc.current_space.name if npc.current_space else "None"
-                                    #print(f"DEBUG: NPC {npc.name} at {npc.position} reached move_target. Current space: {current_space_name_for_debug}, A* target space: {npc.current_path_segment_target_space_name}. Awaiting space update or next A* target recalc.")
-                                    # The "FORCE UPDATED current_space" logic previously here was removed as it could lead to premature A* advancement
-                                    # if the physical space update (around L1839) hadn't occurred yet.
-                                    # Relying on npc.move_target = None to re-trigger A* planning (L1520) with current state.
-
-                        if hasattr(npc, 'waiting_interaction') and npc.waiting_interaction and npc.waiting_interaction.get('started', False):
-                            interaction_result = npc.complete_interaction() 
-                            if interaction_result: last_ai_result = interaction_result
-                else:
-                    # --- Normal Movement & Collision Detection --- 
-                    effective_move_x = current_move_speed * dx / dist
-                    effective_move_y = current_move_speed * dy / dist
-                    
-                    next_pos_x_candidate = npc.position[0] + effective_move_x
-                    next_pos_y_candidate = npc.position[1] + effective_move_y
-                    
-                    npc_world_radius = npc.radius 
-                    npc_next_rect_world = pygame.Rect(
-                        next_pos_x_candidate - npc_world_radius,
-                        next_pos_y_candidate - npc_world_radius,
-                        2 * npc_world_radius,
-                        2 * npc_world_radius
-                    )
+        # 移動、碰撞與空間更新由 backend 的 MovementEngine 統一處理 (與 SandBox 共用)
+        for interaction_result in movement_engine.step(npcs, visible_rect=visible_world_rect):
+            last_ai_result = interaction_result
 
-                    # --- Item Collision & Avoidance --- 
-                    collided_item_this_step = None
-                    current_space_obj_for_item_check = npc.current_space 
-                    if current_space_obj_for_item_check and hasattr(current_space_obj_for_item_check, 'items'):
-                        for item_obj in current_space_obj_for_item_check.items:
-                            if not (hasattr(item_obj, 'position') and hasattr(item_obj, 'size') and item_obj.position and item_obj.size):
-                                continue
-                            
-                            # Skip collision check if this item is the interaction target
-                            if hasattr(npc, 'waiting_interaction') and npc.waiting_interaction and npc.waiting_interaction.get("item_name") == item_obj.name:
-                                continue
-                            
-                            # Skip if already avoiding this item AND still moving towards an avoidance waypoint (original_move_target is set)
-                            if npc.avoiding_item_name == item_obj.name and npc.original_move_target is not None:
-                                continue
-
-                            item_rect_check = pygame.Rect(item_obj.position[0], item_obj.position[1], item_obj.size[0], item_obj.size[1])
-                            if npc_next_rect_world.colliderect(item_rect_check):
-                                collided_item_this_step = item_obj
-                                break
-                            
-                    if collided_item_this_step:
-                        #print(f"DEBUG: NPC {npc.name} predicted collision with {collided_item_this_step.name}")
-                        if npc.avoiding_item_name != collided_item_this_step.name: # New collision or re-collision after trying original target
-                            if npc.move_target:
-                                npc.original_move_target = list(npc.move_target) # Store current main target
-                                npc._last_original_target_x = npc.original_move_target[0]
-                                npc._last_original_target_y = npc.original_move_target[1]
-                            npc.avoiding_item_name = collided_item_this_step.name
-
-                        item_center_x = collided_item_this_step.position[0] + collided_item_this_step.size[0] / 2
-                        item_center_y = collided_item_this_step.position[1] + collided_item_this_step.size[1] / 2
-                        vec_npc_to_item_x = item_center_x - npc.position[0]
-                        vec_npc_to_item_y = item_center_y - npc.position[1]
-
-                        # Try to find a clear perpendicular direction
-                        # This is a simplified avoidance, could be made more robust
-                        perp_x_option1 = -vec_npc_to_item_y
-                        perp_y_option1 = vec_npc_to_item_x
-                        perp_x_option2 = vec_npc_to_item_y
-                        perp_y_option2 = -vec_npc_to_item_x
-
-                        avoid_dist_factor = npc_world_radius + max(collided_item_this_step.size[0], collided_item_this_step.size[1]) / 2 + 20.0 # Increased buffer
-                        
-                        # Normalize and scale perpendicular vectors
-                        len_perp1 = math.hypot(perp_x_option1, perp_y_option1)
-                        if len_perp1 > 1e-6 : 
-                            avoid_target1_x = npc.position[0] + (perp_x_option1 / len_perp1) * avoid_dist_factor
-                            avoid_target1_y = npc.position[1] + (perp_y_option1 / len_perp1) * avoid_dist_factor
-                        else: # Should not happen if vec_npc_to_item is non-zero
-                            avoid_target1_x, avoid_target1_y = npc.position[0], npc.position[1]
-
-                        len_perp2 = math.hypot(perp_x_option2, perp_y_option2)
-                        if len_perp2 > 1e-6:
-                            avoid_target2_x = npc.position[0] + (perp_x_option2 / len_perp2) * avoid_dist_factor
-                            avoid_target2_y = npc.position[1] + (perp_y_option2 / len_perp2) * avoid_dist_factor
-                        else:
-                            avoid_target2_x, avoid_target2_y = npc.position[0], npc.position[1]
-                        
-                        # Simplistic choice: alternate or pick one. A better way would be to check if these points are clear.
-                        # For now, let's try the one further from the item center, or alternate.
-                        if not hasattr(npc, '_last_avoid_choice') or npc._last_avoid_choice == 1:
-                            npc.move_target = [avoid_target1_x, avoid_target1_y]
-                            npc._last_avoid_choice = 2
-                        else: 
-                            npc.move_target = [avoid_target2_x, avoid_target2_y]
-                            npc._last_avoid_choice = 1
-
-                        #print(f"DEBUG: NPC {npc.name} NEW AVOIDANCE TARGET: {npc.move_target} for {npc.avoiding_item_name}")
-                        
-                        # Recalculate movement based on new avoidance target for this frame
-                        dx = npc.move_target[0] - npc.position[0]
-                        dy = npc.move_target[1] - npc.position[1]
-                        dist = math.hypot(dx, dy)
-                        if dist > 1e-6:
-                            effective_move_x = current_move_speed * dx / dist
-                            effective_move_y = current_move_speed * dy / dist
-                        else:
-                            effective_move_x = 0
-                            effective_move_y = 0
-                            next_pos_x_candidate = npc.position[0] + effective_move_x
-                            next_pos_y_candidate = npc.position[1] + effective_move_y
-                    # --- Item Collision END ---
-
-                    # --- Wall Collision (uses the potentially updated next_pos_x/y_candidate) --- 
-                    can_move_x = True
-                    can_move_y = True
-                    npc_try_x_rect_world = pygame.Rect(next_pos_x_candidate - npc_world_radius, npc.position[1] - npc_world_radius, 2 * npc_world_radius, 2 * npc_world_radius)
-                    npc_try_y_rect_world = pygame.Rect(npc.position[0] - npc_world_radius, next_pos_y_candidate - npc_world_radius, 2 * npc_world_radius, 2 * npc_world_radius)
-                    current_space_obj_for_wall_check = npc.current_space # Use the most up-to-date current_space
-
-                    if current_space_obj_for_wall_check and hasattr(current_space_obj_for_wall_check, 'display_pos') and hasattr(current_space_obj_for_wall_check, 'display_size'):
-                        space_rect_for_walls = pygame.Rect(
-                            current_space_obj_for_wall_check.display_pos[0], current_space_obj_for_wall_check.display_pos[1],
-                            current_space_obj_for_wall_check.display_size[0], current_space_obj_for_wall_check.display_size[1]
-                        )
-                        
-                        allow_exit_via_astar_path = False
-                        if hasattr(npc, 'current_path_segment_target_space_name') and \
-                            npc.current_path_segment_target_space_name and \
-                            npc.current_space and \
-                            hasattr(npc.current_space, 'name') and \
-                            npc.current_path_segment_target_space_name != npc.current_space.name:
-                            
-                            target_is_connected_via_door = False
-                            for door_info_check in calculated_doors:
-                                if (door_info_check.get('s1_name') == npc.current_space.name and door_info_check.get('s2_name') == npc.current_path_segment_target_space_name) or \
-                                    (door_info_check.get('s2_name') == npc.current_space.name and door_info_check.get('s1_name') == npc.current_path_segment_target_space_name):
-                                    target_is_connected_via_door = True
-                                    break
-                            if target_is_connected_via_door:
-                                allow_exit_via_astar_path = True
-                        
-                        # Check X movement
-                        if not space_rect_for_walls.contains(npc_try_x_rect_world): # If NPC's next X step is outside current space boundaries
-                            if allow_exit_via_astar_path and npc.move_target:
-                                # If moving towards the A* target's X coordinate, allow exit.
-                                if (effective_move_x < 0 and npc.move_target[0] < space_rect_for_walls.left - 1e-6) or \
-                                    (effective_move_x > 0 and npc.move_target[0] > space_rect_for_walls.right + 1e-6):
-                                    pass # can_move_x remains True, allowing exit
-                                else:
-                                    # Exiting, but not towards the A* target's X direction relative to space edge
-                                    can_move_x = False 
-                            else:
-                                # Not on A* path to exit, or no move_target; apply standard wall collision
-                                # This part of the original logic was already checking specific edge collision:
-                                if ((next_pos_x_candidate - npc_world_radius < space_rect_for_walls.left and effective_move_x < 0) or \
-                                    (next_pos_x_candidate + npc_world_radius > space_rect_for_walls.right and effective_move_x > 0)):
-                                        can_move_x = False
-                        
-                        # Check Y movement
-                        if not space_rect_for_walls.contains(npc_try_y_rect_world): # If NPC's next Y step is outside current space boundaries
-                            if allow_exit_via_astar_path and npc.move_target:
-                                # If moving towards the A* target's Y coordinate, allow exit.
-                                if (effective_move_y < 0 and npc.move_target[1] < space_rect_for_walls.top - 1e-6) or \
-                                    (effective_move_y > 0 and npc.move_target[1] > space_rect_for_walls.bottom + 1e-6):
-                                    pass # can_move_y remains True, allowing exit
-                                else:
-                                    # Exiting, but not towards the A* target's Y direction relative to space edge
-                                    can_move_y = False
-                            else:
-                                # Not on A* path to exit, or no move_target; apply standard wall collision
-                                # This part of the original logic was already checking specific edge collision:
-                                if ((next_pos_y_candidate - npc_world_radius < space_rect_for_walls.top and effective_move_y < 0) or \
-                                    (next_pos_y_candidate + npc_world_radius > space_rect_for_walls.bottom and effective_move_y > 0)):
-                                        can_move_y = False
-                    # --- Wall Collision END ---
-                    
-                    # --- Final Movement Update --- 
-                    if can_move_x:
-                        npc.position[0] = next_pos_x_candidate
-                    #else:
-                        #print(f"DEBUG: NPC {npc.name} X-move blocked by wall. Target was {npc.move_target}")
-
-                    if can_move_y:
-                        npc.position[1] = next_pos_y_candidate
-                    #else:
-                        #print(f"DEBUG: NPC {npc.name} Y-move blocked by wall. Target was {npc.move_target}")
-                    
-                    #if not can_move_x and not can_move_y and collided_item_this_step:
-                        #print(f"DEBUG: NPC {npc.name} FULLY STUCK by {collided_item_this_step.name} and/or walls. Pos: {npc.position}")
-                        # Consider clearing avoidance if fully stuck to allow AI to replan
-                        # npc.avoiding_item_name = None
-                        # npc.original_move_target = None
-                        # npc.move_target = None
-            
-            # Update display_pos and NPC's current actual space (largely unchanged)
-            if npc.position is not None:
-                npc.display_pos = [int(p) for p in npc.position]
-
-            # --- Update NPC's actual current_space based on position (Your lines 1520-1590) ---
-            if npc.position is not None:
-                npc_rect_world_for_space_update = pygame.Rect(
-                    npc.position[0] - getattr(npc, 'radius', 10),
-                    npc.position[1] - getattr(npc, 'radius', 10),
-                    getattr(npc, 'radius', 10) * 2,
-                    getattr(npc, 'radius', 10) * 2
-                )
-                npc_center_point_for_space_update = (npc.position[0], npc.position[1])
-                current_space_name_before_update = getattr(npc.current_space, 'name', None) if hasattr(npc, 'current_space') else None
-                
-                found_new_space_for_npc = False
-                # Check current space first for optimization
-                if hasattr(npc, 'current_space') and npc.current_space and \
-                    hasattr(npc.current_space, 'display_pos') and hasattr(npc.current_space, 'display_size'):
-                    current_space_rect_check = pygame.Rect(
-                        npc.current_space.display_pos[0], npc.current_space.display_pos[1],
-                        npc.current_space.display_size[0], npc.current_space.display_size[1]
-                    )
-                    if current_space_rect_check.collidepoint(npc_center_point_for_space_update):
-                        found_new_space_for_npc = True # Still in the same space
-                    
-                if not found_new_space_for_npc:
-                    for space_name_iter, space_obj_iter in all_spaces_dict.items():
-                        if not hasattr(space_obj_iter, 'display_pos') or not hasattr(space_obj_iter, 'display_size'):
-                            continue
-                        space_rect_iter = pygame.Rect(
-                            space_obj_iter.display_pos[0], space_obj_iter.display_pos[1],
-                            space_obj_iter.display_size[0], space_obj_iter.display_size[1]
-                        )
-                        if space_rect_iter.collidepoint(npc_center_point_for_space_update):
-                            if current_space_name_before_update != space_name_iter:
-                                if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'npcs') and npc in npc.current_space.npcs:
-                                    npc.current_space.npcs.remove(npc)
-                                npc.current_space = space_obj_iter
-                                if npc not in space_obj_iter.npcs: space_obj_iter.npcs.append(npc)
-                                #print(f"DEBUG: NPC {npc.name} SPACE UPDATE (pos) - from {current_space_name_before_update} to {space_name_iter}")
-                            found_new_space_for_npc = True
-                        break
-                
-                if not found_new_space_for_npc and npc.current_path_segment_target_space_name:
-                    # 特殊處理：在門的位置且正在走 A* 路徑
-                    for door in calculated_doors:
-                        door_rect_for_space_update = None
-                        # 計算門區域
-                        if door["type"] == "vertical":
-                            # 垂直門 (在左右邊牆上)
-                            padding = 10.0  # 增加一些寬度讓門區域更容易被偵測到
-                            door_rect_for_space_update = pygame.Rect(
-                                door["wall_x_world"] - padding, 
-                                door["opening_start_world"],
-                                padding * 2,  # 2倍 padding 作為寬度
-                                door["opening_end_world"] - door["opening_start_world"]
-                            )
-                        elif door["type"] == "horizontal":
-                            # 水平門 (在上下邊牆上)
-                            padding = 10.0
-                            door_rect_for_space_update = pygame.Rect(
-                                door["opening_start_world"],
-                                door["wall_y_world"] - padding,
-                                door["opening_end_world"] - door["opening_start_world"],
-                                padding * 2
-                            )
-                        
-                        # 檢查 NPC 是否在門區域，並且門連接到 NPC 正在前往的目標空間
-                        if door_rect_for_space_update and door_rect_for_space_update.colliderect(npc_rect_world_for_space_update) and \
-                            npc.current_path_segment_target_space_name in [door.get('s1_name'), door.get('s2_name')]:
-                            target_space_obj_on_door = all_spaces_dict.get(npc.current_path_segment_target_space_name)
-                            if target_space_obj_on_door and npc.current_space != target_space_obj_on_door:
-                                # 更新 NPC 的當前空間
-                                if hasattr(npc, 'current_space') and npc.current_space and hasattr(npc.current_space, 'npcs'):
-                                    if npc in npc.current_space.npcs:
-                                        npc.current_space.npcs.remove(npc)
-                                npc.current_space = target_space_obj_on_door
-                                if hasattr(target_space_obj_on_door, 'npcs') and npc not in target_space_obj_on_door.npcs:
-                                    target_space_obj_on_door.npcs.append(npc)
-                                #print(f"DEBUG: NPC {npc.name} SPACE UPDATE (door) - from {current_space_name_before_update} to {target_space_obj_on_door.name}")
-                                found_new_space_for_npc = True
-                                break
-            # --- End NPC Current Space Update ---
 
         # 滑鼠控制視角移動邏輯
         pan_mouse_x, pan_mouse_y = pygame.mouse.get_pos()
@@ -1691,6 +1172,10 @@ def run_pygame_demo(world):
         # 計算最終繪圖位移 (加入攝影機位移)
         final_draw_offset_x = base_offset_x + camera_offset_x
         final_draw_offset_y = base_offset_y + camera_offset_y
+        visible_world_rect = (
+            (0 - final_draw_offset_x) / scale - map_padding_x, (0 - final_draw_offset_y) / scale - map_padding_y,
+            (win_w - final_draw_offset_x) / scale - map_padding_x, (win_h - final_draw_offset_y) / scale - map_padding_y
+        )
 
         # 繪製背景
         screen.fill((230, 230, 250))  # 淡藍紫色背景
@@ -1929,7 +1414,7 @@ def run_pygame_demo(world):
             screen.blit(bubble_text, (bubble_rect.x + 10, bubble_rect.y + 10))
             
             # 為當前活動NPC添加指示標記
-            if npc == active_npc:
+            if npc is active_npc:
                 active_marker_rect = pygame.Rect(
                     draw_x - int(npc.radius*scale) - 10,
                     draw_y - int(npc.radius*scale) - 10,
@@ -2008,7 +1493,7 @@ def run_pygame_demo(world):
             screen.blit(bubble_text, (bubble_rect.x + 10, bubble_rect.y + 10))
 
             # 為當前活動NPC添加指示標記
-            if npc == active_npc:
+            if npc is active_npc:
                 active_marker_rect = pygame.Rect(
                     draw_x - int(npc.radius*scale) - 10,
                     draw_y - int(npc.radius*scale) - 10,
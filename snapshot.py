@@ -0,0 +1,190 @@
+"""
+NPC 思考執行緒使用的唯讀世界快照，以及把思考結果交回單一寫入者 (主執行緒) 的提交佇列。
+
+流程：
+    1. 主執行緒以 SnapshotBuilder.build() 建立 WorldSnapshot (不可變的 frozen dataclass 與 tuple)。
+    2. 思考執行緒只讀快照來組 prompt 與 schema、呼叫 LLM，產生 NPCDecision 後 submit 到 DecisionQueue。
+    3. 主執行緒在固定的時間點 drain() 佇列，依序把決策套用到真正的世界 (移動、互動、對話)。
+這樣思考執行緒完全不碰 Space.npcs / items 等共享資料，也不需要粗粒度的鎖。
+
+快照採 copy-on-write：沒有變更的空間 (依變更日誌的實體版本號判斷) 沿用上一份快照的 SpaceView 物件，
+只有改變過的空間與每個 NPC 的狀態會重新建立；沿用的 SpaceView 連同它的描述文字一起沿用，
+NPC 的自我介紹與庫存文字則取自 NPC 的片段快取。
+"""
+from collections import deque
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Tuple
+import threading
+
+
+@dataclass(frozen=True)
+class ItemView:
+    name: str
+    description: str
+    position: Optional[Tuple[float, ...]] = None
+    size: Optional[Tuple[float, ...]] = None
+
+
+@dataclass(frozen=True)
+class SpaceView:
+    name: str
+    description: str
+    connected: Tuple[str, ...]
+    items: Tuple[ItemView, ...]
+    npcs: Tuple[str, ...]
+    text: str  # Space.__str__ 的文字 (建立時產生一次，SpaceView 沿用時字串也沿用)
+    location: str  # prompt 中「你位於...」的片段
+
+    def __str__(self) -> str:
+        return self.text
+
+
+@dataclass(frozen=True)
+class PerceptView:
+    """Percept 的名稱版本 (不保留對共享物件的參照)。"""
+    visible_npcs: Tuple[str, ...] = ()
+    audible_npcs: Tuple[str, ...] = ()
+    visible_items: Tuple[str, ...] = ()
+    distant_items: Tuple[str, ...] = ()
+    summary: str = ""
+
+
+@dataclass(frozen=True)
+class NPCView:
+    name: str
+    description: str
+    space: str
+    home_space_name: Optional[str]
+    position: Optional[Tuple[float, ...]]
+    moving: bool  # 仍有移動目標
+    waiting_item: Optional[str]  # 正在前往互動的物品
+    first_tick: bool
+    inventory: Tuple[ItemView, ...]
+    history: Tuple[Mapping[str, str], ...]
+    percept: Optional[PerceptView] = None
+    persona: str = ""  # prompt 開頭的自我介紹
+    inventory_text: str = ""  # 庫存物品的列表文字
+
+
+@dataclass(frozen=True)
+class WorldSnapshot:
+    version: int  # 建立快照時的世界版本號 (變更日誌)
+    time: str
+    weather: str
+    spaces: Mapping[str, SpaceView]
+    npcs: Mapping[str, NPCView]
+
+
+@dataclass
+class NPCDecision:
+    """思考執行緒的結果，由主執行緒以 NPC.apply_decision 套用。"""
+    npc_name: str
+    snapshot_version: int
+    status: Optional[str] = None  # 沒有進行思考 (例如仍在移動) 時回報的狀態
+    user_input: Optional[str] = None
+    space_history: Optional[str] = None  # 第一次 tick 時要寫入歷史的空間描述
+    reasoning: Optional[str] = None
+    action: Any = None  # LLM 回傳的行動 (GeneralResponse.action)
+    error: Optional[str] = None
+
+
+def _item_view(item: Any) -> ItemView:
+    position = getattr(item, "position", None)
+    size = getattr(item, "size", None)
+    return ItemView(item.name, getattr(item, "description", ""),
+                    tuple(position) if position else None, tuple(size) if size else None)
+
+
+class SnapshotBuilder:
+    """
+    建立 WorldSnapshot (只能由寫入世界的主執行緒呼叫)。
+
+    有變更日誌時，空間的 SpaceView 以 (空間的版本號, 空間內物品的版本號) 為鍵沿用；
+    沒有日誌時每次都重新建立。
+    """
+
+    def __init__(self):
+        self._space_views: Dict[str, Tuple[Any, SpaceView]] = {}
+
+    def build(self, world: Dict[str, Any], time: str = "", weather: str = "",
+              perceive: Optional[Callable[[Any], Any]] = None) -> WorldSnapshot:
+        journal = world.get("journal")
+        spaces: Dict[str, SpaceView] = {}
+        for name, space in world.get("spaces", {}).items():
+            key = None
+            if journal is not None:
+                key = (journal.version_of(("space", name)), space.description, len(space.npcs),
+                       tuple(journal.version_of(("item", item.name)) for item in space.items))
+                cached = self._space_views.get(name)
+                if cached is not None and cached[0] == key:
+                    spaces[name] = cached[1]
+                    continue
+            view = SpaceView(
+                name=space.name,
+                description=space.description,
+                connected=tuple(connected.name for connected in space.connected_spaces),
+                items=tuple(_item_view(item) for item in space.items),
+                npcs=tuple(npc.name for npc in space.npcs),
+                text=str(space),
+                location=f"你位於 {space.name} ({space.description}). ",
+            )
+            if key is not None:
+                self._space_views[name] = (key, view)
+            spaces[name] = view
+
+        npcs: Dict[str, NPCView] = {}
+        for name, npc in world.get("npcs", {}).items():
+            percept = perceive(npc) if perceive is not None else None
+            waiting = npc.waiting_interaction if npc.waiting_interaction and npc.waiting_interaction.get("started") else None
+            npcs[name] = NPCView(
+                name=npc.name,
+                description=npc.description,
+                space=npc.current_space.name if npc.current_space else "",
+                home_space_name=npc.home_space_name,
+                position=tuple(npc.position) if npc.position else None,
+                moving=bool(npc.move_target and npc.position),
+                waiting_item=waiting.get("item_name") if waiting else None,
+                first_tick=npc.first_tick,
+                inventory=tuple(_item_view(item) for item in npc.inventory.items),
+                history=tuple(npc.history),
+                percept=PerceptView(
+                    visible_npcs=tuple(other.name for other in percept.visible_npcs),
+                    audible_npcs=tuple(other.name for other in percept.audible_npcs),
+                    visible_items=tuple(item.name for item in percept.visible_items),
+                    distant_items=tuple(item.name for item in percept.distant_items),
+                    summary=percept.summary(),
+                ) if percept is not None else None,
+                persona=npc.persona_text() if hasattr(npc, "persona_text") else f"你是 NPC {npc.name} ({npc.description}). ",
+                inventory_text=npc.inventory_text() if hasattr(npc, "inventory_text") else "",
+            )
+        return WorldSnapshot(
+            version=journal.version if journal is not None else 0,
+            time=time,
+            weather=weather,
+            spaces=MappingProxyType(spaces),
+            npcs=MappingProxyType(npcs),
+        )
+
+
+class DecisionQueue:
+    """思考執行緒提交決策、主執行緒依序取出套用的佇列 (執行緒安全)。"""
+
+    def __init__(self):
+        self._pending: Deque[NPCDecision] = deque()
+        self._lock = threading.Lock()
+
+    def submit(self, decision: NPCDecision) -> None:
+        with self._lock:
+            self._pending.append(decision)
+
+    def drain(self) -> List[NPCDecision]:
+        """取出目前所有待套用的決策 (依提交順序)。"""
+        with self._lock:
+            decisions = list(self._pending)
+            self._pending.clear()
+        return decisions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
@@ -0,0 +1,227 @@
+"""
+空間索引工具：讓每幀的碰撞與查詢只看附近的物件，而不是整個空間的所有物件。
+
+矩形一律使用世界座標的 (left, top, right, bottom)。
+"""
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import math
+import numpy as np
+
+Rect = Tuple[float, float, float, float]  # (left, top, right, bottom)
+Cell = Tuple[int, int]
+
+# 物品空間雜湊的預設格子大小 (世界座標系)，約為一般家具的大小
+DEFAULT_HASH_CELL_SIZE = 64.0
+
+
+def rects_overlap(a: Rect, b: Rect) -> bool:
+    """兩個矩形是否有重疊面積 (只接觸邊緣不算，與 pygame.Rect.colliderect 相同)。"""
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class SpatialHash:
+    """
+    均勻網格的空間雜湊。
+
+    每個物件依矩形放進它覆蓋到的格子 (bucket)，查詢時只檢查與查詢矩形重疊的格子。
+    物件以 id() 識別 (Pydantic 模型不可雜湊)，查詢結果依插入順序回傳，
+    因此與逐一掃描列表時的先後順序一致。
+    """
+
+    def __init__(self, cell_size: float = DEFAULT_HASH_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        self._buckets: Dict[Cell, List[int]] = {}
+        self._entries: Dict[int, Tuple[int, Any, Rect, List[Cell]]] = {}  # id -> (插入順序, 物件, 矩形, 格子)
+        self._next_order = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, obj: Any) -> bool:
+        return id(obj) in self._entries
+
+    def _cells(self, rect: Rect) -> List[Cell]:
+        size = self.cell_size
+        c0, r0 = int(math.floor(rect[0] / size)), int(math.floor(rect[1] / size))
+        c1, r1 = int(math.floor(rect[2] / size)), int(math.floor(rect[3] / size))
+        return [(c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)]
+
+    def insert(self, obj: Any, rect: Rect) -> None:
+        """加入物件；已存在時改為更新它的矩形 (保留原本的先後順序)。"""
+        key = id(obj)
+        order = self._entries[key][0] if key in self._entries else None
+        self.remove(obj)
+        if order is None:
+            order = self._next_order
+            self._next_order += 1
+        cells = self._cells(rect)
+        for cell in cells:
+            self._buckets.setdefault(cell, []).append(key)
+        self._entries[key] = (order, obj, rect, cells)
+
+    def update(self, obj: Any, rect: Rect) -> None:
+        """物件移動或改變大小後呼叫。"""
+        self.insert(obj, rect)
+
+    def remove(self, obj: Any) -> bool:
+        """移除物件，回傳是否原本存在。"""
+        entry = self._entries.pop(id(obj), None)
+        if entry is None:
+            return False
+        for cell in entry[3]:
+            bucket = self._buckets.get(cell)
+            if bucket is None:
+                continue
+            bucket.remove(id(obj))
+            if not bucket:
+                del self._buckets[cell]
+        return True
+
+    def rect_of(self, obj: Any) -> Optional[Rect]:
+        entry = self._entries.get(id(obj))
+        return entry[2] if entry else None
+
+    def query(self, rect: Rect) -> List[Any]:
+        """回傳矩形與 rect 重疊的物件 (依插入順序)。"""
+        found: Dict[int, Tuple[int, Any]] = {}
+        for cell in self._cells(rect):
+            for key in self._buckets.get(cell, ()):
+                if key in found:
+                    continue
+                order, obj, obj_rect, _ = self._entries[key]
+                if rects_overlap(rect, obj_rect):
+                    found[key] = (order, obj)
+        return [obj for _, obj in sorted(found.values(), key=lambda entry: entry[0])]
+
+    @classmethod
+    def from_rects(cls, pairs: Iterable[Tuple[Any, Rect]], cell_size: float = DEFAULT_HASH_CELL_SIZE) -> "SpatialHash":
+        spatial_hash = cls(cell_size)
+        for obj, rect in pairs:
+            spatial_hash.insert(obj, rect)
+        return spatial_hash
+
+
+def _space_rect(space: Any) -> Optional[Rect]:
+    pos = getattr(space, "display_pos", None)
+    size = getattr(space, "display_size", None)
+    if not pos or not size or len(pos) < 2 or len(size) < 2:
+        return None
+    return (float(pos[0]), float(pos[1]), float(pos[0] + size[0]), float(pos[1] + size[1]))
+
+
+class SpaceIndex:
+    """
+    空間矩形的靜態索引：查詢某一點位於哪個空間。
+
+    載入地圖時把每個空間放進它覆蓋到的網格格子 (格子大小預設為空間邊長的中位數)，
+    查詢時只檢查該點所在格子裡的少數空間。包含判斷與 pygame.Rect.collidepoint 相同
+    (左/上邊含、右/下邊不含)；多個空間重疊時回傳最先加入的那個，與依序掃描 world["spaces"] 一致。
+    空間的位置或大小改變時需要重建。
+    """
+
+    def __init__(self, spaces: Iterable[Any], cell_size: Optional[float] = None):
+        self._entries: List[Tuple[Any, Rect]] = []
+        for space in spaces:
+            rect = _space_rect(space)
+            if rect is not None and rect[2] > rect[0] and rect[3] > rect[1]:
+                self._entries.append((space, rect))
+        if cell_size is None:
+            sides = sorted(max(r[2] - r[0], r[3] - r[1]) for _, r in self._entries)
+            cell_size = sides[len(sides) // 2] if sides else DEFAULT_HASH_CELL_SIZE
+        self.cell_size = float(cell_size)
+        self._bins: Dict[Cell, List[int]] = {}
+        for i, (_, rect) in enumerate(self._entries):
+            c0, r0 = self._cell_of(rect[0], rect[1])
+            c1, r1 = self._cell_of(rect[2], rect[3])
+            for c in range(c0, c1 + 1):
+                for r in range(r0, r1 + 1):
+                    self._bins.setdefault((c, r), []).append(i)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def rebuild(self, spaces: Iterable[Any]) -> None:
+        """空間的位置或大小改變後就地重建 (格子大小重新計算)。"""
+        self.__init__(spaces)
+
+    def _cell_of(self, x: float, y: float) -> Cell:
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def spaces_at(self, point: Tuple[float, float]) -> List[Any]:
+        """回傳包含此點的所有空間 (依加入順序)。"""
+        x, y = point
+        result = []
+        for i in self._bins.get(self._cell_of(x, y), ()):
+            space, rect = self._entries[i]
+            if rect[0] <= x < rect[2] and rect[1] <= y < rect[3]:
+                result.append(space)
+        return result
+
+    def space_at(self, point: Tuple[float, float]) -> Optional[Any]:
+        """回傳包含此點的空間，沒有則回傳 None。"""
+        x, y = point
+        for i in self._bins.get(self._cell_of(x, y), ()):
+            space, rect = self._entries[i]
+            if rect[0] <= x < rect[2] and rect[1] <= y < rect[3]:
+                return space
+        return None
+
+
+class NeighborGrid:
+    """
+    以均勻網格找出彼此靠近的點對 (NumPy 向量化)，供 NPC 之間的避讓使用。
+
+    每個點只和自己與周圍 8 個格子裡的點比較，因此成本與附近的點數成正比，而不是 O(n²)。
+    格子大小應不小於要查詢的最大距離。
+    """
+
+    # 格子座標合成單一整數鍵時使用的偏移與倍數 (世界座標 / 格子大小需落在 ±2^20 內)
+    _KEY_OFFSET = 1 << 20
+    _KEY_SCALE = 1 << 21
+
+    def __init__(self, cell_size: float):
+        self.cell_size = float(cell_size)
+
+    def pairs(self, positions: np.ndarray, max_distance: Optional[float] = None,
+              groups: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        回傳距離小於 max_distance (預設為格子大小) 的點對索引 (i, j)，i < j。
+        提供 groups 時只回傳同一組 (例如同一個空間) 的點對。
+        """
+        n = len(positions)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        if n < 2:
+            return empty
+        max_distance = self.cell_size if max_distance is None else float(max_distance)
+        cells = np.floor(positions / self.cell_size).astype(np.int64) + self._KEY_OFFSET
+        keys = cells[:, 0] * self._KEY_SCALE + cells[:, 1]
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+
+        all_i, all_j = [], []
+        for ox in (-1, 0, 1):
+            for oy in (-1, 0, 1):
+                neighbor_keys = (cells[:, 0] + ox) * self._KEY_SCALE + (cells[:, 1] + oy)
+                start = np.searchsorted(sorted_keys, neighbor_keys, side="left")
+                end = np.searchsorted(sorted_keys, neighbor_keys, side="right")
+                counts = end - start
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                i = np.repeat(np.arange(n), counts)
+                # 每個 i 對應 sorted 陣列中 [start, end) 的連續區段
+                run_start = np.repeat(start - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+                j = order[run_start + np.arange(total)]
+                keep = i < j
+                all_i.append(i[keep])
+                all_j.append(j[keep])
+        if not all_i:
+            return empty
+        i = np.concatenate(all_i)
+        j = np.concatenate(all_j)
+        if groups is not None:
+            same = groups[i] == groups[j]
+            i, j = i[same], j[same]
+        delta = positions[i] - positions[j]
+        close = np.einsum("ij,ij->i", delta, delta) < max_distance * max_distance
+        return i[close], j[close]
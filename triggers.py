@@ -0,0 +1,134 @@
+"""
+以事件通知取代每幀輪詢距離的接近觸發器。
+
+程式碼登記「進入/離開某個半徑」或「抵達目的地」的條件，由移動引擎在 NPC 移動、換空間或抵達時通知，
+只檢查空間雜湊中與 NPC 位置重疊的觸發區域；條件成立時呼叫回呼，回呼的回傳值 (非 None) 交給引擎收集。
+"""
+from dataclasses import dataclass, field as dataclass_field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+import itertools
+import math
+
+from spatial import SpatialHash
+
+Point = Tuple[float, float]
+
+# 觸發區域空間雜湊的格子大小 (世界座標系)
+TRIGGER_CELL_SIZE = 64.0
+
+_trigger_ids = itertools.count(1)
+
+
+@dataclass
+class ProximityTrigger:
+    """以 center 為圓心、radius 為半徑的觸發區域 (限定在 space_name 空間內)。"""
+    space_name: str
+    center: Point
+    radius: float
+    on_enter: Optional[Callable[[Any], Any]] = None  # on_enter(npc)
+    on_exit: Optional[Callable[[Any], Any]] = None  # on_exit(npc)
+    watch: Optional[Any] = None  # 只觀察這個 NPC；None 表示任何 NPC
+    once: bool = False  # 第一次進入後自動移除
+    trigger_id: int = dataclass_field(default_factory=lambda: next(_trigger_ids))
+
+    def contains(self, point: Point) -> bool:
+        return math.dist(self.center, point) <= self.radius
+
+    def rect(self) -> Tuple[float, float, float, float]:
+        x, y = self.center
+        return (x - self.radius, y - self.radius, x + self.radius, y + self.radius)
+
+
+class TriggerSystem:
+    """
+    接近與抵達觸發器。
+
+    半徑觸發器依空間放進空間雜湊；移動引擎對移動過的 NPC 呼叫 moved(npc)，
+    只檢查與 NPC 位置重疊的觸發區域，並與上次的結果比較得出進入與離開。
+    抵達觸發器以 NPC 登記，引擎在 NPC 走完 move_target 時呼叫 arrived(npc)，每個只觸發一次。
+    """
+
+    def __init__(self, cell_size: float = TRIGGER_CELL_SIZE):
+        self.cell_size = cell_size
+        self._hashes: Dict[str, SpatialHash] = {}  # 空間名稱 -> 觸發區域的空間雜湊
+        self._triggers: Dict[int, ProximityTrigger] = {}
+        self._inside: Dict[int, Set[int]] = {}  # id(NPC) -> 目前所在的觸發區域
+        self._arrivals: Dict[int, List[Callable[[Any], Any]]] = {}  # id(NPC) -> 抵達時的回呼
+
+    def __len__(self) -> int:
+        return len(self._triggers)
+
+    def add(self, trigger: ProximityTrigger) -> ProximityTrigger:
+        """登記半徑觸發器；已經在區域內的 NPC 會在下次移動時觸發進入。"""
+        self._triggers[trigger.trigger_id] = trigger
+        self._hashes.setdefault(trigger.space_name, SpatialHash(self.cell_size)).insert(trigger, trigger.rect())
+        return trigger
+
+    def add_radius(self, space_name: str, center: Point, radius: float,
+                   on_enter: Optional[Callable[[Any], Any]] = None, on_exit: Optional[Callable[[Any], Any]] = None,
+                   watch: Optional[Any] = None, once: bool = False) -> ProximityTrigger:
+        return self.add(ProximityTrigger(space_name, (float(center[0]), float(center[1])), float(radius),
+                                         on_enter, on_exit, watch, once))
+
+    def remove(self, trigger: ProximityTrigger) -> bool:
+        """移除觸發器，回傳是否原本存在。"""
+        if self._triggers.pop(trigger.trigger_id, None) is None:
+            return False
+        spatial_hash = self._hashes.get(trigger.space_name)
+        if spatial_hash is not None:
+            spatial_hash.remove(trigger)
+        for inside in self._inside.values():
+            inside.discard(trigger.trigger_id)
+        return True
+
+    def on_arrival(self, npc: Any, callback: Callable[[Any], Any]) -> None:
+        """npc 下一次抵達 move_target 時呼叫 callback(npc) 一次。"""
+        self._arrivals.setdefault(id(npc), []).append(callback)
+
+    def cancel_arrival(self, npc: Any) -> None:
+        """取消 npc 尚未觸發的抵達回呼 (例如收到新的行動)。"""
+        self._arrivals.pop(id(npc), None)
+
+    def has_arrival(self, npc: Any) -> bool:
+        return id(npc) in self._arrivals
+
+    def arrived(self, npc: Any) -> List[Any]:
+        """移動引擎在 npc 抵達目標時呼叫，回傳回呼的結果。"""
+        callbacks = self._arrivals.pop(id(npc), None)
+        if not callbacks:
+            return []
+        return [result for result in (callback(npc) for callback in callbacks) if result is not None]
+
+    def moved(self, npc: Any) -> List[Any]:
+        """移動引擎在 npc 移動或換空間後呼叫，回傳這次進入/離開觸發的回呼結果。"""
+        space = getattr(npc, "current_space", None)
+        position = getattr(npc, "position", None)
+        previous = self._inside.get(id(npc), set())
+        if not self._triggers and not previous:
+            return []
+        now: Set[int] = set()
+        spatial_hash = self._hashes.get(space.name) if space is not None else None
+        if spatial_hash is not None and position:
+            point = (float(position[0]), float(position[1]))
+            for trigger in spatial_hash.query((point[0] - 0.5, point[1] - 0.5, point[0] + 0.5, point[1] + 0.5)):
+                if (trigger.watch is None or trigger.watch is npc) and trigger.contains(point):
+                    now.add(trigger.trigger_id)
+        results: List[Any] = []
+        for trigger_id in sorted(previous - now):
+            trigger = self._triggers.get(trigger_id)
+            if trigger is not None and trigger.on_exit is not None:
+                results.append(trigger.on_exit(npc))
+        for trigger_id in sorted(now - previous):
+            trigger = self._triggers.get(trigger_id)
+            if trigger is None:
+                continue
+            if trigger.once:
+                self.remove(trigger)
+                now.discard(trigger_id)
+            if trigger.on_enter is not None:
+                results.append(trigger.on_enter(npc))
+        if now:
+            self._inside[id(npc)] = now
+        else:
+            self._inside.pop(id(npc), None)
+        return [result for result in results if result is not None]